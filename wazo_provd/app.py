@@ -4,13 +4,17 @@
 from __future__ import annotations
 
 import functools
+import hashlib
+import json
 import logging
 import os.path
 import re
-from collections.abc import Callable, Generator
+from collections import defaultdict
+from collections.abc import Callable, Collection, Generator
 from copy import deepcopy
 from typing import TYPE_CHECKING, Any, Literal, Union
 from urllib.parse import urlparse
+from weakref import WeakKeyDictionary
 
 from pydantic import ValidationError
 from twisted.internet import defer
@@ -21,7 +25,13 @@ from wazo_provd.devices.config import (
     RawConfigError,
     build_autocreate_config,
 )
-from wazo_provd.devices.device import DeviceCollection, needs_reconfiguration
+from wazo_provd.devices.device import (
+    AbstractDeviceObserver,
+    DeviceCollection,
+    check_device_validity,
+    configuration_digest,
+    needs_reconfiguration,
+)
 from wazo_provd.localization import get_localization_service
 from wazo_provd.operation import (
     OIP_FAIL,
@@ -32,6 +42,7 @@ from wazo_provd.operation import (
 from wazo_provd.persist.common import ID_KEY
 from wazo_provd.persist.common import InvalidIdError as PersistInvalidIdError
 from wazo_provd.persist.common import NonDeletableError as PersistNonDeletableError
+from wazo_provd.persist.util import copy_document
 from wazo_provd.plugins import PluginManager, PluginNotLoadedError
 from wazo_provd.rest.server import auth
 from wazo_provd.rest.server.helpers.tenants import Tenant, tenant_helpers
@@ -40,7 +51,7 @@ from wazo_provd.services import (
     JsonConfigPersister,
     PersistentConfigurationServiceDecorator,
 )
-from wazo_provd.synchro import DeferredRWLock
+from wazo_provd.synchro import DeferredExecutor, DeferredLockManager, DeferredRWLock
 from wazo_provd.util import decode_bytes
 
 from .devices.schemas import (
@@ -118,34 +129,51 @@ def _wlock_arg(
     return decorator
 
 
-def _rlock(
+def _wlock(
     fun: Callable[Concatenate[ProvisioningApplication, P], R]
 ) -> Callable[Concatenate[ProvisioningApplication, P], Deferred]:
     # Decorator for instance method of ProvisioningApplication that need to
-    # acquire the read lock
+    # acquire the write lock
     @functools.wraps(fun)
     def aux(
         self: ProvisioningApplication, *args: P.args, **kwargs: P.kwargs
     ) -> Deferred:
-        d = self._rw_lock.read_lock.run(fun, self, *args, **kwargs)
+        d = self._locks.global_lock.write_lock.run(fun, self, *args, **kwargs)
         return d
 
     return aux
 
 
-def _wlock(
-    fun: Callable[Concatenate[ProvisioningApplication, P], R]
-) -> Callable[Concatenate[ProvisioningApplication, P], Deferred]:
-    # Decorator for instance method of ProvisioningApplication that need to
-    # acquire the write lock
-    @functools.wraps(fun)
-    def aux(
-        self: ProvisioningApplication, *args: P.args, **kwargs: P.kwargs
-    ) -> Deferred:
-        d = self._rw_lock.write_lock.run(fun, self, *args, **kwargs)
-        return d
+def _dev_lock(
+    delete: bool = False,
+) -> Callable[
+    [Callable[Concatenate[ProvisioningApplication, P], R]],
+    Callable[Concatenate[ProvisioningApplication, P], Deferred],
+]:
+    # Decorator for instance method of ProvisioningApplication operating on
+    # a single device, given as first argument either as a device or as a
+    # device ID, that need to acquire the locks of this device. delete must
+    # be true if the method deletes the device.
+    def decorator(
+        fun: Callable[Concatenate[ProvisioningApplication, P], R]
+    ) -> Callable[Concatenate[ProvisioningApplication, P], Deferred]:
+        @functools.wraps(fun)
+        def aux(
+            self: ProvisioningApplication, *args: P.args, **kwargs: P.kwargs
+        ) -> Deferred:
+            device_or_id = args[0]
+            if isinstance(device_or_id, dict):
+                device_id, new_device = device_or_id.get(ID_KEY), device_or_id
+            else:
+                device_id, new_device = device_or_id, None
 
-    return aux
+            d = self._dev_acquire_locks(device_id, new_device, delete)
+            d.addCallback(self._locks.run_acquired, fun, self, *args, **kwargs)
+            return d
+
+        return aux
+
+    return decorator
 
 
 def _check_common_raw_config_validity(raw_config: dict[str, Any]) -> None:
@@ -184,6 +212,57 @@ def _set_defaults_raw_config(raw_config: RawConfigDict) -> None:
     raw_config.setdefault('funckeys', {})  # type: ignore[typeddict-item]
 
 
+def _raw_config_digest(raw_config: RawConfigDict) -> str:
+    data = json.dumps(raw_config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _plugin_config_digest(gen_cfg: dict[str, Any], spec_cfg: dict[str, Any]) -> str:
+    data = json.dumps([gen_cfg, spec_cfg], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _keep_unchanged_values(
+    device: DeviceDict, old_device: DeviceDict, changed_keys: Collection[str]
+) -> None:
+    # Set the value of every key of device not in changed_keys back to its
+    # value in old_device
+    for key in set(device).union(old_device).difference(changed_keys):
+        if key in old_device:
+            device[key] = old_device[key]  # type: ignore[literal-required]
+        else:
+            del device[key]  # type: ignore[misc]
+
+
+def _set_configured(
+    device: BaseDeviceDict | DeviceDict, configured: bool, digest: str | None
+) -> bool:
+    # Set the configured state of the device and the digest of its
+    # configuration, and return true if any of them has changed
+    if not configured:
+        digest = None
+    changed = (
+        device.get('configured') != configured
+        or device.get('configured_digest') != digest
+    )
+    device['configured'] = configured
+    if digest is None:
+        device.pop('configured_digest', None)
+    else:
+        device['configured_digest'] = digest
+    return changed
+
+
+def _is_up_to_date(device: BaseDeviceDict | DeviceDict, digest: str | None) -> bool:
+    # Return true if the device is configured and the digest of its
+    # configuration has not changed since
+    return (
+        digest is not None
+        and device['configured']
+        and device.get('configured_digest') == digest
+    )
+
+
 class ProvisioningApplication:
     """Main logic used to provision devices.
 
@@ -201,6 +280,11 @@ class ProvisioningApplication:
 
     # Note that, seen from the outside, all method acquiring a lock return a
     # deferred.
+    #
+    # Methods operating on a single device only lock this device and its
+    # configs, so that unrelated devices are processed concurrently, while
+    # methods operating on configs or plugins, which may reconfigure any
+    # number of devices, acquire the global write lock.
 
     def __init__(
         self,
@@ -246,13 +330,33 @@ class ProvisioningApplication:
         self._base_raw_config = config['general']['base_raw_config']
         logger.info('Using base raw config %s', self._base_raw_config)
         _check_common_raw_config_validity(self._base_raw_config)
-        self._rw_lock = DeferredRWLock()
+        self._locks = DeferredLockManager()
+        # valid raw configs with the defaults set and their digest, by config
+        # ID, along with the raw config version they were computed from
+        self._valid_raw_configs: dict[
+            str, tuple[int, RawConfigDict | None, str | None]
+        ] = {}
+        # versions of the loaded plugins, by plugin ID
+        self._plugin_versions: dict[str, str | None] = {}
+        # digests of the general and specific configs the loaded plugins were
+        # loaded with, by plugin ID
+        self._plugin_config_digests: dict[str, str] = {}
+        # plugins configure devices in a pool of threads, so that rendering
+        # and writing their files don't block the reactor
+        self._plugin_executor = DeferredExecutor(
+            config['general']['plugin_threads'],
+            config['general']['plugin_threads_per_plugin'],
+        )
+        self._dev_observers: WeakKeyDictionary[
+            AbstractDeviceObserver, None
+        ] = WeakKeyDictionary()
         self._pg_load_all(True)
 
     @_wlock
     def close(self) -> None:
         logger.info('Closing provisioning application...')
         self.pg_mgr.close()
+        self._plugin_executor.close()
         logger.info('Provisioning application closed')
 
     def token(self) -> str | None:
@@ -304,92 +408,375 @@ class ProvisioningApplication:
                 defer.returnValue((plugin, raw_config))
         defer.returnValue((None, None))
 
-    def _dev_configure(
-        self, device: BaseDeviceDict | DeviceDict, plugin, raw_config: RawConfigDict
-    ):
-        # Return true if the device has been successfully configured (i.e.
-        # no exception were raised), else false.
-        device_id = device[ID_KEY]
-        logger.info('Configuring device %s with plugin %s', device_id, plugin.id)
-        if self.use_provisioning_key:
-            tenant_uuid = device.get('tenant_uuid', None)
-            if not tenant_uuid:
-                logger.warning(
-                    'Device %s is using provisioning key but has no tenant_uuid',
-                    device_id,
-                )
-                return False
-            provisioning_key = self.configure_service.get(
-                'provisioning_key', tenant_uuid
+    def _dev_has_tenant_for_provisioning_key(
+        self, device: BaseDeviceDict | DeviceDict
+    ) -> bool:
+        # Return false if the device can't be configured because it is using
+        # a provisioning key but has no tenant, else true.
+        if self.use_provisioning_key and not device.get('tenant_uuid', None):
+            logger.warning(
+                'Device %s is using provisioning key but has no tenant_uuid',
+                device[ID_KEY],
             )
+            return False
+        return True
 
-            raw_config = deepcopy(raw_config)
-            http_base_url = raw_config['http_base_url']
-            raw_config['http_base_url'] = f'{http_base_url}/{provisioning_key}'
+    @defer.inlineCallbacks
+    def _cfg_get_valid_raw_config(self, config_id: str):
+        # Return a deferred that will fire with a tuple (raw config, digest)
+        # where raw config is the raw config of the config, with the defaults
+        # set, or fire with the tuple (None, None) if the config is unknown
+        # or its raw config is not valid. Valid raw configs are cached by
+        # config ID and raw config version, and MUST NOT be modified.
+        version = self._cfg_collection.get_raw_config_version(config_id)
+        if version is None:
+            self._valid_raw_configs.pop(config_id, None)
+        elif (cached := self._valid_raw_configs.get(config_id)) is not None:
+            if cached[0] == version:
+                defer.returnValue(cached[1:])
+
+        raw_config = yield self._cfg_collection.get_raw_config(
+            config_id, self._base_raw_config
+        )
+        if raw_config is None:
+            defer.returnValue((None, None))
 
         _set_defaults_raw_config(raw_config)
         try:
             RawConfigSchema.validate(raw_config)
         except ValidationError as e:
             logger.error(
-                'Error while configuring device %s. '
+                'Error while configuring devices using config %s. '
                 'There were errors with some values: %s',
-                device_id,
+                config_id,
                 e.errors(),
             )
+            raw_config = None
         except Exception:
             # Do we really want to catch **any** exception?
+            logger.error(
+                'Error while configuring devices using config %s',
+                config_id,
+                exc_info=True,
+            )
+            raw_config = None
+        digest = None if raw_config is None else _raw_config_digest(raw_config)
+        # the version was taken before the raw config, so that a raw config
+        # modified in the meantime is never used for the new version
+        if version is not None:
+            self._valid_raw_configs[config_id] = version, raw_config, digest
+        defer.returnValue((raw_config, digest))
+
+    def _dev_get_configured_digest(
+        self,
+        device: BaseDeviceDict | DeviceDict,
+        plugin,
+        raw_config_digest: str | None,
+    ) -> str | None:
+        # Return the digest of everything the configuration of the device by
+        # the plugin depends on, or None if it is not known
+        plugin_version = self._plugin_versions.get(plugin.id)
+        if plugin_version is None or raw_config_digest is None:
+            return None
+        provisioning_key = None
+        if self.use_provisioning_key and (tenant_uuid := device.get('tenant_uuid')):
+            provisioning_key = self.configure_service.get(
+                'provisioning_key', tenant_uuid
+            )
+        return configuration_digest(
+            device,
+            plugin.id,
+            plugin_version,
+            self._plugin_config_digests.get(plugin.id),
+            self.proxies,
+            self.nat,
+            raw_config_digest,
+            provisioning_key,
+        )
+
+    def _dev_new_raw_config(
+        self, device: BaseDeviceDict | DeviceDict, valid_raw_config: RawConfigDict
+    ) -> RawConfigDict:
+        # Return a copy of the valid raw config to pass to the plugin for the
+        # device, with the provisioning key of its tenant added if needed
+        raw_config = copy_document(valid_raw_config)
+        if self.use_provisioning_key:
+            provisioning_key = self.configure_service.get(
+                'provisioning_key', device.get('tenant_uuid')
+            )
+            http_base_url = raw_config['http_base_url']
+            raw_config['http_base_url'] = f'{http_base_url}/{provisioning_key}'
+        return raw_config
+
+    @defer.inlineCallbacks
+    def _dev_plugin_configure(
+        self, device: BaseDeviceDict | DeviceDict, plugin, raw_config: RawConfigDict
+    ):
+        # Return a deferred that will fire with true if the plugin has
+        # successfully configured the device, else false.
+        device_id = device[ID_KEY]
+        try:
+            yield self._plugin_executor.call_in_thread(
+                plugin.id, [device_id], plugin.configure, device, raw_config
+            )
+        except Exception:
             logger.error('Error while configuring device %s', device_id, exc_info=True)
-        else:
+            defer.returnValue(False)
+        defer.returnValue(True)
+
+    def _dev_configure(
+        self,
+        device: BaseDeviceDict | DeviceDict,
+        plugin,
+        valid_raw_config: RawConfigDict,
+    ):
+        # Return a deferred that will fire with true if the device has been
+        # successfully configured (i.e. no exception were raised), else false.
+        device_id = device[ID_KEY]
+        logger.info('Configuring device %s with plugin %s', device_id, plugin.id)
+        if not self._dev_has_tenant_for_provisioning_key(device):
+            return defer.succeed(False)
+        raw_config = self._dev_new_raw_config(device, valid_raw_config)
+        return self._dev_plugin_configure(device, plugin, raw_config)
+
+    @defer.inlineCallbacks
+    def _dev_configure_batch(
+        self, plugin, devices_and_raw_configs: list[tuple[DeviceDict, RawConfigDict]]
+    ):
+        # Configure the devices with the plugin batch method, or one at a
+        # time if the plugin has no such method or if it failed. The valid
+        # raw configs are copied, with the provisioning key added, before
+        # being passed to the plugin. Return a deferred that will fire with
+        # the set of IDs of the devices that have been successfully
+        # configured.
+        if not devices_and_raw_configs:
+            defer.returnValue(set())
+
+        device_ids = [device[ID_KEY] for device, _ in devices_and_raw_configs]
+        configure_batch = getattr(plugin, 'configure_batch', None)
+        if configure_batch is not None:
+            logger.info(
+                'Configuring %d devices with plugin %s', len(device_ids), plugin.id
+            )
             try:
-                plugin.configure(device, raw_config)
+                yield self._plugin_executor.call_in_thread(
+                    plugin.id,
+                    device_ids,
+                    configure_batch,
+                    [
+                        (device, self._dev_new_raw_config(device, raw_config))
+                        for device, raw_config in devices_and_raw_configs
+                    ],
+                )
+            except NotImplementedError:
+                pass
             except Exception:
                 logger.error(
-                    'Error while configuring device %s', device_id, exc_info=True
+                    'Error while configuring devices with plugin %s, '
+                    'configuring them one at a time',
+                    plugin.id,
+                    exc_info=True,
+                )
+            else:
+                defer.returnValue(set(device_ids))
+
+        deferreds = []
+        for device, raw_config in devices_and_raw_configs:
+            logger.info(
+                'Configuring device %s with plugin %s', device[ID_KEY], plugin.id
+            )
+            deferreds.append(
+                self._dev_plugin_configure(
+                    device, plugin, self._dev_new_raw_config(device, raw_config)
+                )
+            )
+        results = yield defer.gatherResults(deferreds)
+        defer.returnValue(
+            {
+                device_id
+                for device_id, configured in zip(device_ids, results)
+                if configured
+            }
+        )
+
+    @defer.inlineCallbacks
+    def _dev_reconfigure_plugin_devices(
+        self,
+        plugin,
+        devices: list[DeviceDict],
+        valid_raw_configs: dict[str, tuple[RawConfigDict | None, str | None]],
+    ):
+        # Deconfigure then configure the devices of the plugin whose
+        # configuration has changed. valid_raw_configs is a dictionary of
+        # config ID to (valid raw config, digest), (None, None) for unknown
+        # or invalid configs. Return a deferred that will fire with a
+        # dictionary of device ID to configured digest of the devices that
+        # are configured.
+        digests = {}
+        outdated_devices = []
+        for device in devices:
+            valid_raw_config, raw_config_digest = None, None
+            if (cfg_id := device.get('config')) is not None:
+                valid_raw_config, raw_config_digest = valid_raw_configs.get(
+                    cfg_id, (None, None)
                 )
+            digest = self._dev_get_configured_digest(device, plugin, raw_config_digest)
+            if _is_up_to_date(device, digest):
+                digests[device[ID_KEY]] = digest
             else:
-                return True
-        return False
+                outdated_devices.append((device, valid_raw_config, digest))
+        if digests:
+            logger.info(
+                'Not reconfiguring %d devices with plugin %s: not changed',
+                len(digests),
+                plugin.id,
+            )
+
+        yield defer.gatherResults(
+            [
+                self._dev_deconfigure(device, plugin)
+                for device, _, _ in outdated_devices
+                if device['configured']
+            ]
+        )
+        devices_and_raw_configs = [
+            (device, valid_raw_config)
+            for device, valid_raw_config, _ in outdated_devices
+            if valid_raw_config is not None
+            and self._dev_has_tenant_for_provisioning_key(device)
+        ]
+        configured_ids = yield self._dev_configure_batch(
+            plugin, devices_and_raw_configs
+        )
+        for device, _, digest in outdated_devices:
+            if device[ID_KEY] in configured_ids:
+                digests[device[ID_KEY]] = digest
+        defer.returnValue(digests)
+
+    @defer.inlineCallbacks
+    def _dev_reconfigure_many(
+        self, devices: list[DeviceDict], oip: OperationInProgress | None = None
+    ):
+        # Reconfigure the devices whose configuration has changed, one batch
+        # per plugin, then update the devices whose configured state or
+        # digest has changed all at once. Devices
+        # without a loaded plugin are left untouched. Return a deferred that
+        # will fire with None once done. The progress, in number of devices,
+        # is reported to oip.
+        if oip is None:
+            oip = OperationInProgress()
+        oip.state = OIP_PROGRESS
+        try:
+            devices_by_plugin_id: dict[str, list[DeviceDict]] = defaultdict(list)
+            valid_raw_configs: dict[str, tuple[RawConfigDict | None, str | None]] = {}
+            for device in devices:
+                if (plugin_id := device.get('plugin')) is not None:
+                    devices_by_plugin_id[plugin_id].append(device)
+                cfg_id = device.get('config')
+                if cfg_id is not None and cfg_id not in valid_raw_configs:
+                    valid_raw_configs[cfg_id] = yield self._cfg_get_valid_raw_config(
+                        cfg_id
+                    )
+
+            oip.current = 0
+            oip.end = sum(len(devices) for devices in devices_by_plugin_id.values())
+            updated_devices = []
+
+            def add_progress(plugin_devices: list[DeviceDict]) -> None:
+                oip.current = (oip.current or 0) + len(plugin_devices)
+
+            def on_reconfigured(
+                digests: dict[str | None, str | None], plugin_devices: list[DeviceDict]
+            ) -> None:
+                for device in plugin_devices:
+                    device_id = device[ID_KEY]
+                    configured = device_id in digests
+                    if _set_configured(device, configured, digests.get(device_id)):
+                        updated_devices.append(device)
+                add_progress(plugin_devices)
+
+            # the devices of different plugins are reconfigured concurrently
+            deferreds = []
+            for plugin_id, plugin_devices in devices_by_plugin_id.items():
+                if (plugin := self.pg_mgr.get(plugin_id)) is None:
+                    add_progress(plugin_devices)
+                    continue
+                deferred = self._dev_reconfigure_plugin_devices(
+                    plugin, plugin_devices, valid_raw_configs
+                )
+                deferred.addCallback(on_reconfigured, plugin_devices)
+                deferreds.append(deferred)
+            yield defer.gatherResults(deferreds, consumeErrors=True)
+
+            if updated_devices:
+                yield self._dev_collection.update_many(updated_devices)
+        except Exception:
+            oip.state = OIP_FAIL
+            raise
+        else:
+            oip.state = OIP_SUCCESS
+
+    @defer.inlineCallbacks
+    def _dev_get_configuration(self, device: BaseDeviceDict | DeviceDict):
+        # Return a deferred that will fire with a tuple (plugin, valid raw
+        # config, configured digest) the device would be configured with,
+        # or fire with the tuple (None, None, None) if it can't be configured
+        if (plugin := self._dev_get_plugin(device)) is None or 'config' not in device:
+            defer.returnValue((None, None, None))
+        valid_raw_config, raw_config_digest = yield self._cfg_get_valid_raw_config(
+            device['config']
+        )
+        if valid_raw_config is None:
+            defer.returnValue((None, None, None))
+        digest = self._dev_get_configured_digest(device, plugin, raw_config_digest)
+        defer.returnValue((plugin, valid_raw_config, digest))
 
     @defer.inlineCallbacks
     def _dev_configure_if_possible(self, device: BaseDeviceDict | DeviceDict):
-        # Return a deferred that fire with true if the device has been
-        # successfully configured (i.e. no exception were raised), else false.
-        plugin, raw_config = yield self._dev_get_plugin_and_raw_config(device)
+        # Return a deferred that fire with a tuple (configured, digest) where
+        # configured is true if the device has been successfully configured
+        # (i.e. no exception were raised), else false.
+        plugin, valid_raw_config, digest = yield self._dev_get_configuration(device)
         if plugin is None:
-            defer.returnValue(False)
-        else:
-            defer.returnValue(self._dev_configure(device, plugin, raw_config))
+            defer.returnValue((False, None))
+        configured = yield self._dev_configure(device, plugin, valid_raw_config)
+        defer.returnValue((configured, digest))
 
+    @defer.inlineCallbacks
     def _dev_deconfigure(self, device: BaseDeviceDict | DeviceDict, plugin):
-        # Return true if the device has been successfully deconfigured (i.e.
-        # no exception were raised), else false.
-        logger.info('Deconfiguring device %s with plugin %s', device[ID_KEY], plugin.id)
+        # Return a deferred that will fire with true if the device has been
+        # successfully deconfigured (i.e. no exception were raised), else false.
+        device_id = device[ID_KEY]
+        logger.info('Deconfiguring device %s with plugin %s', device_id, plugin.id)
         try:
-            plugin.deconfigure(device)
+            yield self._plugin_executor.call_in_thread(
+                plugin.id, [device_id], plugin.deconfigure, device
+            )
         except Exception:
             logger.error(
-                'Error while deconfiguring device %s', device[ID_KEY], exc_info=True
+                'Error while deconfiguring device %s', device_id, exc_info=True
             )
-            return False
-        else:
-            return True
+            defer.returnValue(False)
+        defer.returnValue(True)
 
     def _dev_deconfigure_if_possible(self, device: BaseDeviceDict | DeviceDict):
-        # Return true if the device has been successfully configured (i.e.
-        # no exception were raised), else false.
+        # Return a deferred that will fire with true if the device has been
+        # successfully deconfigured (i.e. no exception were raised), else false.
         if (plugin := self._dev_get_plugin(device)) is None:
-            return False
+            return defer.succeed(False)
         return self._dev_deconfigure(device, plugin)
 
     def _dev_synchronize(
         self, device: BaseDeviceDict | DeviceDict, plugin, raw_config: RawConfigDict
     ):
         # Return a deferred that will fire with None once the device
-        # synchronization is completed.
+        # synchronization is completed. Plugins synchronize devices
+        # asynchronously, so this is done in the reactor thread.
         logger.info('Synchronizing device %s with plugin %s', device[ID_KEY], plugin.id)
         _set_defaults_raw_config(raw_config)
-        return plugin.synchronize(device, raw_config)
+        return self._plugin_executor.call(
+            plugin.id, [device[ID_KEY]], plugin.synchronize, device, raw_config
+        )
 
     @defer.inlineCallbacks
     def _dev_synchronize_if_possible(self, device: BaseDeviceDict | DeviceDict):
@@ -404,6 +791,54 @@ class ProvisioningApplication:
 
         yield self._dev_synchronize(device, plugin, raw_config)
 
+    @defer.inlineCallbacks
+    def _dev_get_cfg_id(self, device_id: str | None):
+        if device_id is None:
+            defer.returnValue(None)
+        device = yield self._dev_collection.retrieve(device_id)
+        defer.returnValue(device.get('config') if device else None)
+
+    @defer.inlineCallbacks
+    def _dev_acquire_locks(
+        self, device_id: str | None, new_device: DeviceDict | None, delete: bool
+    ):
+        # Return a deferred that will fire with a lock token once the lock of
+        # the device and the locks of its current and new configs have been
+        # acquired. The lock of a transient config the device is leaving is a
+        # write lock, since the config is deleted once no device uses it.
+        while True:
+            old_cfg_id = yield self._dev_get_cfg_id(device_id)
+            if delete:
+                new_cfg_id = None
+            elif new_device is None:
+                new_cfg_id = old_cfg_id
+            else:
+                new_cfg_id = new_device.get('config')
+
+            write_keys = []
+            if device_id is not None:
+                write_keys.append(('device', device_id))
+            read_keys = [
+                ('config', cfg_id)
+                for cfg_id in (old_cfg_id, new_cfg_id)
+                if cfg_id is not None
+            ]
+            if old_cfg_id is not None and old_cfg_id != new_cfg_id:
+                old_cfg = yield self._cfg_collection.retrieve(old_cfg_id)
+                if old_cfg and old_cfg.get('transient'):
+                    write_keys.append(('config', old_cfg_id))
+
+            token = yield self._locks.acquire(write_keys, read_keys)
+            try:
+                cfg_id = yield self._dev_get_cfg_id(device_id)
+            except Exception:
+                self._locks.release(token)
+                raise
+            if cfg_id == old_cfg_id:
+                defer.returnValue(token)
+            # the config of the device has changed while acquiring the locks
+            self._locks.release(token)
+
     @defer.inlineCallbacks
     def _dev_get_or_raise(self, device_id: str):
         device = yield self._dev_collection.retrieve(device_id)
@@ -412,7 +847,7 @@ class ProvisioningApplication:
 
         defer.returnValue(device)
 
-    @_wlock
+    @_dev_lock()
     @defer.inlineCallbacks
     def dev_insert(self, device: DeviceDict):
         """Insert a new device into the provisioning application.
@@ -433,7 +868,8 @@ class ProvisioningApplication:
         to do so.
 
         Note that:
-        - the value of 'configured' is ignored if given.
+        - the values of 'configured' and 'configured_digest' are ignored if
+          given.
         - the passed in device object might be modified so that if the device
           has been inserted successfully, the device object has the same value
           as the one which has been inserted.
@@ -442,7 +878,7 @@ class ProvisioningApplication:
         logger.info('Inserting new device')
         try:
             # new device are never configured
-            device['configured'] = False
+            _set_configured(device, False, None)
 
             if not device.get('tenant_uuid'):
                 device['tenant_uuid'] = self._tenant_uuid  # type: ignore
@@ -454,9 +890,8 @@ class ProvisioningApplication:
             except PersistInvalidIdError as e:
                 raise InvalidIdError(e)
             else:
-                configured = yield self._dev_configure_if_possible(device)
-                if configured:
-                    device['configured'] = True
+                configured, digest = yield self._dev_configure_if_possible(device)
+                if _set_configured(device, configured, digest):
                     yield self._dev_collection.update(device)
                 defer.returnValue(device_id)
         except Exception:
@@ -465,12 +900,116 @@ class ProvisioningApplication:
 
     @_wlock
     @defer.inlineCallbacks
-    def dev_update(self, device: DeviceDict, pre_update_hook=None):
+    def _dev_insert_many(self, devices: list[DeviceDict]):
+        # Return a deferred that will fire with a list with, for each device,
+        # either its ID if it has been inserted, or the exception explaining
+        # why it has not
+        try:
+            device_ids = [device[ID_KEY] for device in devices if ID_KEY in device]
+            existing_devices = yield self._dev_collection.find(
+                {ID_KEY: {'$in': device_ids}}, fields=[ID_KEY]
+            )
+            used_ids = {device[ID_KEY] for device in existing_devices}
+            results: list[DeviceDict | Exception] = []
+            valid_devices = []
+            for device in devices:
+                # new device are never configured
+                _set_configured(device, False, None)
+                if not device.get('tenant_uuid'):
+                    device['tenant_uuid'] = self._tenant_uuid  # type: ignore
+                device['is_new'] = device['tenant_uuid'] == self._tenant_uuid
+                try:
+                    if ID_KEY in device:
+                        if device[ID_KEY] in used_ids:
+                            raise InvalidIdError(
+                                f'invalid device ID "{device[ID_KEY]}"'
+                            )
+                        used_ids.add(device[ID_KEY])
+                    check_device_validity(device)
+                except (InvalidIdError, ValueError) as e:
+                    results.append(e)
+                else:
+                    results.append(device)
+                    valid_devices.append(device)
+
+            logger.info('Inserting %d new devices', len(valid_devices))
+            yield self._dev_collection.insert_many(valid_devices)
+            defer.returnValue(
+                [
+                    result if isinstance(result, Exception) else result[ID_KEY]
+                    for result in results
+                ]
+            )
+        except Exception:
+            logger.error('Error while inserting devices', exc_info=True)
+            raise
+
+    @_wlock
+    @defer.inlineCallbacks
+    def _dev_configure_new_many(self, device_ids: list[str], oip: OperationInProgress):
+        # Configure the given devices that are still not configured
+        devices = yield self._dev_collection.find(
+            {ID_KEY: {'$in': device_ids}, 'configured': False}
+        )
+        yield self._dev_reconfigure_many(list(devices), oip)
+
+    def dev_insert_many(
+        self, devices: list[DeviceDict]
+    ) -> tuple[Deferred, OperationInProgress]:
+        """Insert many new devices at once, then configure them in the
+        background.
+
+        Return a tuple (deferred, operation in progress). The deferred will
+        fire once the devices are inserted, with a list with, for each device,
+        either its ID if it has been inserted, or else an InvalidIdError or a
+        ValueError if the device is not valid or its ID is already in use.
+        The operation in progress reports the configuration of the inserted
+        devices, done in batches once they have been inserted.
+
+        The devices are inserted under a single lock acquisition and written
+        all at once. The rules of dev_insert otherwise apply.
+
+        """
+        oip = OperationInProgress('configure')
+
+        def on_inserted(results: list[str | Exception]) -> list[str | Exception]:
+            device_ids = [
+                result for result in results if not isinstance(result, Exception)
+            ]
+            deferred = self._dev_configure_new_many(device_ids, oip)
+            deferred.addErrback(on_configure_error)
+            return results
+
+        def on_configure_error(failure):
+            oip.state = OIP_FAIL
+            logger.error('Error while configuring devices: %s', failure.value)
+
+        def on_insert_error(failure):
+            oip.state = OIP_FAIL
+            return failure
+
+        deferred = self._dev_insert_many(devices)
+        deferred.addCallbacks(on_inserted, on_insert_error)
+        return deferred, oip
+
+    @_dev_lock()
+    @defer.inlineCallbacks
+    def dev_update(
+        self,
+        device: DeviceDict,
+        pre_update_hook=None,
+        changed_keys: Collection[str] | None = None,
+    ):
         """Update the device.
 
         The pre_update_hook function is called with the device and
         its config just before the device is persisted.
 
+        If changed_keys is given, only the values of these keys are taken
+        from the device, the values of the other keys being set back to the
+        ones of the stored device, so that concurrent updates of the other
+        keys are not lost.
+
         Return a deferred that fire with None once the update is completed.
 
         The deferred will fire its errback with an exception if device has
@@ -481,26 +1020,33 @@ class ProvisioningApplication:
 
         The device is automatically deconfigured/configured if needed.
 
-        Note that the value of 'configured' is ignored if given.
+        Note that the values of 'configured' and 'configured_digest' are
+        ignored if given.
 
         """
         try:
             try:
-                device_id = device[ID_KEY]
+                device_id: str = device[ID_KEY]  # type: ignore[assignment]
             except KeyError:
                 raise InvalidIdError(f'No id key for device {device}')
             else:
                 logger.info('Updating device %s', device_id)
                 old_device = yield self._dev_get_or_raise(device_id)
+                if changed_keys is not None:
+                    _keep_unchanged_values(device, old_device, changed_keys)
                 if needs_reconfiguration(old_device, device):
                     # Deconfigure old device it was configured
                     if old_device['configured']:
-                        self._dev_deconfigure_if_possible(old_device)
+                        yield self._dev_deconfigure_if_possible(old_device)
                     # Configure new device if possible
-                    configured = yield self._dev_configure_if_possible(device)
-                    device['configured'] = configured
+                    configured, digest = yield self._dev_configure_if_possible(device)
+                    _set_configured(device, configured, digest)
                 else:
-                    device['configured'] = old_device['configured']
+                    _set_configured(
+                        device,
+                        old_device['configured'],
+                        old_device.get('configured_digest'),
+                    )
                 if pre_update_hook is not None:
                     config = yield self._cfg_collection.retrieve(device.get('config'))
                     pre_update_hook(device, config)
@@ -509,6 +1055,7 @@ class ProvisioningApplication:
                 if device != old_device:
                     device['is_new'] = device['tenant_uuid'] == self._tenant_uuid
                     yield self._dev_collection.update(device)
+                    self._dev_notify(device_id, 'update')
                     # check if old device was using a transient config that is
                     # no more in use
                     if 'config' in old_device and old_device['config'] != device.get(
@@ -525,14 +1072,14 @@ class ProvisioningApplication:
                                     {'config': old_device_cfg_id}
                                 )
                             ):
-                                self._cfg_collection.delete(old_device_cfg_id)
+                                self._cfg_delete(old_device_cfg_id)
                 else:
                     logger.info('Not updating device %s: not changed', device_id)
         except Exception:
             logger.error('Error while updating device', exc_info=True)
             raise
 
-    @_wlock
+    @_dev_lock(delete=True)
     @defer.inlineCallbacks
     def dev_delete(self, device_id: str):
         """Delete the device with the given ID.
@@ -551,8 +1098,9 @@ class ProvisioningApplication:
             device = yield self._dev_get_or_raise(device_id)
             # Next line should never raise an exception since we successfully
             # retrieve the device with the same id just before and we are
-            # using the write lock
+            # holding the lock of the device
             yield self._dev_collection.delete(device_id)
+            self._dev_notify(device_id, 'delete')
             # check if device was using a transient config that is no more in use
             if 'config' in device:
                 device_cfg_id = device['config']
@@ -562,13 +1110,39 @@ class ProvisioningApplication:
                     if not (
                         yield self._dev_collection.find_one({'config': device_cfg_id})
                     ):
-                        self._cfg_collection.delete(device_cfg_id)
+                        self._cfg_delete(device_cfg_id)
             if device['configured']:
-                self._dev_deconfigure_if_possible(device)
+                yield self._dev_deconfigure_if_possible(device)
         except Exception:
             logger.error('Error while deleting device', exc_info=True)
             raise
 
+    def dev_attach(self, observer: AbstractDeviceObserver) -> None:
+        """Attach an AbstractDeviceObserver object to this application.
+
+        Note that since observers are weakly referenced, you MUST keep a
+        reference to each one somewhere in the application if you want them
+        not to be immediately garbage collected.
+
+        """
+        logger.debug('Attaching device observer %s', observer)
+        self._dev_observers[observer] = None
+
+    def dev_detach(self, observer: AbstractDeviceObserver) -> None:
+        """Detach an AbstractDeviceObserver object from this application."""
+        logger.debug('Detaching device observer %s', observer)
+        self._dev_observers.pop(observer, None)
+
+    def _dev_notify(self, device_id: str, action: str) -> None:
+        # action is either 'update' or 'delete'
+        for observer in list(self._dev_observers):
+            try:
+                getattr(observer, f'dev_{action}')(device_id)
+            except Exception:
+                logger.error(
+                    'Error while notifying device observer %s', observer, exc_info=True
+                )
+
     def dev_retrieve(self, device_id: str):
         """Return a deferred that fire with the device with the given ID, or
         fire with None if there's no such document.
@@ -582,11 +1156,15 @@ class ProvisioningApplication:
     def dev_find_one(self, selector, *args, **kwargs):
         return self._dev_collection.find_one(selector, *args, **kwargs)
 
-    @_wlock
+    @_dev_lock()
     @defer.inlineCallbacks
-    def dev_reconfigure(self, device_id: str):
-        """Force the reconfiguration of the device. This is usually not
-        necessary since configuration is usually done automatically.
+    def dev_reconfigure(self, device_id: str, force: bool = False):
+        """Reconfigure the device. This is usually not necessary since
+        configuration is usually done automatically.
+
+        The device is not reconfigured if it is already configured and
+        nothing its configuration depends on has changed since, unless
+        force is true.
 
         Return a deferred that will fire once the device reconfiguration is
         completed, with either True if the device has been successfully
@@ -599,18 +1177,23 @@ class ProvisioningApplication:
         logger.info('Reconfiguring device %s', device_id)
         try:
             device = yield self._dev_get_or_raise(device_id)
+            plugin, valid_raw_config, digest = yield self._dev_get_configuration(device)
+            if not force and _is_up_to_date(device, digest):
+                logger.info('Not reconfiguring device %s: not changed', device_id)
+                defer.returnValue(True)
             if device['configured']:
-                self._dev_deconfigure_if_possible(device)
-            configured = yield self._dev_configure_if_possible(device)
-            if device['configured'] != configured:
-                device['configured'] = configured
+                yield self._dev_deconfigure_if_possible(device)
+            configured = False
+            if plugin is not None:
+                configured = yield self._dev_configure(device, plugin, valid_raw_config)
+            if _set_configured(device, configured, digest):
                 yield self._dev_collection.update(device)
             defer.returnValue(configured)
         except Exception:
             logger.error('Error while reconfiguring device', exc_info=True)
             raise
 
-    @_rlock
+    @_dev_lock()
     @defer.inlineCallbacks
     def dev_synchronize(self, device_id: str):
         """Synchronize the physical device with its config.
@@ -647,6 +1230,19 @@ class ProvisioningApplication:
             raise InvalidIdError(f'Invalid config ID "{config_id}"')
         defer.returnValue(config)
 
+    @defer.inlineCallbacks
+    def _cfg_reconfigure_descendants(
+        self, config_id: str, oip: OperationInProgress | None = None
+    ):
+        # Reconfigure every device depending directly or indirectly on the
+        # config. Devices whose config doesn't exist anymore are deconfigured.
+        affected_cfg_ids = yield self._cfg_collection.get_descendants(config_id)
+        affected_cfg_ids.add(config_id)
+        affected_devices = yield self._dev_collection.find(
+            {'config': {'$in': list(affected_cfg_ids)}}
+        )
+        yield self._dev_reconfigure_many(list(affected_devices), oip)
+
     @_wlock
     @defer.inlineCallbacks
     def cfg_insert(self, config: ConfigDict):
@@ -673,36 +1269,7 @@ class ProvisioningApplication:
                 raise InvalidIdError(e)
             else:
                 # configure each device that depend on the newly inserted config
-                # 1. get the set of affected configs
-                affected_cfg_ids = yield self._cfg_collection.get_descendants(config_id)
-                affected_cfg_ids.add(config_id)
-                # 2. get the raw_config of every affected config
-                raw_configs = {}
-                for affected_cfg_id in affected_cfg_ids:
-                    raw_configs[
-                        affected_cfg_id
-                    ] = yield self._cfg_collection.get_raw_config(
-                        affected_cfg_id, self._base_raw_config
-                    )
-                # 3. reconfigure/deconfigure each affected devices
-                affected_devices = yield self._dev_collection.find(
-                    {'config': {'$in': list(affected_cfg_ids)}}
-                )
-                for device in affected_devices:
-                    plugin = self._dev_get_plugin(device)
-                    if plugin is not None:
-                        raw_config = raw_configs[device['config']]
-                        assert raw_config is not None
-                        # deconfigure
-                        if device['configured']:
-                            self._dev_deconfigure(device, plugin)
-                        # configure
-                        configured = self._dev_configure(device, plugin, raw_config)
-                        # update device if it has changed
-                        if device['configured'] != configured:
-                            device['configured'] = configured
-                            yield self._dev_collection.update(device)
-                # 4. return the device id
+                yield self._cfg_reconfigure_descendants(config_id)
                 defer.returnValue(config_id)
         except Exception:
             logger.error('Error while inserting config', exc_info=True)
@@ -710,11 +1277,14 @@ class ProvisioningApplication:
 
     @_wlock
     @defer.inlineCallbacks
-    def cfg_update(self, config):
+    def cfg_update(self, config, oip: OperationInProgress | None = None):
         """Update the config.
 
         Return a deferred that fire with None once the update is completed.
 
+        If oip is given, it is updated with the progress of the
+        reconfiguration of the affected devices.
+
         The deferred will fire its errback with an exception if config has
         no 'id' key.
 
@@ -734,44 +1304,29 @@ class ProvisioningApplication:
             old_config = yield self._cfg_get_or_raise(config_id)
             if old_config == config:
                 logger.info('config has not changed, ignoring update')
+                if oip is not None:
+                    oip.state = OIP_SUCCESS
             else:
                 yield self._cfg_collection.update(config)
-                affected_cfg_ids = yield self._cfg_collection.get_descendants(config_id)
-                affected_cfg_ids.add(config_id)
-                # 2. get the raw_config of every affected config
-                raw_configs = {}
-                for affected_cfg_id in affected_cfg_ids:
-                    raw_configs[
-                        affected_cfg_id
-                    ] = yield self._cfg_collection.get_raw_config(
-                        affected_cfg_id, self._base_raw_config
-                    )
-                # 3. reconfigure each device having a direct dependency on
-                #    one of the affected cfg id
-                affected_devices = yield self._dev_collection.find(
-                    {'config': {'$in': list(affected_cfg_ids)}}
-                )
-                for device in affected_devices:
-                    plugin = self._dev_get_plugin(device)
-                    if plugin is not None:
-                        raw_config = raw_configs[device['config']]
-                        assert raw_config is not None
-                        # deconfigure
-                        if device['configured']:
-                            self._dev_deconfigure(device, plugin)
-                        # configure
-                        configured = self._dev_configure(device, plugin, raw_config)
-                        # update device if it has changed
-                        if device['configured'] != configured:
-                            device['configured'] = configured
-                            yield self._dev_collection.update(device)
+                yield self._cfg_reconfigure_descendants(config_id, oip)
         except Exception:
             logger.error('Error while updating config', exc_info=True)
+            if oip is not None:
+                oip.state = OIP_FAIL
             raise
 
+    def _cfg_delete(self, config_id: str) -> Deferred:
+        # Delete the config and forget its valid raw config
+        def callback(_: Any) -> None:
+            self._valid_raw_configs.pop(config_id, None)
+
+        d = self._cfg_collection.delete(config_id)
+        d.addCallback(callback)
+        return d
+
     @_wlock
     @defer.inlineCallbacks
-    def cfg_delete(self, config_id):
+    def cfg_delete(self, config_id, oip: OperationInProgress | None = None):
         """Delete the config with the given ID. Does not delete any reference
         to it from other configs.
 
@@ -782,58 +1337,25 @@ class ProvisioningApplication:
         has unknown id.
 
         The devices depending directly or indirectly on this config are
-        automatically reconfigured if needed.
+        automatically reconfigured if needed. If oip is given, it is updated
+        with the progress of this reconfiguration.
 
         """
         config_id = decode_bytes(config_id)
         logger.info('Deleting config %s', config_id)
         try:
             try:
-                yield self._cfg_collection.delete(config_id)
+                yield self._cfg_delete(config_id)
             except PersistInvalidIdError as e:
                 raise InvalidIdError(e)
             except PersistNonDeletableError as e:
                 raise NonDeletableError(e)
             else:
-                # 1. get the set of affected configs
-                affected_cfg_ids = yield self._cfg_collection.get_descendants(config_id)
-                affected_cfg_ids.add(config_id)
-                # 2. get the raw_config of every affected config
-                raw_configs = {}
-                for affected_cfg_id in affected_cfg_ids:
-                    raw_configs[
-                        affected_cfg_id
-                    ] = yield self._cfg_collection.get_raw_config(
-                        affected_cfg_id, self._base_raw_config
-                    )
-                # 3. reconfigure/deconfigure each affected devices
-                affected_devices = yield self._dev_collection.find(
-                    {'config': {'$in': list(affected_cfg_ids)}}
-                )
-                for device in affected_devices:
-                    plugin = self._dev_get_plugin(device)
-                    if plugin is not None:
-                        raw_config = raw_configs[device['config']]
-                        # deconfigure
-                        if device['configured']:
-                            self._dev_deconfigure(device, plugin)
-                        # configure if device config is not the deleted config
-                        if device['config'] == config_id:
-                            assert raw_config is None
-                            # update device if it has changed
-                            if device['configured']:
-                                device['configured'] = False
-                                yield self._dev_collection.update(device)
-                        else:
-                            assert raw_config is not None
-                            configured = yield self._dev_configure(
-                                device, plugin, raw_config
-                            )
-                            # update device if it has changed
-                            if device['configured'] != configured:
-                                yield self._dev_collection.update(device)
+                yield self._cfg_reconfigure_descendants(config_id, oip)
         except Exception:
             logger.error('Error while deleting config', exc_info=True)
+            if oip is not None:
+                oip.state = OIP_FAIL
             raise
 
     def cfg_retrieve(self, config_id):
@@ -910,11 +1432,16 @@ class ProvisioningApplication:
             logger.error('Error while configuring plugin %s', plugin_id, exc_info=True)
             raise
 
-    def _pg_load(self, plugin_id: str) -> None:
-        # Raise an exception if plugin loading or common configuration fail
+    def _pg_new_config(self, plugin_id: str) -> tuple[dict, dict]:
+        # Return the general and specific configuration the plugin is loaded with
         gen_cfg = dict(self._split_config['general'])
         gen_cfg['proxies'] = self.proxies
         spec_cfg = dict(self._split_config.get('plugin_config', {}).get(plugin_id, {}))
+        return gen_cfg, spec_cfg
+
+    def _pg_load(self, plugin_id: str) -> None:
+        # Raise an exception if plugin loading or common configuration fail
+        gen_cfg, spec_cfg = self._pg_new_config(plugin_id)
         try:
             self.pg_mgr.load(plugin_id, gen_cfg, spec_cfg)
         except Exception:
@@ -922,9 +1449,25 @@ class ProvisioningApplication:
             raise
         else:
             self._pg_configure_pg(plugin_id)
+            self._plugin_versions[plugin_id] = self._pg_get_version(plugin_id)
+            self._plugin_config_digests[plugin_id] = _plugin_config_digest(
+                gen_cfg, spec_cfg
+            )
+
+    def _pg_get_version(self, plugin_id: str) -> str | None:
+        # Return the version of the loaded plugin, or None if it is not known
+        try:
+            return self.pg_mgr[plugin_id].info['version']
+        except Exception:
+            logger.warning(
+                'Could not get the version of plugin %s', plugin_id, exc_info=True
+            )
+            return None
 
     def _pg_unload(self, plugin_id: str) -> None:
         # This method should never raise an exception
+        self._plugin_versions.pop(plugin_id, None)
+        self._plugin_config_digests.pop(plugin_id, None)
         try:
             self.pg_mgr.unload(plugin_id)
         except PluginNotLoadedError:
@@ -932,19 +1475,41 @@ class ProvisioningApplication:
             # installed successfully but the plugin was not loadable
             logger.info('Plugin %s was not loaded ', plugin_id)
 
+    @defer.inlineCallbacks
+    def _pg_deconfigure_outdated_devices(
+        self, plugin_id: str, devices: list[DeviceDict]
+    ):
+        # Deconfigure, with the loaded plugin, the configured devices whose
+        # configuration will change once the installed plugin is loaded, i.e.
+        # every configured device if the plugin version or configuration
+        # changes, and mark them as not configured. Return a deferred that
+        # will fire with None once done.
+        plugin = self.pg_mgr[plugin_id]
+        installed_version = (
+            self.pg_mgr.list_installed().get(plugin_id, {}).get('version')
+        )
+        plugin_changed = (
+            installed_version is None
+            or installed_version != self._plugin_versions.get(plugin_id)
+            or _plugin_config_digest(*self._pg_new_config(plugin_id))
+            != self._plugin_config_digests.get(plugin_id)
+        )
+        for device in devices:
+            if not device['configured']:
+                continue
+            if not plugin_changed:
+                _, _, digest = yield self._dev_get_configuration(device)
+                if _is_up_to_date(device, digest):
+                    continue
+            yield self._dev_deconfigure(device, plugin)
+            if _set_configured(device, False, None):
+                yield self._dev_collection.update(device)
+
     @defer.inlineCallbacks
     def _pg_configure_all_devices(self, plugin_id: str):
         logger.info('Reconfiguring all devices using plugin %s', plugin_id)
         devices = yield self._dev_collection.find({'plugin': plugin_id})
-        for device in devices:
-            # deconfigure
-            if device['configured']:
-                self._dev_deconfigure_if_possible(device)
-            # configure
-            configured = yield self._dev_configure_if_possible(device)
-            if device['configured'] != configured:
-                device['configured'] = configured
-                yield self._dev_collection.update(device)
+        yield self._dev_reconfigure_many(list(devices))
 
     def pg_install(self, plugin_id: str) -> tuple[Deferred, OperationInProgress]:
         """Install the plugin with the given id.
@@ -972,7 +1537,7 @@ class ProvisioningApplication:
             # reset the state to in progress
             oip.state = OIP_PROGRESS
 
-        @_wlock_arg(self._rw_lock)
+        @_wlock_arg(self._locks.global_lock)
         def callback2(_):
             # The lock apply only to the deferred return by this function
             # and not on the function itself
@@ -1011,7 +1576,7 @@ class ProvisioningApplication:
             # reset the state to in progress
             oip.state = OIP_PROGRESS
 
-        @_wlock_arg(self._rw_lock)
+        @_wlock_arg(self._locks.global_lock)
         def callback2(_: Any):
             # The lock apply only to the deferred return by this function
             # and not on the function itself
@@ -1059,7 +1624,7 @@ class ProvisioningApplication:
             {'plugin': plugin_id, 'configured': True}
         )
         for device in affected_devices:
-            device['configured'] = False
+            _set_configured(device, False, None)
             yield self._dev_collection.update(device)
 
     @_wlock
@@ -1075,6 +1640,10 @@ class ProvisioningApplication:
         The deferred will fire its errback with an exception if the plugin
         is not already installed or if there's an error at loading.
 
+        Only the devices whose configuration has changed, e.g. because the
+        plugin version has changed, are deconfigured with the loaded plugin
+        and then reconfigured with the reloaded one.
+
         """
         logger.info('Reloading plugin %s', plugin_id)
         if not self.pg_mgr.is_installed(plugin_id):
@@ -1084,12 +1653,9 @@ class ProvisioningApplication:
         devices = yield self._dev_collection.find({'plugin': plugin_id})
         devices = list(devices)
 
-        # unload plugin
+        # deconfigure the outdated devices and unload plugin
         if plugin_id in self.pg_mgr:
-            plugin = self.pg_mgr[plugin_id]
-            for device in devices:
-                if device['configured']:
-                    self._dev_deconfigure(device, plugin)
+            yield self._pg_deconfigure_outdated_devices(plugin_id, devices)
             self._pg_unload(plugin_id)
 
         # load plugin
@@ -1099,17 +1665,12 @@ class ProvisioningApplication:
             # mark all the devices as not configured and reraise
             # the exception
             for device in devices:
-                if device['configured']:
-                    device['configured'] = False
+                if _set_configured(device, False, None):
                     yield self._dev_collection.update(device)
             raise
 
-        # reconfigure every device
-        for device in devices:
-            configured = yield self._dev_configure_if_possible(device)
-            if device['configured'] != configured:
-                device['configured'] = configured
-                yield self._dev_collection.update(device)
+        # reconfigure the devices whose configuration has changed
+        yield self._dev_reconfigure_many(devices)
 
     def pg_retrieve(self, plugin_id: str):
         return self.pg_mgr[plugin_id]
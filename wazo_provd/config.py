@@ -29,6 +29,23 @@ The following parameters are defined:
         asterisk_ami_servers
         advertised_http_url
             The HTTP URL advertised to phones
+        plugin_threads
+            The number of threads in which plugins configure and deconfigure
+            devices (0 to do it in the reactor thread). Only plugins that are
+            thread-safe can be configured in threads.
+        plugin_threads_per_plugin
+            The maximum number of devices a plugin configures at the same time.
+        ident_cache_ttl
+            The number of seconds the device identified for a request is
+            reused for the next requests of the same client with the same
+            device info (0 to disable).
+        ident_max_concurrent_requests
+            The maximum number of requests going through the device retrievers
+            and updaters at the same time (0 for no limit).
+        ident_max_queued_requests
+            The maximum number of requests waiting to go through the device
+            retrievers and updaters. Requests received once the queue is full
+            are rejected.
     rest_api:
         ip
         port
@@ -46,6 +63,20 @@ The following parameters are defined:
         generator
         ensure_common_indexes
         json_db_dir
+        json_db_flush_delay
+            The maximum delay, in seconds, before a modified document is
+            written to disk (0 to write every document immediately).
+        json_db_flush_in_thread
+            Write the modified documents in a thread instead of the reactor
+            thread (only if json_db_flush_delay is not 0).
+        log_db_dir
+        log_db_sync_delay
+            The maximum delay, in seconds, before a write is synced to disk
+            (0 to sync after every write).
+        log_db_compact_threshold
+            The number of log records after which the log is compacted.
+        sqlite_db_file
+            The file of the database if type is 'sqlite'.
     plugin_config:
         *
             *
@@ -114,6 +145,11 @@ class GeneralConfig(TypedDict):
     sync_service_type: str
     syncdb: SyncDbConfigDict
     http_auth_strategy: Union[Literal['url_key'], None]
+    plugin_threads: int
+    plugin_threads_per_plugin: int
+    ident_cache_ttl: float
+    ident_max_concurrent_requests: int
+    ident_max_queued_requests: int
 
 
 class RestApiConfigDict(TypedDict):
@@ -137,6 +173,12 @@ class DatabaseConfigDict(TypedDict):
     generator: Literal['default', 'numeric', 'uuid']
     ensure_common_indexes: bool
     json_db_dir: str
+    json_db_flush_delay: float
+    json_db_flush_in_thread: bool
+    log_db_dir: str
+    log_db_sync_delay: float
+    log_db_compact_threshold: int
+    sqlite_db_file: str
 
 
 class AmidConfigDict(TypedDict):
@@ -198,6 +240,11 @@ _DEFAULT_CONFIG: ProvdConfigDict = {
             'start_sec': 60,
         },
         'http_auth_strategy': None,
+        'plugin_threads': 0,
+        'plugin_threads_per_plugin': 1,
+        'ident_cache_ttl': 30.0,
+        'ident_max_concurrent_requests': 100,
+        'ident_max_queued_requests': 1000,
     },
     'rest_api': {
         'ip': '127.0.0.1',
@@ -218,6 +265,12 @@ _DEFAULT_CONFIG: ProvdConfigDict = {
         'generator': 'default',
         'ensure_common_indexes': True,
         'json_db_dir': 'jsondb',
+        'json_db_flush_delay': 0.0,
+        'json_db_flush_in_thread': False,
+        'log_db_dir': 'logdb',
+        'log_db_sync_delay': 1.0,
+        'log_db_compact_threshold': 10000,
+        'sqlite_db_file': 'provd.sqlite',
     },
     'amid': {
         'host': 'localhost',
@@ -327,12 +380,13 @@ def _update_general_base_raw_config(app_raw_config: dict[str, Any]) -> None:
 def _post_update_raw_config(raw_config: dict[str, Any]) -> None:
     # Update raw config after transformation/check
     _update_general_base_raw_config(raw_config)
-    # update json_db_dir to absolute dir
-    if 'json_db_dir' in raw_config['database']:
-        raw_config['database']['json_db_dir'] = os.path.join(
-            raw_config['general']['base_storage_dir'],
-            raw_config['database']['json_db_dir'],
-        )
+    # update json_db_dir, log_db_dir and sqlite_db_file to absolute path
+    for db_dir in ['json_db_dir', 'log_db_dir', 'sqlite_db_file']:
+        if db_dir in raw_config['database']:
+            raw_config['database'][db_dir] = os.path.join(
+                raw_config['general']['base_storage_dir'],
+                raw_config['database'][db_dir],
+            )
 
 
 def _load_key_file(config: dict[str, Any]) -> AuthKeyFileDict:
@@ -28,9 +28,11 @@ Config collection objects are used as a storage for config objects.
 """
 from __future__ import annotations
 
+import itertools
 import logging
+import time
 import uuid
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from collections.abc import Callable, Generator
 from copy import deepcopy
 from functools import wraps
@@ -38,10 +40,11 @@ from typing import TYPE_CHECKING, Any
 
 from twisted.internet import defer
 from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 
 from wazo_provd.devices.schemas import ConfigSchema
 from wazo_provd.persist.common import ID_KEY
-from wazo_provd.persist.util import ForwardingDocumentCollection
+from wazo_provd.persist.util import ForwardingDocumentCollection, copy_document
 from wazo_provd.util import decode_bytes
 
 if TYPE_CHECKING:
@@ -482,6 +485,10 @@ def _rec_update_dict(base_dict, overlay_dict):
             base_dict[k] = v
 
 
+# never modified, only used as the default base raw config
+_EMPTY_RAW_CONFIG: dict[str, Any] = {}
+
+
 def _check_config_validity(config: ConfigDict) -> None:
     if 'parent_ids' not in config:
         raise ValueError('missing "parent_ids" field in config')
@@ -521,7 +528,7 @@ def _needs_child_and_parent_indexes(
                 assert self._has_child_and_parent_indexes()
                 return fun(self, *args, **kwargs)
 
-            deferred = self._build_child_and_parent_indexes()
+            deferred = self.build_child_and_parent_indexes()
             deferred.addCallback(callback)
             return deferred
 
@@ -549,21 +556,70 @@ def _remove_none_values(config):
 
 
 class ConfigCollection(ForwardingDocumentCollection):
+    max_cached_raw_configs = 1000
+
+    def __init__(self, collection) -> None:
+        super().__init__(collection)
+        # flattened raw configs, by config ID, along with the base raw config
+        # they were computed from, the least recently used first
+        self._raw_config_cache: OrderedDict[
+            str, tuple[dict[str, Any], dict[str, Any]]
+        ] = OrderedDict()
+        # incremented on every invalidation, so that a flattened raw config
+        # computed while a config was being modified is not cached
+        self._raw_config_generation = 0
+        # generation at which the flattened raw config of a config last
+        # changed, for the configs modified since the collection was loaded
+        self._raw_config_versions: dict[str, int] = {}
+        # ancestors and descendants of the configs, by config ID, computed
+        # on demand and kept up to date when the parents of a config change
+        self._ancestors_memo: dict[str, set[str]] = {}
+        self._descendants_memo: dict[str, set[str]] = {}
+        # deferreds waiting for the indexes being built, None if they are
+        # not being built
+        self._index_waiters: list[Deferred] | None = None
+
+    def build_child_and_parent_indexes(self) -> Deferred:
+        """Build the child and parent indexes if they are not built yet.
+
+        Return a deferred that will fire with None once the indexes are
+        built. The indexes are built only once, even if this method is
+        called again while they are being built, and are otherwise built
+        on the first call of a method needing them.
+
+        """
+        if self._has_child_and_parent_indexes():
+            return defer.succeed(None)
+        deferred: Deferred = Deferred()
+        if self._index_waiters is not None:
+            self._index_waiters.append(deferred)
+        else:
+            self._index_waiters = [deferred]
+            build_deferred = self._build_child_and_parent_indexes()
+            build_deferred.addBoth(self._on_child_and_parent_indexes_built)
+        return deferred
+
+    def _on_child_and_parent_indexes_built(self, result: Any) -> None:
+        # Fire the waiting deferreds with the result of the build, which is
+        # tried again on the next call if it failed
+        waiters, self._index_waiters = self._index_waiters or [], None
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(None)
+
     @defer.inlineCallbacks
     def _build_child_and_parent_indexes(
         self,
     ) -> Generator[None, list[ConfigDict], None]:
-        # XXX it's possible to have this method executed twice, for example
-        #     if during the time to yield another methods call this method,
-        #     etc, we should use a lock, twisted is such a pain sometimes,
-        #     but then it's only about efficiency (doing the same job twice
-        #     is less efficient than only once...)
         logger.debug('Building child and parent indexes')
-        child_idx = defaultdict(list)
-        parent_idx = {}
+        start_time = time.monotonic()
+        child_idx: defaultdict[str, list[str]] = defaultdict(list)
+        parent_idx: dict[str, list[str]] = {}
         configs = yield self._collection.find({})
         for config in configs:
-            config_id = config[ID_KEY]  # type: ignore
+            config_id: str = config[ID_KEY]  # type: ignore
             parent_ids = config['parent_ids']
             for parent_id in parent_ids:
                 child_idx[parent_id].append(config_id)
@@ -571,6 +627,13 @@ class ConfigCollection(ForwardingDocumentCollection):
             parent_idx[config_id] = list(parent_ids)
         self._child_idx = child_idx
         self._parent_idx = parent_idx
+        self._ancestors_memo = {}
+        self._descendants_memo = {}
+        logger.info(
+            'Built child and parent indexes of %d configs in %.3f seconds',
+            len(parent_idx),
+            time.monotonic() - start_time,
+        )
 
     def _has_child_and_parent_indexes(self):
         return hasattr(self, '_child_idx') and hasattr(self, '_parent_idx')
@@ -582,15 +645,10 @@ class ConfigCollection(ForwardingDocumentCollection):
 
         def callback(config_id: str) -> str:
             config_id = decode_bytes(config_id)
-            parent_ids = config['parent_ids']
-            # update child idx
-            for parent_id in parent_ids:
-                if parent_id in self._child_idx:
-                    self._child_idx[parent_id].append(config_id)
-                else:
-                    self._child_idx[parent_id] = [config_id]
-            # update parent idx
-            self._parent_idx[config_id] = list(parent_ids)
+            self._set_parent_ids(config_id, [], config['parent_ids'])
+            # configs referencing this config as a parent may have been
+            # flattened before it existed
+            self._invalidate_raw_configs(config_id)
             return config_id
 
         deferred = self._collection.insert(config)
@@ -607,19 +665,8 @@ class ConfigCollection(ForwardingDocumentCollection):
             new_parent_ids = config['parent_ids']
             old_parent_ids = self._parent_idx[config_id]
             if new_parent_ids != old_parent_ids:
-                # update idx of children
-                for parent_id in old_parent_ids:
-                    children = self._child_idx[parent_id]
-                    children.remove(config_id)
-                    if not children:
-                        del self._child_idx[parent_id]
-                for parent_id in new_parent_ids:
-                    if parent_id in self._child_idx:
-                        self._child_idx[parent_id].append(config_id)
-                    else:
-                        self._child_idx[parent_id] = [config_id]
-                # update parent idx
-                self._parent_idx[config_id] = list(new_parent_ids)
+                self._set_parent_ids(config_id, old_parent_ids, new_parent_ids)
+            self._invalidate_raw_configs(config_id)
 
         deferred = self._collection.update(config)
         deferred.addCallback(callback)
@@ -630,20 +677,92 @@ class ConfigCollection(ForwardingDocumentCollection):
         config_id = decode_bytes(config_id)
 
         def callback(_: Any) -> None:
-            # update idx of children
-            old_parent_ids = self._parent_idx[config_id]
-            for parent_id in old_parent_ids:
-                children = self._child_idx[parent_id]
-                children.remove(config_id)
-                if not children:
-                    del self._child_idx[parent_id]
-            # update parent idx
-            del self._parent_idx[config_id]
+            self._set_parent_ids(config_id, self._parent_idx[config_id], None)
+            self._invalidate_raw_configs(config_id)
+            del self._raw_config_versions[config_id]
 
         deferred = self._collection.delete(config_id)
         deferred.addCallback(callback)
         return deferred
 
+    def _set_parent_ids(
+        self,
+        config_id: str,
+        old_parent_ids: list[str],
+        new_parent_ids: list[str] | None,
+    ) -> None:
+        # Update the indexes and the memoized ancestors and descendants once
+        # the parents of the config have changed. new_parent_ids is None if
+        # the config has been deleted.
+        descendants = self._descendants(config_id)
+        if old_parent_ids:
+            # the configs that were ancestors may no longer be, recompute
+            # their descendants on demand
+            for ancestor_id in self._ancestors(config_id):
+                self._descendants_memo.pop(ancestor_id, None)
+        for cur_id in itertools.chain([config_id], descendants):
+            self._ancestors_memo.pop(cur_id, None)
+
+        # update idx of children
+        for parent_id in old_parent_ids:
+            children = self._child_idx[parent_id]
+            children.remove(config_id)
+            if not children:
+                del self._child_idx[parent_id]
+        if new_parent_ids is None:
+            # update parent idx
+            del self._parent_idx[config_id]
+            return
+        for parent_id in new_parent_ids:
+            if parent_id in self._child_idx:
+                self._child_idx[parent_id].append(config_id)
+            else:
+                self._child_idx[parent_id] = [config_id]
+        # update parent idx
+        self._parent_idx[config_id] = list(new_parent_ids)
+
+        # the ancestors of the config are its parents and their ancestors,
+        # and they gain the config and its descendants as descendants
+        ancestors = set(new_parent_ids)
+        for parent_id in new_parent_ids:
+            ancestors.update(self._ancestors(parent_id))
+        self._ancestors_memo[config_id] = ancestors
+        for ancestor_id in ancestors:
+            if (
+                ancestor_descendants := self._descendants_memo.get(ancestor_id)
+            ) is not None:
+                ancestor_descendants.add(config_id)
+                ancestor_descendants.update(descendants)
+
+    @staticmethod
+    def _walk(config_id: str, idx: dict[str, list[str]]) -> set[str]:
+        # Return the set of config IDs reachable from the config by following
+        # the index, without the config itself unless it is part of a cycle
+        visited = set()
+        stack = [config_id]
+        while stack:
+            for next_id in idx.get(stack.pop(), ()):
+                if next_id not in visited:
+                    visited.add(next_id)
+                    stack.append(next_id)
+        return visited
+
+    def _ancestors(self, config_id: str) -> set[str]:
+        # The returned set is shared and MUST NOT be modified
+        ancestors = self._ancestors_memo.get(config_id)
+        if ancestors is None:
+            ancestors = self._walk(config_id, self._parent_idx)
+            self._ancestors_memo[config_id] = ancestors
+        return ancestors
+
+    def _descendants(self, config_id: str) -> set[str]:
+        # The returned set is shared and MUST NOT be modified
+        descendants = self._descendants_memo.get(config_id)
+        if descendants is None:
+            descendants = self._walk(config_id, self._child_idx)
+            self._descendants_memo[config_id] = descendants
+        return descendants
+
     @_needs_child_and_parent_indexes
     def get_ancestors(self, config_id: str) -> set[str]:
         """Return a deferred that will fire with the set of ancestors of the
@@ -652,17 +771,7 @@ class ConfigCollection(ForwardingDocumentCollection):
         if id is unknown.
 
         """
-        visited = set()
-
-        def aux(cur_id: str) -> None:
-            if cur_id in self._parent_idx:
-                for parent_id in self._parent_idx[cur_id]:
-                    if parent_id not in visited:
-                        visited.add(parent_id)
-                        aux(parent_id)
-
-        aux(decode_bytes(config_id))
-        return visited
+        return set(self._ancestors(decode_bytes(config_id)))
 
     @_needs_child_and_parent_indexes
     def get_descendants(self, config_id: str):
@@ -672,17 +781,43 @@ class ConfigCollection(ForwardingDocumentCollection):
         is unknown.
 
         """
-        visited = set()
+        return set(self._descendants(decode_bytes(config_id)))
 
-        def aux(cur_id: str) -> None:
-            if cur_id in self._child_idx:
-                for child_id in self._child_idx[cur_id]:
-                    if child_id and child_id not in visited:
-                        visited.add(child_id)
-                        aux(child_id)
+    def _invalidate_raw_configs(self, config_id: str) -> None:
+        # Remove the flattened raw config of the config and of its descendants
+        # from the cache and update their version
+        self._raw_config_generation += 1
+        for cur_id in itertools.chain([config_id], self._descendants(config_id)):
+            self._raw_config_cache.pop(cur_id, None)
+            self._raw_config_versions[cur_id] = self._raw_config_generation
 
-        aux(decode_bytes(config_id))
-        return visited
+    def _cache_raw_config(
+        self,
+        config_id: str,
+        base_raw_config: dict[str, Any],
+        flattened_raw_config: dict[str, Any],
+    ) -> None:
+        self._raw_config_cache[config_id] = (base_raw_config, flattened_raw_config)
+        self._raw_config_cache.move_to_end(config_id)
+        if len(self._raw_config_cache) > self.max_cached_raw_configs:
+            self._raw_config_cache.popitem(last=False)
+
+    def get_raw_config_version(self, config_id: str) -> int | None:
+        """Return the version of the raw config of the config with the given
+        ID, or None if the config is not known or if the version is not
+        available yet.
+
+        The version changes every time the config or one of its ancestors
+        is modified, so that a value computed from the raw config can be
+        cached along with the version it was computed from.
+
+        """
+        if not self._has_child_and_parent_indexes():
+            return None
+        config_id = decode_bytes(config_id)
+        if config_id not in self._parent_idx:
+            return None
+        return self._raw_config_versions.get(config_id, 0)
 
     def get_raw_config(
         self, config_id: str, base_raw_config: dict[str, Any] | None = None
@@ -691,14 +826,25 @@ class ConfigCollection(ForwardingDocumentCollection):
         parameter from its ancestors' config, or fire with None if id is not
         a known ID.
 
+        Flattened raw configs are cached until the config or one of its
+        ancestors is modified. The base raw config is part of the cached
+        value, and as such MUST NOT be modified once passed to this method.
+
         """
+        config_id = decode_bytes(config_id)
+        if base_raw_config is None:
+            base_raw_config = _EMPTY_RAW_CONFIG
+        cached = self._raw_config_cache.get(config_id)
+        if cached is not None and cached[0] is base_raw_config:
+            self._raw_config_cache.move_to_end(config_id)
+            return defer.succeed(copy_document(cached[1]))
+
         # flattened_raw_config is set to a copy of base_raw_config only once
         # we know that the id is valid. This is a bit ugly, but it's the
         # simplest thing to do.
         flattened_raw_config: dict[str, Any] | None = None
         visited = {config_id}
-        if base_raw_config is None:
-            base_raw_config = {}
+        generation = self._raw_config_generation
 
         @defer.inlineCallbacks
         def aux(cur_id: str) -> Generator[None, None, None]:
@@ -713,8 +859,17 @@ class ConfigCollection(ForwardingDocumentCollection):
                         yield aux(parent_id)
                 _rec_update_dict(flattened_raw_config, config['raw_config'])
 
-        d = aux(decode_bytes(config_id))
-        d.addCallback(lambda _: flattened_raw_config)
+        def callback(_: Any) -> dict[str, Any] | None:
+            if flattened_raw_config is None:
+                return None
+            if generation == self._raw_config_generation:
+                self._cache_raw_config(
+                    config_id, base_raw_config, copy_document(flattened_raw_config)
+                )
+            return flattened_raw_config
+
+        d = aux(config_id)
+        d.addCallback(callback)
         return d
 
 
@@ -27,6 +27,9 @@ Device objects have also the following standardized keys:
   config -- the ID of the configuration of this device (unicode)
   configured -- a boolean indicating if the device has been successfully
     configured by a plugin. (boolean) (mandatory)
+  configured_digest -- a digest of everything the configuration of the
+    device depends on, set by the application when the device has been
+    configured. (unicode)
   added -- how the device has been added to the collection (unicode). Right
     now, only 'auto' has been defined.
   options -- dictionary of device options
@@ -35,15 +38,21 @@ Non-standard keys MUST begin with 'X_'.
 
 Finally, device collection objects are used as a storage for device objects.
 
+Objects which want to be notified when a device is updated or deleted
+provide the AbstractDeviceObserver interface.
+
 """
 from __future__ import annotations
 
+import hashlib
+import json
 import logging
+from abc import ABCMeta, abstractmethod
 from collections.abc import Mapping
 from copy import deepcopy
 from typing import Any, TypeVar
 
-from wazo_provd.devices.schemas import DeviceDict, DeviceSchema
+from wazo_provd.devices.schemas import BaseDeviceDict, DeviceDict, DeviceSchema
 from wazo_provd.persist.util import ForwardingDocumentCollection
 from wazo_provd.util import is_normed_ip, is_normed_mac
 
@@ -75,8 +84,20 @@ def needs_reconfiguration(old_device: DeviceDict, new_device: DeviceDict) -> boo
     return False
 
 
-# do
-def _check_device_validity(device: DeviceDict) -> None:
+def configuration_digest(device: BaseDeviceDict, *values: Any) -> str:
+    """Return a digest of the values of the device that need a
+    reconfiguration when modified and of the given values, which must be
+    serializable to JSON.
+
+    """
+    digest_values = [device.get(key) for key in _RECONF_KEYS]
+    digest_values.extend(values)
+    data = json.dumps(digest_values, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def check_device_validity(device: DeviceDict) -> None:
+    """Raise a ValueError if the device is not valid."""
     if device_mac := device.get('mac'):
         if not is_normed_mac(device_mac):
             raise ValueError(f'Non-normalized MAC address {device_mac}')
@@ -90,9 +111,51 @@ def _check_device_validity(device: DeviceDict) -> None:
 
 class DeviceCollection(ForwardingDocumentCollection):
     def insert(self, device: DeviceDict):
-        _check_device_validity(device)
+        check_device_validity(device)
         return self._collection.insert(device)
 
     def update(self, device: DeviceDict):
-        _check_device_validity(device)
+        check_device_validity(device)
         return self._collection.update(device)
+
+    def insert_many(self, devices: list[DeviceDict]):
+        for device in devices:
+            check_device_validity(device)
+        return self._collection.insert_many(devices)
+
+    def update_many(self, devices: list[DeviceDict]):
+        for device in devices:
+            check_device_validity(device)
+        return self._collection.update_many(devices)
+
+
+class AbstractDeviceObserver(metaclass=ABCMeta):
+    """Interface that objects which want to be notified of device
+    updates/deletions MUST provide.
+
+    """
+
+    @abstractmethod
+    def dev_update(self, device_id: str) -> None:
+        pass
+
+    @abstractmethod
+    def dev_delete(self, device_id: str) -> None:
+        pass
+
+
+class BaseDeviceObserver(AbstractDeviceObserver):
+    # Warning: don't forget to store at least 1 reference to this object
+    # after attaching it to the application since observers are weakly
+    # referenced by the application
+    def __init__(self, dev_update=None, dev_delete=None):
+        self._dev_update = dev_update
+        self._dev_delete = dev_delete
+
+    def dev_update(self, device_id: str) -> None:
+        if self._dev_update is not None:
+            self._dev_update(device_id)
+
+    def dev_delete(self, device_id: str) -> None:
+        if self._dev_delete is not None:
+            self._dev_delete(device_id)
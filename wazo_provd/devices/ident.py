@@ -5,9 +5,11 @@
 from __future__ import annotations
 
 import logging
+import re
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque
 from collections.abc import Callable
+from copy import deepcopy
 from enum import Enum
 from operator import itemgetter
 from os.path import basename
@@ -15,10 +17,13 @@ from typing import TYPE_CHECKING, Any, Protocol, TypedDict, Union, cast
 
 from twisted.internet import defer
 from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IReactorTime
+from twisted.python.failure import Failure
 from twisted.web import rewrite
-from twisted.web.http import INTERNAL_SERVER_ERROR
+from twisted.web.http import INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE
 from twisted.web.resource import ErrorPage, NoResource, Resource
 
+from wazo_provd.devices.device import BaseDeviceObserver
 from wazo_provd.devices.device import copy as copy_device
 from wazo_provd.plugins import BasePluginManagerObserver, PluginManager
 from wazo_provd.security import log_security_msg
@@ -275,10 +280,104 @@ class CollaboratingDeviceInfoExtractor(AbstractDeviceInfoExtractor):
         defer.returnValue(updater.dev_info)
 
 
+class _PrefixIndex:
+    # Index of values by string prefix, where looking up a string costs one
+    # dictionary lookup per distinct prefix length
+
+    def __init__(self) -> None:
+        self._values_by_prefix: defaultdict[str, set[int]] = defaultdict(set)
+        self._lengths: set[int] = set()
+
+    def add(self, prefix: str, value: int) -> None:
+        self._values_by_prefix[prefix].add(value)
+        self._lengths.add(len(prefix))
+
+    def lookup(self, string: str) -> set[int]:
+        values: set[int] = set()
+        for length in self._lengths:
+            values.update(self._values_by_prefix.get(string[:length], ()))
+        return values
+
+
+class _ExtractorDispatchIndex:
+    # Index of the plugin extractors of a request type by dispatch hints,
+    # used to find which extractors may extract information from a request
+
+    def __init__(self, request_type: RequestType) -> None:
+        self.request_type = request_type
+        self.extractors: list[ExtractorProtocol] = []
+        self._broadcast: set[int] = set()
+        self._user_agent_index = _PrefixIndex()
+        self._vendor_class_index = _PrefixIndex()
+        self._filename_regexes: list[tuple[re.Pattern, int]] = []
+
+    def add(self, extractor: ExtractorProtocol, hints: dict[str, Any] | None) -> None:
+        position = len(self.extractors)
+        self.extractors.append(extractor)
+        try:
+            if not hints:
+                raise ValueError('no hints')
+            user_agent_prefixes = list(hints.get('user_agent_prefixes', ()))
+            vendor_class_prefixes = list(hints.get('vendor_class_prefixes', ()))
+            filename_regex = None
+            if filename_patterns := list(hints.get('filename_patterns', ())):
+                filename_regex = re.compile(
+                    '|'.join(f'(?:{pattern})' for pattern in filename_patterns)
+                )
+        except (AttributeError, TypeError, ValueError, re.error) as e:
+            if hints:
+                logger.warning('Ignoring invalid dispatch hints %r: %s', hints, e)
+            self._broadcast.add(position)
+            return
+
+        for prefix in user_agent_prefixes:
+            self._user_agent_index.add(prefix, position)
+        for prefix in vendor_class_prefixes:
+            self._vendor_class_index.add(prefix, position)
+        if filename_regex is not None:
+            self._filename_regexes.append((filename_regex, position))
+
+    def get_candidates(self, request) -> tuple[int, ...] | None:
+        """Return the sorted positions of the extractors to give the request
+        to, or None if it must be given to every extractor.
+
+        """
+        if len(self._broadcast) == len(self.extractors):
+            return None
+
+        positions: set[int] = set()
+        if self.request_type == RequestType.HTTP:
+            if user_agent := request.getHeader('User-Agent'):
+                positions.update(self._user_agent_index.lookup(user_agent))
+        elif self.request_type == RequestType.DHCP:
+            if vendor_class := request['options'].get(60):
+                positions.update(self._vendor_class_index.lookup(vendor_class))
+        if self._filename_regexes:
+            if filename := _get_filename_from_request(request, self.request_type):
+                for regex, position in self._filename_regexes:
+                    if regex.match(filename):
+                        positions.add(position)
+
+        if not positions:
+            return None
+        positions.update(self._broadcast)
+        return tuple(sorted(positions))
+
+
+def _get_dispatch_hints(pg, request_type: RequestType) -> dict[str, Any] | None:
+    hints = getattr(pg, 'dev_info_dispatch_hints', None)
+    if not isinstance(hints, dict):
+        return None
+    return hints.get(request_type.value)
+
+
 class AllPluginsDeviceInfoExtractor(AbstractDeviceInfoExtractor):
     """Composite device info extractor that forward extraction requests to
     device info extractors of every loaded plugins.
 
+    Plugins with dispatch hints only have their extractors called for the
+    requests matching their hints. See Plugin.dev_info_dispatch_hints.
+
     """
 
     def __init__(
@@ -307,21 +406,43 @@ class AllPluginsDeviceInfoExtractor(AbstractDeviceInfoExtractor):
 
     def _set_xtors(self) -> None:
         logger.debug('Updating extractors for %s', self)
+        self._dispatch_indexes: dict[RequestType, _ExtractorDispatchIndex] = {}
+        # extractors created for a subset of the plugin extractors, by
+        # request type and positions of the extractors
+        self._candidate_xtors: dict[
+            tuple[RequestType, tuple[int, ...]], AbstractDeviceInfoExtractor
+        ] = {}
         for request_type in RequestType:
-            pg_extractors = []
+            dispatch_index = _ExtractorDispatchIndex(request_type)
             for pg in self._pg_mgr.values():
                 pg_extractor = getattr(pg, f'{request_type.value}_dev_info_extractor')
                 if pg_extractor is not None:
                     logger.debug('Adding %s extractor from %s', request_type.value, pg)
-                    pg_extractors.append(pg_extractor)
-            xtor = self.extractor_factory(pg_extractors)
+                    dispatch_index.add(
+                        pg_extractor, _get_dispatch_hints(pg, request_type)
+                    )
+            self._dispatch_indexes[request_type] = dispatch_index
+            xtor = self.extractor_factory(dispatch_index.extractors)
             setattr(self, self._xtor_name(request_type), xtor)
 
     def _on_plugin_load_or_unload(self, pg_id: str) -> None:
         self._set_xtors()
 
+    def _get_xtor(self, request, request_type: RequestType):
+        dispatch_index = self._dispatch_indexes[request_type]
+        positions = dispatch_index.get_candidates(request)
+        if positions is None:
+            return getattr(self, self._xtor_name(request_type))
+
+        key = (request_type, positions)
+        if key not in self._candidate_xtors:
+            self._candidate_xtors[key] = self.extractor_factory(
+                [dispatch_index.extractors[position] for position in positions]
+            )
+        return self._candidate_xtors[key]
+
     def extract(self, request, request_type: RequestType) -> Deferred:
-        xtor = getattr(self, self._xtor_name(request_type))
+        xtor = self._get_xtor(request, request_type)
         return xtor.extract(request, request_type)
 
 
@@ -471,6 +592,82 @@ class FirstCompositeDeviceRetriever(AbstractDeviceRetriever):
         defer.returnValue(None)
 
 
+_MISSING = object()
+
+
+class _ChangeTrackingDevice(dict):
+    # Device given to the device updaters, recording the original value of
+    # every key that is read, set or removed, so that the changed keys can be
+    # found without copying and comparing the whole device. The dict and list
+    # values are copied the first time they are read with [] or get, so that
+    # their in place modifications are found too.
+
+    def __init__(self, device) -> None:
+        super().__init__(device)
+        self._original_values: dict[str, Any] = {}
+
+    def _record(self, key) -> None:
+        if key not in self._original_values:
+            value = dict.get(self, key, _MISSING)
+            if isinstance(value, (dict, list)):
+                value = deepcopy(value)
+            self._original_values[key] = value
+
+    def __getitem__(self, key):
+        self._record(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            self._record(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value) -> None:
+        self._record(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key) -> None:
+        self._record(key)
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        self._record(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._original_values.setdefault(key, value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        self._record(key)
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __or__(self, other: Any) -> dict:
+        return dict(self) | other
+
+    def __ior__(self, other: Any) -> _ChangeTrackingDevice:
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        for key in list(self):
+            self._record(key)
+        super().clear()
+
+    def changed_keys(self) -> set[str]:
+        """Return the keys which value differs from their original value."""
+        return {
+            key
+            for key, original_value in self._original_values.items()
+            if dict.get(self, key, _MISSING) != original_value
+        }
+
+
 class AbstractDeviceUpdater(metaclass=ABCMeta):
     """Update a device object device from an info object.
 
@@ -580,10 +777,169 @@ class CompositeDeviceUpdater(AbstractDeviceUpdater):
             yield updater.update(device, dev_info, request, request_type)
 
 
+class IdentificationCache:
+    """A short-lived cache of the device identified for a request.
+
+    Entries are keyed on the client IP, the request type and the device info
+    extracted from the request, so that the many files a device fetches while
+    booting are all routed after a single device retrieval and update.
+
+    Entries expire after ttl seconds, and are invalidated when their device is
+    updated or deleted, or when a plugin is loaded or unloaded.
+
+    """
+
+    MAX_ENTRIES = 10000
+
+    def __init__(
+        self,
+        app: ProvisioningApplication,
+        pg_mgr: PluginManager,
+        ttl: float,
+        clock: IReactorTime | None = None,
+    ) -> None:
+        if clock is None:
+            from twisted.internet import reactor
+
+            clock = cast(IReactorTime, reactor)
+        self._ttl = ttl
+        self._clock: IReactorTime = clock
+        # expiration time and device ID, by key
+        self._entries: dict[tuple, tuple[float, str]] = {}
+        self._keys_by_device_id: defaultdict[str, set[tuple]] = defaultdict(set)
+        # keep a reference to the weakly referenced observers
+        self._dev_obs = BaseDeviceObserver(
+            self.invalidate_device, self.invalidate_device
+        )
+        app.dev_attach(self._dev_obs)
+        self._pg_obs = BasePluginManagerObserver(self._clear, self._clear)
+        pg_mgr.attach(self._pg_obs)
+
+    @staticmethod
+    def new_key(ip: str | None, request_type: RequestType, dev_info) -> tuple | None:
+        """Return the cache key of a request, or None if it can't be cached."""
+        if not ip or not dev_info:
+            return None
+        try:
+            key = (ip, request_type, frozenset(dev_info.items()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key: tuple) -> str | None:
+        """Return the ID of the device identified for key, or None."""
+        try:
+            expiration, device_id = self._entries[key]
+        except KeyError:
+            return None
+        if expiration <= self._clock.seconds():
+            self._remove(key)
+            return None
+        return device_id
+
+    def put(self, key: tuple, device_id: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+        elif len(self._entries) >= self.MAX_ENTRIES:
+            self._remove_expired()
+            if len(self._entries) >= self.MAX_ENTRIES:
+                return
+        self._entries[key] = (self._clock.seconds() + self._ttl, device_id)
+        self._keys_by_device_id[device_id].add(key)
+
+    def invalidate_device(self, device_id: str) -> None:
+        for key in self._keys_by_device_id.pop(device_id, ()):
+            del self._entries[key]
+
+    def _remove(self, key: tuple) -> None:
+        _, device_id = self._entries.pop(key)
+        keys = self._keys_by_device_id[device_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_device_id[device_id]
+
+    def _remove_expired(self) -> None:
+        now = self._clock.seconds()
+        expired_keys = [
+            key for key, (expiration, _) in self._entries.items() if expiration <= now
+        ]
+        for key in expired_keys:
+            self._remove(key)
+
+    def _clear(self, pg_id: str | None = None) -> None:
+        logger.debug('Clearing identification cache')
+        self._entries.clear()
+        self._keys_by_device_id.clear()
+
+
+class RequestRejectedError(Exception):
+    """Raised when a request is rejected because too many requests are
+    already being processed.
+
+    """
+
+
+class AdmissionController:
+    """Limit the number of requests going through the device retrievers and
+    updaters at the same time.
+
+    Requests that can't be processed immediately wait in a bounded queue,
+    the requests from known devices before the others. Once the queue is
+    full, new requests are rejected with a RequestRejectedError, unless they
+    are from a known device and a queued request from an unknown device can
+    be rejected in their place.
+
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int) -> None:
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._running = 0
+        self._known_queue: deque[Deferred] = deque()
+        self._unknown_queue: deque[Deferred] = deque()
+
+    def has_free_slot(self) -> bool:
+        return self._running < self._max_concurrent
+
+    def acquire(self, known: bool) -> Deferred:
+        """Return a deferred that will fire once the request can be
+        processed, or fire its errback with a RequestRejectedError.
+
+        Every successful acquisition MUST be followed by a call to release.
+
+        """
+        if self._running < self._max_concurrent:
+            self._running += 1
+            return defer.succeed(None)
+
+        if len(self._known_queue) + len(self._unknown_queue) >= self._max_queued:
+            if not known or not self._unknown_queue:
+                return defer.fail(RequestRejectedError())
+            self._unknown_queue.pop().errback(RequestRejectedError())
+        d: Deferred = Deferred()
+        if known:
+            self._known_queue.append(d)
+        else:
+            self._unknown_queue.append(d)
+        return d
+
+    def release(self) -> None:
+        for queue in (self._known_queue, self._unknown_queue):
+            if queue:
+                # the slot is handed over to the queued request
+                queue.popleft().callback(None)
+                return
+        self._running -= 1
+
+
 class RequestProcessingService:
     """The base object responsible for dynamically modifying the process state
     when processing a request from a device.
 
+    Concurrent requests with the same client IP, request type and device info
+    share a single device retrieval and update.
+
     """
 
     def __init__(
@@ -592,11 +948,18 @@ class RequestProcessingService:
         dev_info_extractor,
         dev_retriever,
         dev_updater,
+        ident_cache: IdentificationCache | None = None,
+        admission_controller: AdmissionController | None = None,
     ) -> None:
         self._app = app
         self._dev_info_extractor = dev_info_extractor
         self._dev_retriever = dev_retriever
         self._dev_updater = dev_updater
+        self._ident_cache = ident_cache
+        self._admission_controller = admission_controller
+        # deferreds of the requests waiting for a concurrent request with the
+        # same identification key, by key
+        self._pending: dict[tuple, list[Deferred]] = {}
         self._req_id = 0  # used for logging
 
     def _new_request_id(self):
@@ -614,17 +977,65 @@ class RequestProcessingService:
         - pg_id is a plugin identifier or None, identifying which plugin should
           continue to process this request.
 
+        The deferred will fire its errback with a RequestRejectedError if the
+        request has been rejected by the admission controller.
+
         """
         helper = _RequestHelper(
             self._app, request, request_type, self._new_request_id()
         )
 
         dev_info = yield helper.extract_device_info(self._dev_info_extractor)
-        device = yield helper.retrieve_device(self._dev_retriever, dev_info)
-        yield helper.update_device(self._dev_updater, device, dev_info)
-        pg_id = helper.get_plugin_id(device)
+        key = helper.get_identification_key(dev_info)
+        if key is not None and self._ident_cache is not None:
+            device = yield helper.get_cached_device(self._ident_cache, key)
+            if device is not None:
+                defer.returnValue((device, helper.get_plugin_id(device)))
+
+        if key in self._pending:
+            device = yield helper.wait_for_concurrent_request(self._pending[key])
+            if not helper.can_share_device(device):
+                device = yield self._identify(helper, dev_info, None)
+        else:
+            device = yield self._identify(helper, dev_info, key)
 
-        defer.returnValue((device, pg_id))
+        defer.returnValue((device, helper.get_plugin_id(device)))
+
+    @defer.inlineCallbacks
+    def _identify(self, helper, dev_info, key):
+        # Retrieve and update the device once the request is admitted, and
+        # share the result with the requests with the same key received in
+        # the meantime
+        if key is not None:
+            self._pending[key] = []
+        try:
+            yield self._admit(helper, dev_info)
+            try:
+                device = yield helper.retrieve_device(self._dev_retriever, dev_info)
+                yield helper.update_device(self._dev_updater, device, dev_info)
+            finally:
+                if self._admission_controller is not None:
+                    self._admission_controller.release()
+        except Exception:
+            failure = Failure()
+            for waiter in self._pending.pop(key, ()):
+                waiter.errback(failure)
+            raise
+
+        if key is not None and device is not None and self._ident_cache is not None:
+            self._ident_cache.put(key, device['id'])
+        for waiter in self._pending.pop(key, ()):
+            waiter.callback(None if device is None else copy_device(device))
+        defer.returnValue(device)
+
+    @defer.inlineCallbacks
+    def _admit(self, helper, dev_info):
+        if self._admission_controller is None:
+            return
+        known = True
+        if not self._admission_controller.has_free_slot():
+            known = yield helper.is_known_device(dev_info)
+        yield self._admission_controller.acquire(known)
 
 
 class _RequestHelper:
@@ -647,6 +1058,48 @@ class _RequestHelper:
 
         defer.returnValue(dev_info)
 
+    def get_identification_key(self, dev_info):
+        ip = _get_ip_from_request(self._request, self._request_type)
+        return IdentificationCache.new_key(ip, self._request_type, dev_info)
+
+    def can_share_device(self, device):
+        # Return true if the device identified for another request can be
+        # used for this request, i.e. if this request doesn't need to go
+        # through the device updaters
+        return device is None or not self._should_update_remote_state(device)
+
+    @defer.inlineCallbacks
+    def get_cached_device(self, ident_cache, key):
+        # Return the device identified for a previous request with the same
+        # key, unless the request must go through the device updaters
+        device_id = ident_cache.get(key)
+        if device_id is None:
+            defer.returnValue(None)
+
+        device = yield self._app.dev_retrieve(device_id)
+        if device is None or not self.can_share_device(device):
+            defer.returnValue(None)
+
+        logger.info('<%s> Retrieved cached device id: %s', self._request_id, device_id)
+        defer.returnValue(device)
+
+    def wait_for_concurrent_request(self, waiters):
+        logger.info(
+            '<%s> Waiting for a concurrent request of the same device',
+            self._request_id,
+        )
+        d: Deferred = Deferred()
+        waiters.append(d)
+        return d
+
+    @defer.inlineCallbacks
+    def is_known_device(self, dev_info):
+        for key in ('mac', 'ip'):
+            if key in dev_info:
+                device = yield self._app.dev_find_one({key: dev_info[key]})
+                defer.returnValue(device is not None)
+        defer.returnValue(False)
+
     @defer.inlineCallbacks
     def retrieve_device(self, dev_retriever, dev_info):
         device = yield dev_retriever.retrieve(dev_info)
@@ -662,13 +1115,25 @@ class _RequestHelper:
         if device is None:
             defer.returnValue(None)
 
-        orig_device = copy_device(device)
-        yield dev_updater.update(device, dev_info, self._request, self._request_type)
-        if device == orig_device:
+        tracking_device = _ChangeTrackingDevice(device)
+        yield dev_updater.update(
+            tracking_device, dev_info, self._request, self._request_type
+        )
+        changed_keys = tracking_device.changed_keys()
+        if not changed_keys:
             yield self._update_device_on_no_change(device)
         else:
-            logger.info('<%s> Device has been updated', self._request_id)
-            yield self._update_device_on_change(device)
+            logger.info(
+                '<%s> Device has been updated: %s',
+                self._request_id,
+                ', '.join(sorted(changed_keys)),
+            )
+            for key in changed_keys:
+                if key in tracking_device:
+                    device[key] = tracking_device[key]
+                else:
+                    del device[key]
+            yield self._update_device_on_change(device, changed_keys)
 
     @defer.inlineCallbacks
     def _update_device_on_no_change(self, device):
@@ -683,23 +1148,28 @@ class _RequestHelper:
             defer.returnValue(None)
 
         if self._update_remote_state_sip_username(device, config):
-            yield self._app.dev_update(device)
+            yield self._app.dev_update(
+                device, changed_keys={'remote_state_sip_username'}
+            )
 
-    def _update_device_on_change(self, device):
+    def _update_device_on_change(self, device, changed_keys):
         if self._should_update_remote_state(device):
             pre_update_hook = self._pre_update_hook
         else:
             pre_update_hook = None
 
-        return self._app.dev_update(device, pre_update_hook=pre_update_hook)
+        return self._app.dev_update(
+            device, pre_update_hook=pre_update_hook, changed_keys=changed_keys
+        )
 
     def _should_update_remote_state(self, device):
-        filename = _get_filename_from_request(self._request, self._request_type)
-        if not filename:
+        # cheapest checks first, since this is done for most requests
+        plugin_id = device.get('plugin')
+        if not plugin_id or not device.get('config'):
             return False
 
-        plugin_id = device.get('plugin')
-        if not plugin_id:
+        filename = _get_filename_from_request(self._request, self._request_type)
+        if not filename:
             return False
 
         plugin = self._app.pg_mgr.get(plugin_id)
@@ -714,14 +1184,7 @@ class _RequestHelper:
         if not trigger_filename:
             return False
 
-        if trigger_filename != filename:
-            return False
-
-        config_id = device.get('config')
-        if not config_id:
-            return False
-
-        return True
+        return trigger_filename == filename
 
     def _pre_update_hook(self, device, config):
         if not config:
@@ -808,6 +1271,8 @@ class HTTPRequestProcessingService(Resource):
     """
 
     default_service = NoResource('Nowhere to route this request.')
+    # number of seconds after which rejected requests should be retried
+    retry_after = 5
 
     def __init__(self, process_service, pg_mgr, num_http_proxies) -> None:
         super().__init__()
@@ -831,6 +1296,16 @@ class HTTPRequestProcessingService(Resource):
             device, pg_id = yield self._process_service.process(
                 request, RequestType.HTTP
             )
+        except RequestRejectedError:
+            logger.warning('Rejecting HTTP request: too many requests in progress')
+            request.setHeader(b'Retry-After', str(self.retry_after).encode('ascii'))
+            defer.returnValue(
+                ErrorPage(
+                    SERVICE_UNAVAILABLE,
+                    'Service unavailable',
+                    'Too many requests in progress',
+                )
+            )
         except Exception:
             logger.error('Error while processing HTTP request:', exc_info=True)
             defer.returnValue(
@@ -955,6 +1430,11 @@ class TFTPRequestProcessingService:
             service.handle_read_request(request, response)
 
         def errback(failure):
+            if failure.check(RequestRejectedError):
+                # the device will send the request again once it times out
+                logger.warning('Ignoring TFTP request: too many requests in progress')
+                response.ignore()
+                return
             logger.error('Error while processing TFTP request: %s', failure)
             response.reject(ERR_UNDEF, 'Internal processing error')
 
@@ -996,6 +1476,9 @@ class DHCPRequestProcessingService(Resource):
         logger.debug('DHCP request: %s', request)
 
         def errback(failure):
+            if failure.check(RequestRejectedError):
+                logger.warning('Ignoring DHCP request: too many requests in progress')
+                return
             logger.error('Error while processing DHCP request: %s', failure)
 
         d = self._process_service.process(request, RequestType.DHCP)
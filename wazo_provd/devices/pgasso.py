@@ -9,10 +9,12 @@ from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 from enum import IntEnum
 from operator import itemgetter
+from typing import Any
 
 from twisted.internet import defer
 
 from wazo_provd.devices.ident import AbstractDeviceUpdater
+from wazo_provd.plugins import BasePluginManagerObserver
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +67,15 @@ class BasePgAssociator(AbstractPluginAssociator):
         raise NotImplementedError('must be overridden in derived class')
 
 
+def _depends_only_on_vendor_model_version(
+    associator: AbstractPluginAssociator,
+) -> bool:
+    return (
+        isinstance(associator, BasePgAssociator)
+        and type(associator).associate is BasePgAssociator.associate
+    )
+
+
 class AbstractConflictSolver(metaclass=ABCMeta):
     @abstractmethod
     def solve(self, pg_ids: list[str]) -> str | None:
@@ -81,12 +92,49 @@ class ReverseAlphabeticConflictSolver(AbstractConflictSolver):
 
 
 class PluginAssociatorDeviceUpdater(AbstractDeviceUpdater):
+    """Device updater that associates a plugin to the device if the device
+    has no plugin.
+
+    The scores of the associators deriving from BasePgAssociator only depend
+    on the vendor, model and version of the device, and are cached until a
+    plugin is loaded or unloaded. The cache statistics can be added to the
+    status of the application by registering provide_status as a provider.
+
+    """
+
     force_update = False
     min_level = DeviceSupport.PROBABLE
+    max_cached_scores = 10000
 
     def __init__(self, pg_mgr, conflict_solver):
         self._pg_mgr = pg_mgr
         self._solver = conflict_solver
+        # scores by (plugin ID, vendor, model, version)
+        self._scores: dict[tuple[str, Any, Any, Any], DeviceSupport | int] = {}
+        self._hits = 0
+        self._misses = 0
+        # observe plugin loading/unloading and keep a reference to the weakly
+        # referenced observer
+        self._obs = BasePluginManagerObserver(
+            self._on_plugin_load_or_unload, self._on_plugin_load_or_unload
+        )
+        pg_mgr.attach(self._obs)
+
+    def _on_plugin_load_or_unload(self, pg_id: str) -> None:
+        self._scores.clear()
+
+    def get_stats(self) -> dict[str, Any]:
+        """Return the statistics of the association score cache."""
+        lookups = self._hits + self._misses
+        return {
+            'size': len(self._scores),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': self._hits / lookups if lookups else 0.0,
+        }
+
+    def provide_status(self, status: dict[str, Any]) -> None:
+        status['plugin_association_cache'] = self.get_stats()
 
     def update(self, dev, dev_info, request, request_type):
         if self.force_update or 'plugin' not in dev:
@@ -113,7 +161,7 @@ class PluginAssociatorDeviceUpdater(AbstractDeviceUpdater):
         for pg_id, pg in self._pg_mgr.items():
             if (associator := pg.pg_associator) is not None:
                 try:
-                    score = associator.associate(dev_info)
+                    score = self._associate(pg_id, associator, dev_info)
                     logger.debug('Associator: %s = score %s', pg_id, score)
                 except Exception:
                     logger.error(
@@ -124,3 +172,25 @@ class PluginAssociatorDeviceUpdater(AbstractDeviceUpdater):
                 else:
                     pg_scores[score].append(pg_id)
         return pg_scores
+
+    def _associate(self, pg_id, associator, dev_info):
+        if not _depends_only_on_vendor_model_version(associator):
+            return associator.associate(dev_info)
+
+        key = (
+            pg_id,
+            dev_info.get('vendor'),
+            dev_info.get('model'),
+            dev_info.get('version'),
+        )
+        try:
+            score = self._scores[key]
+        except KeyError:
+            self._misses += 1
+            score = associator.associate(dev_info)
+            if len(self._scores) >= self.max_cached_scores:
+                self._scores.clear()
+            self._scores[key] = score
+        else:
+            self._hits += 1
+        return score
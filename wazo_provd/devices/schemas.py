@@ -278,6 +278,7 @@ class BaseDeviceDict(TypedDict, total=False):
     plugin: Union[str, None]
     description: Union[str, None]
     configured: bool
+    configured_digest: Union[str, None]
     is_new: bool
     vendor: Union[str, None]
     version: Union[str, None]
@@ -3,8 +3,13 @@
 
 from __future__ import annotations
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
-from typing import Any
+from typing import Any, cast
+from unittest.mock import Mock, patch
 
 import pytest
 from hamcrest import (
@@ -12,15 +17,22 @@ from hamcrest import (
     assert_that,
     equal_to,
     has_entries,
+    has_key,
     is_,
     none,
     not_,
+    not_none,
     starts_with,
 )
 from pydantic import ValidationError
+from twisted.internet import defer
+from twisted.internet.defer import Deferred
 
-from ..config import _remove_none_values, build_autocreate_config
-from ..schemas import ConfigSchema, FuncKeyType, RawConfigSchema
+from wazo_provd.persist.id import numeric_id_generator
+from wazo_provd.persist.json_backend import new_json_collection
+
+from ..config import ConfigCollection, _remove_none_values, build_autocreate_config
+from ..schemas import ConfigDict, ConfigSchema, FuncKeyType, RawConfigSchema
 
 
 def test_config_schema_empty() -> None:
@@ -214,3 +226,306 @@ class TestRemoveNoneValues(unittest.TestCase):
             result,
             is_(equal_to(expected_result)),
         )
+
+
+def _result(deferred: Deferred) -> Any:
+    results: list[Any] = []
+    deferred.addBoth(results.append)
+    return results[0]
+
+
+class TestConfigCollectionRawConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join(tempfile.mkdtemp(), 'configs')
+        self.collection = ConfigCollection(
+            new_json_collection(self.directory, numeric_id_generator())
+        )
+        self.base_raw_config = {'X_base': 'b', 'X_shared': 'base'}
+        for config in [
+            {'id': 'c1', 'parent_ids': [], 'raw_config': {'X_shared': 'c1'}},
+            {'id': 'c2', 'parent_ids': ['c1'], 'raw_config': {'X_c2': 'v2'}},
+            {'id': 'c3', 'parent_ids': ['c2'], 'raw_config': {'X_c3': 'v3'}},
+            {'id': 'other', 'parent_ids': [], 'raw_config': {'X_other': 'v'}},
+        ]:
+            self._insert(config)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def _insert(self, config: dict[str, Any]) -> None:
+        _result(self.collection.insert(cast(ConfigDict, config)))
+
+    def _update(self, config: dict[str, Any]) -> None:
+        _result(self.collection.update(cast(ConfigDict, config)))
+
+    def _get_raw_config(self, config_id: str) -> Any:
+        return _result(self.collection.get_raw_config(config_id, self.base_raw_config))
+
+    def test_get_raw_config(self) -> None:
+        assert_that(
+            self._get_raw_config('c3'),
+            equal_to({'X_base': 'b', 'X_shared': 'c1', 'X_c2': 'v2', 'X_c3': 'v3'}),
+        )
+        assert_that(self._get_raw_config('unknown'), none())
+
+    def test_get_raw_config_is_cached(self) -> None:
+        self._get_raw_config('c3')
+
+        with patch.object(
+            self.collection._collection,
+            'retrieve',
+            wraps=self.collection._collection.retrieve,
+        ) as retrieve:
+            raw_config = self._get_raw_config('c3')
+
+        retrieve.assert_not_called()
+        raw_config['X_c3'] = 'modified'
+        assert_that(self._get_raw_config('c3'), has_entries(X_c3='v3'))
+
+    def test_least_recently_used_raw_config_is_evicted(self) -> None:
+        self.collection.max_cached_raw_configs = 2
+        self._get_raw_config('c1')
+        self._get_raw_config('c2')
+        self._get_raw_config('c1')
+
+        self._get_raw_config('other')
+
+        assert_that(list(self.collection._raw_config_cache), equal_to(['c1', 'other']))
+
+    def test_get_raw_config_with_another_base_raw_config(self) -> None:
+        self._get_raw_config('c2')
+
+        raw_config = _result(self.collection.get_raw_config('c2'))
+
+        assert_that(raw_config, equal_to({'X_shared': 'c1', 'X_c2': 'v2'}))
+
+    def test_update_invalidates_descendants(self) -> None:
+        self._get_raw_config('c3')
+        self._get_raw_config('other')
+
+        self._update({'id': 'c1', 'parent_ids': [], 'raw_config': {'X_shared': 'new'}})
+
+        assert_that(self._get_raw_config('c3'), has_entries(X_shared='new'))
+        assert_that(self.collection._raw_config_cache, has_key('other'))
+
+    def test_update_parent_ids_invalidates(self) -> None:
+        self._get_raw_config('c3')
+
+        self._update(
+            {'id': 'c3', 'parent_ids': ['other'], 'raw_config': {'X_c3': 'v3'}}
+        )
+
+        assert_that(
+            self._get_raw_config('c3'),
+            equal_to({'X_base': 'b', 'X_shared': 'base', 'X_other': 'v', 'X_c3': 'v3'}),
+        )
+
+    def test_insert_missing_parent_invalidates_children(self) -> None:
+        self._insert(
+            {'id': 'c4', 'parent_ids': ['missing'], 'raw_config': {'X_c4': 'v4'}}
+        )
+        self._get_raw_config('c4')
+
+        self._insert({'id': 'missing', 'parent_ids': [], 'raw_config': {'X_m': 'v'}})
+
+        assert_that(self._get_raw_config('c4'), has_entries(X_m='v', X_c4='v4'))
+
+    def test_delete_invalidates_descendants(self) -> None:
+        self._get_raw_config('c3')
+
+        _result(self.collection.delete('c2'))
+
+        assert_that(
+            self._get_raw_config('c3'),
+            equal_to({'X_base': 'b', 'X_shared': 'base', 'X_c3': 'v3'}),
+        )
+        assert_that(self._get_raw_config('c2'), none())
+
+    def test_get_raw_config_version(self) -> None:
+        self._get_raw_config('c3')
+        versions = {
+            config_id: self.collection.get_raw_config_version(config_id)
+            for config_id in ['c1', 'c2', 'c3', 'other']
+        }
+
+        self._update({'id': 'c2', 'parent_ids': ['c1'], 'raw_config': {'X_c2': 'new'}})
+
+        assert_that(
+            self.collection.get_raw_config_version('c1'), equal_to(versions['c1'])
+        )
+        assert_that(
+            self.collection.get_raw_config_version('other'),
+            equal_to(versions['other']),
+        )
+        for config_id in ['c2', 'c3']:
+            version = self.collection.get_raw_config_version(config_id)
+            assert_that(version, not_none())
+            assert_that(version, not_(equal_to(versions[config_id])))
+
+    def test_get_raw_config_version_unknown_config(self) -> None:
+        self._get_raw_config('c3')
+
+        _result(self.collection.delete('c3'))
+
+        assert_that(self.collection.get_raw_config_version('c3'), none())
+        assert_that(self.collection.get_raw_config_version('unknown'), none())
+
+
+class TestConfigCollectionAncestorsAndDescendants(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join(tempfile.mkdtemp(), 'configs')
+        self.collection = ConfigCollection(
+            new_json_collection(self.directory, numeric_id_generator())
+        )
+        configs: list[tuple[str, list[str]]] = [
+            ('base', []),
+            ('c1', ['base']),
+            ('c2', ['c1']),
+            ('c3', ['c1', 'other']),
+            ('other', []),
+        ]
+        for config_id, parent_ids in configs:
+            self._insert(config_id, parent_ids)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def _insert(self, config_id: str, parent_ids: list[str]) -> None:
+        config = {'id': config_id, 'parent_ids': parent_ids, 'raw_config': {}}
+        _result(self.collection.insert(cast(ConfigDict, config)))
+
+    def _update(self, config_id: str, parent_ids: list[str]) -> None:
+        config = {'id': config_id, 'parent_ids': parent_ids, 'raw_config': {}}
+        _result(self.collection.update(cast(ConfigDict, config)))
+
+    def _ancestors(self, config_id: str) -> set[str]:
+        return _result(self.collection.get_ancestors(config_id))
+
+    def _descendants(self, config_id: str) -> set[str]:
+        return _result(self.collection.get_descendants(config_id))
+
+    def test_get_ancestors_and_descendants(self) -> None:
+        assert_that(self._ancestors('c3'), equal_to({'c1', 'base', 'other'}))
+        assert_that(self._descendants('base'), equal_to({'c1', 'c2', 'c3'}))
+        assert_that(self._descendants('unknown'), equal_to(set()))
+
+    def test_returned_sets_can_be_modified(self) -> None:
+        self._descendants('base').add('modified')
+
+        assert_that(self._descendants('base'), equal_to({'c1', 'c2', 'c3'}))
+
+    def test_insert_update_and_delete(self) -> None:
+        self._descendants('base')
+        self._ancestors('c2')
+
+        self._insert('c4', ['c2'])
+        assert_that(self._descendants('base'), equal_to({'c1', 'c2', 'c3', 'c4'}))
+
+        self._update('c2', ['other'])
+        assert_that(self._descendants('base'), equal_to({'c1', 'c3'}))
+        assert_that(self._descendants('other'), equal_to({'c2', 'c3', 'c4'}))
+        assert_that(self._ancestors('c4'), equal_to({'c2', 'other'}))
+
+        _result(self.collection.delete('c2'))
+        assert_that(self._descendants('other'), equal_to({'c3'}))
+        assert_that(self._ancestors('c4'), equal_to({'c2'}))
+
+    def test_cycle(self) -> None:
+        self._update('base', ['c2'])
+
+        assert_that(self._ancestors('c1'), equal_to({'base', 'c1', 'c2'}))
+        assert_that(self._descendants('c2'), equal_to({'base', 'c1', 'c2', 'c3'}))
+
+    def test_deep_tree(self) -> None:
+        parent_id = 'base'
+        for i in range(1500):
+            self._insert(f'deep{i}', [parent_id])
+            parent_id = f'deep{i}'
+
+        assert_that(len(self._descendants('base')), equal_to(1503))
+        assert_that(len(self._ancestors(parent_id)), equal_to(1500))
+
+    def test_matches_a_full_traversal(self) -> None:
+        rand = random.Random(42)
+        config_ids = ['base', 'c1', 'c2', 'c3', 'other']
+
+        def walk(config_id: str, neighbours) -> set[str]:
+            visited: set[str] = set()
+            stack = [config_id]
+            while stack:
+                for next_id in neighbours(stack.pop()):
+                    if next_id not in visited:
+                        visited.add(next_id)
+                        stack.append(next_id)
+            return visited
+
+        for i in range(200):
+            parent_ids = rand.sample(config_ids, rand.randint(0, 2))
+            operation = rand.random()
+            if operation < 0.4:
+                config_id = f'n{i}'
+                self._insert(config_id, parent_ids)
+                config_ids.append(config_id)
+            elif operation < 0.8:
+                self._update(rand.choice(config_ids), parent_ids)
+            elif len(config_ids) > 1:
+                config_id = rand.choice(config_ids)
+                _result(self.collection.delete(config_id))
+                config_ids.remove(config_id)
+
+            configs = {
+                config['id']: config['parent_ids']
+                for config in _result(self.collection.find({}))
+            }
+            for config_id in rand.sample(config_ids, 3):
+                assert_that(
+                    self._ancestors(config_id),
+                    equal_to(walk(config_id, lambda c: configs.get(c, []))),
+                )
+                assert_that(
+                    self._descendants(config_id),
+                    equal_to(
+                        walk(
+                            config_id,
+                            lambda c: [k for k, v in configs.items() if c in v],
+                        )
+                    ),
+                )
+
+
+class TestConfigCollectionIndexes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.backend_collection = Mock(spec=['find'])
+        self.find_deferred: Deferred = Deferred()
+        self.backend_collection.find.return_value = self.find_deferred
+        self.collection = ConfigCollection(self.backend_collection)
+
+    def test_indexes_are_built_once_for_concurrent_calls(self) -> None:
+        descendants = self.collection.get_descendants('base')
+        ancestors = self.collection.get_ancestors('c1')
+        self.collection.build_child_and_parent_indexes()
+
+        self.find_deferred.callback(
+            [
+                {'id': 'base', 'parent_ids': []},
+                {'id': 'c1', 'parent_ids': ['base']},
+            ]
+        )
+
+        self.backend_collection.find.assert_called_once_with({})
+        assert_that(_result(descendants), equal_to({'c1'}))
+        assert_that(_result(ancestors), equal_to({'base'}))
+        assert_that(_result(self.collection.get_descendants('base')), equal_to({'c1'}))
+        self.backend_collection.find.assert_called_once_with({})
+
+    def test_indexes_build_error(self) -> None:
+        first = self.collection.get_descendants('base')
+        second = self.collection.build_child_and_parent_indexes()
+
+        self.find_deferred.errback(Exception('error'))
+
+        _result(first).trap(Exception)
+        _result(second).trap(Exception)
+        self.backend_collection.find.return_value = defer.succeed([])
+        assert_that(_result(self.collection.get_descendants('base')), equal_to(set()))
+        assert_that(self.backend_collection.find.call_count, equal_to(2))
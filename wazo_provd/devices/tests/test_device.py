@@ -5,9 +5,13 @@ from __future__ import annotations
 
 import unittest
 
-from hamcrest import assert_that, equal_to
+from hamcrest import assert_that, equal_to, is_not
 
-from wazo_provd.devices.device import copy, needs_reconfiguration
+from wazo_provd.devices.device import (
+    configuration_digest,
+    copy,
+    needs_reconfiguration,
+)
 from wazo_provd.devices.schemas import DeviceDict
 
 
@@ -59,3 +63,29 @@ class TestDevice(unittest.TestCase):
         }
 
         self.assertFalse(needs_reconfiguration(old_device, new_device))
+
+    def test_configuration_digest_same_configuration(self) -> None:
+        device: DeviceDict = {'id': '1', 'config': 'a', 'tenant_uuid': 'tenant_uuid'}
+        other_device: DeviceDict = {
+            'id': '1',
+            'config': 'a',
+            'tenant_uuid': 'tenant_uuid',
+            'description': 'b',
+        }
+
+        assert_that(
+            configuration_digest(other_device, 'plugin', {'k': 'v'}),
+            equal_to(configuration_digest(device, 'plugin', {'k': 'v'})),
+        )
+
+    def test_configuration_digest_different_configuration(self) -> None:
+        device: DeviceDict = {'id': '1', 'config': 'a', 'tenant_uuid': 'tenant_uuid'}
+        other_device: DeviceDict = {
+            'id': '1',
+            'config': 'b',
+            'tenant_uuid': 'tenant_uuid',
+        }
+        digest = configuration_digest(device, 'plugin', '1.0')
+
+        assert_that(configuration_digest(other_device, 'plugin', '1.0'), is_not(digest))
+        assert_that(configuration_digest(device, 'plugin', '1.1'), is_not(digest))
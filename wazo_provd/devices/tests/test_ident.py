@@ -4,24 +4,32 @@
 from __future__ import annotations
 
 from collections.abc import Generator
-from typing import Any
+from copy import deepcopy
+from typing import Any, cast
 from unittest.mock import Mock, patch
 
-from hamcrest import assert_that, equal_to, has_entry
+from hamcrest import assert_that, equal_to, has_entry, not_
 from twisted.internet import defer
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 
 from wazo_provd.devices import ident
 from wazo_provd.devices.ident import (
     AddDeviceRetriever,
+    AdmissionController,
+    AllPluginsDeviceInfoExtractor,
     DHCPRequest,
     HTTPKeyVerifyingHook,
+    IdentificationCache,
     LastSeenUpdater,
     RemoveOutdatedIpDeviceUpdater,
     Request,
+    RequestProcessingService,
+    RequestRejectedError,
     RequestType,
     VotingUpdater,
+    _ChangeTrackingDevice,
     _get_ip_from_http_request_with_proxies,
     _RequestHelper,
 )
@@ -53,6 +61,117 @@ class TestAddDeviceRetriever(unittest.TestCase):
         assert_that(device, equal_to(expected_device))
 
 
+class TestAllPluginsDeviceInfoExtractor(unittest.TestCase):
+    def setUp(self) -> None:
+        self.pg_mgr = {
+            'aastra': self._new_plugin(
+                {
+                    'http': {'user_agent_prefixes': ['Aastra']},
+                    'tftp': {'filename_patterns': [r'aastra\.cfg$']},
+                    'dhcp': {'vendor_class_prefixes': ['AastraIPPhone']},
+                }
+            ),
+            'polycom': self._new_plugin(
+                {
+                    'http': {
+                        'user_agent_prefixes': ['FileTransport Polycom'],
+                        'filename_patterns': [r'[0-9a-f]{12}-phone\.cfg$'],
+                    },
+                    'dhcp': {'vendor_class_prefixes': ['Polycom-']},
+                }
+            ),
+            'other': self._new_plugin(None),
+        }
+        self.pg_mgr_mock = Mock()
+        self.pg_mgr_mock.values.side_effect = self.pg_mgr.values
+        # the extractors dispatched to are returned as is, so they can be checked
+        self.xtor = AllPluginsDeviceInfoExtractor(cast(Any, list), self.pg_mgr_mock)
+
+    def _new_plugin(self, hints: dict | None) -> Mock:
+        plugin = Mock()
+        plugin.dev_info_dispatch_hints = hints
+        return plugin
+
+    def _extractors(self, *pg_ids: str, request_type: RequestType) -> list:
+        return [
+            getattr(self.pg_mgr[pg_id], f'{request_type.value}_dev_info_extractor')
+            for pg_id in pg_ids
+        ]
+
+    def _new_http_request(self, user_agent: str | None, path: bytes) -> Mock:
+        request = Mock()
+        request.getHeader.return_value = user_agent
+        request.path = path
+        return request
+
+    def test_dispatch_on_user_agent(self) -> None:
+        request = self._new_http_request('Aastra6731i MAC:00-08', b'/aastra.cfg')
+
+        assert_that(
+            self.xtor._get_xtor(request, RequestType.HTTP),
+            equal_to(
+                self._extractors('aastra', 'other', request_type=RequestType.HTTP)
+            ),
+        )
+
+    def test_dispatch_on_filename(self) -> None:
+        request = self._new_http_request(None, b'/000000000000-phone.cfg')
+        tftp_request = {'packet': {'filename': b'aastra.cfg'}}
+
+        assert_that(
+            self.xtor._get_xtor(request, RequestType.HTTP),
+            equal_to(
+                self._extractors('polycom', 'other', request_type=RequestType.HTTP)
+            ),
+        )
+        assert_that(
+            self.xtor._get_xtor(tftp_request, RequestType.TFTP),
+            equal_to(
+                self._extractors(
+                    'aastra', 'polycom', 'other', request_type=RequestType.TFTP
+                )
+            ),
+        )
+
+    def test_dispatch_on_vendor_class(self) -> None:
+        request = {'ip': '10.0.0.1', 'mac': 'm', 'options': {60: 'Polycom-VVX'}}
+
+        assert_that(
+            self.xtor._get_xtor(request, RequestType.DHCP),
+            equal_to(
+                self._extractors('polycom', 'other', request_type=RequestType.DHCP)
+            ),
+        )
+
+    def test_broadcast_when_no_hint_matches(self) -> None:
+        request = self._new_http_request('Unknown', b'/unknown.cfg')
+
+        assert_that(
+            self.xtor._get_xtor(request, RequestType.HTTP),
+            equal_to(
+                self._extractors(
+                    'aastra', 'polycom', 'other', request_type=RequestType.HTTP
+                )
+            ),
+        )
+
+    def test_invalid_hints_are_broadcast(self) -> None:
+        self.pg_mgr['aastra'].dev_info_dispatch_hints = {
+            'http': {'filename_patterns': ['(']}
+        }
+        self.xtor._on_plugin_load_or_unload('aastra')
+        request = self._new_http_request('FileTransport Polycom', b'/a.cfg')
+
+        assert_that(
+            self.xtor._get_xtor(request, RequestType.HTTP),
+            equal_to(
+                self._extractors(
+                    'aastra', 'polycom', 'other', request_type=RequestType.HTTP
+                )
+            ),
+        )
+
+
 class TestLastSeenUpdater(unittest.TestCase):
     def setUp(self) -> None:
         self.updater = LastSeenUpdater()
@@ -156,6 +275,261 @@ class TestRemoveOutdatedIpDeviceUpdater(unittest.TestCase):
         self.assertFalse(self.app.dev_find.called)
 
 
+class TestIdentificationCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = Mock()
+        self.pg_mgr = Mock()
+        self.clock = Clock()
+        self.cache = IdentificationCache(self.app, self.pg_mgr, 30, self.clock)
+        key = IdentificationCache.new_key(
+            '10.0.0.1', RequestType.HTTP, {'mac': '00:11:22:33:44:55'}
+        )
+        assert key is not None
+        self.key = key
+
+    def test_new_key(self) -> None:
+        dev_info = {'mac': '00:11:22:33:44:55'}
+
+        assert_that(
+            IdentificationCache.new_key('10.0.0.1', RequestType.HTTP, dev_info),
+            equal_to(self.key),
+        )
+        assert_that(
+            IdentificationCache.new_key('10.0.0.1', RequestType.TFTP, dev_info),
+            not_(equal_to(self.key)),
+        )
+        assert_that(
+            IdentificationCache.new_key('10.0.0.1', RequestType.HTTP, {}),
+            equal_to(None),
+        )
+        assert_that(
+            IdentificationCache.new_key(None, RequestType.HTTP, dev_info),
+            equal_to(None),
+        )
+
+    def test_get(self) -> None:
+        self.cache.put(self.key, 'd1')
+
+        assert_that(self.cache.get(self.key), equal_to('d1'))
+
+    def test_get_expired(self) -> None:
+        self.cache.put(self.key, 'd1')
+        self.clock.advance(30)
+
+        assert_that(self.cache.get(self.key), equal_to(None))
+
+    def test_invalidated_on_device_update_and_delete(self) -> None:
+        self.cache.put(self.key, 'd1')
+        self.app.dev_attach.assert_called_once_with(self.cache._dev_obs)
+
+        self.cache._dev_obs.dev_update('d2')
+        assert_that(self.cache.get(self.key), equal_to('d1'))
+        self.cache._dev_obs.dev_update('d1')
+        assert_that(self.cache.get(self.key), equal_to(None))
+
+        self.cache.put(self.key, 'd1')
+        self.cache._dev_obs.dev_delete('d1')
+        assert_that(self.cache.get(self.key), equal_to(None))
+
+    def test_cleared_on_plugin_load_and_unload(self) -> None:
+        self.pg_mgr.attach.assert_called_once_with(self.cache._pg_obs)
+
+        self.cache.put(self.key, 'd1')
+        self.cache._pg_obs.pg_load('p1')
+        assert_that(self.cache.get(self.key), equal_to(None))
+
+        self.cache.put(self.key, 'd1')
+        self.cache._pg_obs.pg_unload('p1')
+        assert_that(self.cache.get(self.key), equal_to(None))
+
+
+class TestAdmissionController(unittest.TestCase):
+    def setUp(self) -> None:
+        self.controller = AdmissionController(1, 2)
+
+    def _results(self, d: Deferred) -> list:
+        results: list = []
+        d.addBoth(results.append)
+        return results
+
+    def test_acquire_and_release(self) -> None:
+        first = self._results(self.controller.acquire(False))
+        second = self._results(self.controller.acquire(False))
+
+        assert_that(first, equal_to([None]))
+        assert_that(second, equal_to([]))
+        self.controller.release()
+        assert_that(second, equal_to([None]))
+        self.controller.release()
+        assert_that(self.controller.has_free_slot(), equal_to(True))
+
+    def test_known_devices_first(self) -> None:
+        self.controller.acquire(False)
+        unknown = self._results(self.controller.acquire(False))
+        known = self._results(self.controller.acquire(True))
+
+        self.controller.release()
+
+        assert_that(known, equal_to([None]))
+        assert_that(unknown, equal_to([]))
+
+    def test_reject_when_queue_is_full(self) -> None:
+        self.controller.acquire(False)
+        unknown = self._results(self.controller.acquire(False))
+        self.controller.acquire(True)
+
+        rejected = self._results(self.controller.acquire(False))
+        known = self._results(self.controller.acquire(True))
+
+        rejected[0].trap(RequestRejectedError)
+        unknown[0].trap(RequestRejectedError)
+        assert_that(known, equal_to([]))
+        rejected = self._results(self.controller.acquire(True))
+        rejected[0].trap(RequestRejectedError)
+
+
+class TestRequestProcessingService(unittest.TestCase):
+    def setUp(self) -> None:
+        self.device = {'id': 'd1', 'plugin': 'p1'}
+        self.app = Mock()
+        self.app.dev_retrieve.side_effect = lambda _: defer.succeed(dict(self.device))
+        self.app.pg_mgr.get.return_value = None
+        self.extractor = Mock()
+        self.extractor.extract.side_effect = lambda *_: defer.succeed(
+            {'ip': '10.0.0.1', 'mac': '00:11:22:33:44:55'}
+        )
+        self.retriever = Mock()
+        self.retriever.retrieve.side_effect = lambda _: defer.succeed(dict(self.device))
+        self.updater = Mock()
+        self.updater.update.side_effect = lambda *_: defer.succeed(None)
+        self.cache = IdentificationCache(self.app, Mock(), 30, Clock())
+        self.service = RequestProcessingService(
+            self.app, self.extractor, self.retriever, self.updater, self.cache
+        )
+        self.request = {'address': ('10.0.0.1', 69), 'packet': {'filename': b'f'}}
+
+    @defer.inlineCallbacks
+    def test_process_uses_cache(self) -> Generator[Deferred, Any, None]:
+        first = yield self.service.process(self.request, RequestType.TFTP)
+        second = yield self.service.process(self.request, RequestType.TFTP)
+
+        assert_that(first, equal_to((self.device, 'p1')))
+        assert_that(second, equal_to((self.device, 'p1')))
+        self.retriever.retrieve.assert_called_once()
+        self.updater.update.assert_called_once()
+
+    def test_concurrent_requests_are_coalesced(self) -> None:
+        retrieved: Deferred = Deferred()
+        self.retriever.retrieve.side_effect = lambda _: retrieved
+        results: list = []
+
+        self.service.process(self.request, RequestType.TFTP).addCallback(results.append)
+        self.service.process(self.request, RequestType.TFTP).addCallback(results.append)
+        retrieved.callback(dict(self.device))
+
+        assert_that(results, equal_to([(self.device, 'p1'), (self.device, 'p1')]))
+        self.retriever.retrieve.assert_called_once()
+        assert_that(results[0][0] is results[1][0], equal_to(False))
+
+    def test_concurrent_request_errors_are_shared(self) -> None:
+        retrieved: Deferred = Deferred()
+        self.retriever.retrieve.side_effect = lambda _: retrieved
+        failures: list = []
+
+        self.service.process(self.request, RequestType.TFTP).addErrback(failures.append)
+        self.service.process(self.request, RequestType.TFTP).addErrback(failures.append)
+        retrieved.errback(Exception('error'))
+
+        assert_that(len(failures), equal_to(2))
+        assert_that(self.service._pending, equal_to({}))
+
+    def test_requests_are_rejected_when_saturated(self) -> None:
+        self.service._admission_controller = AdmissionController(1, 0)
+        retrieved: Deferred = Deferred()
+        self.retriever.retrieve.side_effect = lambda _: retrieved
+        self.app.dev_find_one.return_value = defer.succeed(None)
+        other_request = {'address': ('10.0.0.2', 69), 'packet': {'filename': b'f'}}
+        failures: list = []
+
+        self.service.process(self.request, RequestType.TFTP)
+        self.service.process(other_request, RequestType.TFTP).addErrback(
+            failures.append
+        )
+
+        failures[0].trap(RequestRejectedError)
+        retrieved.callback(dict(self.device))
+        assert_that(self.service._admission_controller.has_free_slot(), equal_to(True))
+
+    @defer.inlineCallbacks
+    def test_process_deleted_device(self) -> Generator[Deferred, Any, None]:
+        yield self.service.process(self.request, RequestType.TFTP)
+        self.app.dev_retrieve.side_effect = lambda _: defer.succeed(None)
+
+        yield self.service.process(self.request, RequestType.TFTP)
+
+        assert_that(self.retriever.retrieve.call_count, equal_to(2))
+
+
+class TestChangeTrackingDevice(unittest.TestCase):
+    def test_changed_keys(self) -> None:
+        device = _ChangeTrackingDevice({'id': 'a', 'ip': '10.0.0.1', 'vendor': 'v'})
+
+        device['ip'] = '10.0.0.2'
+        device['vendor'] = 'w'
+        device['vendor'] = 'v'
+        device.setdefault('model', 'm')
+        device.update(version='1.0')
+        del device['id']
+
+        assert_that(device.changed_keys(), equal_to({'ip', 'model', 'version', 'id'}))
+
+    def test_no_changed_keys(self) -> None:
+        device = _ChangeTrackingDevice({'id': 'a'})
+
+        device['id'] = 'a'
+        device.pop('unknown', None)
+
+        assert_that(device.changed_keys(), equal_to(set()))
+
+    def test_changed_keys_nested_values(self) -> None:
+        device = _ChangeTrackingDevice(
+            {
+                'options': {'switchboard': False},
+                'remote_state': {'sip_username': 'a'},
+                'ids': [],
+                'vendor': 'v',
+            }
+        )
+
+        device['options']['switchboard'] = True
+        device.get('ids', []).append('b')
+        device['remote_state'] = {'sip_username': 'a'}
+
+        assert_that(device.changed_keys(), equal_to({'options', 'ids'}))
+
+    def test_nested_values_are_copied_only_when_read(self) -> None:
+        device = _ChangeTrackingDevice(
+            {'options': {'switchboard': False}, 'ids': [], 'vendor': 'v'}
+        )
+
+        with patch('wazo_provd.devices.ident.deepcopy', wraps=deepcopy) as copy:
+            device['vendor'] = 'w'
+            device.get('ids')
+
+        copy.assert_called_once_with([])
+        assert_that(device.changed_keys(), equal_to({'vendor'}))
+
+    def test_or(self) -> None:
+        device = _ChangeTrackingDevice({'id': 'a'})
+
+        merged = device | {'ip': '10.0.0.1'}
+        device |= {'id': 'b'}
+
+        assert_that(merged, equal_to({'id': 'a', 'ip': '10.0.0.1'}))
+        assert_that(device, equal_to({'id': 'b'}))
+        assert_that(device.changed_keys(), equal_to({'id'}))
+
+
 class TestRequestHelper(unittest.TestCase):
     request_type: Mock | RequestType
 
@@ -260,13 +634,17 @@ class TestRequestHelper(unittest.TestCase):
         }
         self.helper = _RequestHelper(self.app, self.request, self.request_type, 1)
 
+        original_device = dict(device)
+
         yield self.helper.update_device(dev_updater, device, dev_info)
 
         dev_updater.update.assert_called_once_with(
-            device, dev_info, self.request, self.request_type
+            original_device, dev_info, self.request, self.request_type
         )
         self.app.cfg_retrieve.assert_called_once_with(device['config'])
-        self.app.dev_update.assert_called_once_with(device)
+        self.app.dev_update.assert_called_once_with(
+            device, changed_keys={'remote_state_sip_username'}
+        )
         assert_that(device, has_entry('remote_state_sip_username', 'foobar'))
 
     @defer.inlineCallbacks
@@ -304,8 +682,35 @@ class TestRequestHelper(unittest.TestCase):
             device, dev_info, self.request, self.request_type
         )
         self.app.dev_update.assert_called_once_with(
-            device, pre_update_hook=self.helper._pre_update_hook
+            device,
+            pre_update_hook=self.helper._pre_update_hook,
+            changed_keys={'vendor'},
         )
+        assert_that(device, has_entry('vendor', 'xivo'))
+
+    @defer.inlineCallbacks
+    def test_update_device_untouched_device_with_options(
+        self,
+    ) -> Generator[Deferred, Any, None]:
+        dev_updater = self._new_dev_updater_mock()
+        device = {'id': 'a', 'options': {'switchboard': True}, 'vendor': 'xivo'}
+
+        with patch('wazo_provd.devices.ident.deepcopy') as copy:
+            yield self.helper.update_device(dev_updater, device, {})
+
+        copy.assert_not_called()
+        self.assertFalse(self.app.dev_update.called)
+
+    @defer.inlineCallbacks
+    def test_update_device_set_to_same_value(
+        self,
+    ) -> Generator[Deferred, Any, None]:
+        dev_updater = self._new_dev_updater_mock({'vendor': 'xivo'})
+        device = {'id': 'a', 'vendor': 'xivo'}
+
+        yield self.helper.update_device(dev_updater, device, {})
+
+        self.assertFalse(self.app.dev_update.called)
 
     def test_get_plugin_id_no_device(self) -> None:
         device = None
@@ -0,0 +1,111 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import annotations
+
+import unittest
+from unittest.mock import Mock
+
+from hamcrest import assert_that, equal_to, has_entries
+
+from wazo_provd.devices.pgasso import (
+    AbstractPluginAssociator,
+    BasePgAssociator,
+    DeviceSupport,
+    PluginAssociatorDeviceUpdater,
+    ReverseAlphabeticConflictSolver,
+)
+
+
+class _VendorPgAssociator(BasePgAssociator):
+    def __init__(self, vendor: str) -> None:
+        self.vendor = vendor
+        self.calls = 0
+
+    def _do_associate(self, vendor, model, version):
+        self.calls += 1
+        if vendor == self.vendor:
+            return DeviceSupport.EXACT
+        return DeviceSupport.IMPROBABLE
+
+
+class _MacPgAssociator(AbstractPluginAssociator):
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def associate(self, dev_info):
+        self.calls += 1
+        if dev_info.get('mac', '').startswith('00:08:5d'):
+            return DeviceSupport.COMPLETE
+        return DeviceSupport.UNKNOWN
+
+
+class TestPluginAssociatorDeviceUpdater(unittest.TestCase):
+    def setUp(self) -> None:
+        self.aastra_associator = _VendorPgAssociator('Aastra')
+        self.polycom_associator = _VendorPgAssociator('Polycom')
+        self.mac_associator = _MacPgAssociator()
+        self.plugins = {
+            'aastra': Mock(pg_associator=self.aastra_associator),
+            'polycom': Mock(pg_associator=self.polycom_associator),
+            'mac': Mock(pg_associator=self.mac_associator),
+        }
+        self.pg_mgr = Mock()
+        self.pg_mgr.items.side_effect = self.plugins.items
+        self.updater = PluginAssociatorDeviceUpdater(
+            self.pg_mgr, ReverseAlphabeticConflictSolver()
+        )
+
+    def _update(self, dev_info: dict[str, str]) -> dict[str, str]:
+        device: dict[str, str] = {}
+        self.updater.update(device, dev_info, Mock(), Mock())
+        return device
+
+    def test_update(self) -> None:
+        device = self._update({'vendor': 'Polycom', 'model': 'VVX'})
+
+        assert_that(device, equal_to({'plugin': 'polycom'}))
+
+    def test_scores_are_cached(self) -> None:
+        self._update({'vendor': 'Aastra', 'model': '6731i', 'ip': '10.0.0.1'})
+        device = self._update({'vendor': 'Aastra', 'model': '6731i', 'ip': '10.0.0.2'})
+
+        assert_that(device, equal_to({'plugin': 'aastra'}))
+        assert_that(self.aastra_associator.calls, equal_to(1))
+        assert_that(self.polycom_associator.calls, equal_to(1))
+        assert_that(
+            self.updater.get_stats(),
+            has_entries(size=2, hits=2, misses=2, hit_rate=0.5),
+        )
+
+    def test_scores_are_cached_by_vendor_model_version(self) -> None:
+        self._update({'vendor': 'Aastra', 'model': '6731i'})
+        self._update({'vendor': 'Aastra', 'model': '6739i'})
+
+        assert_that(self.aastra_associator.calls, equal_to(2))
+
+    def test_other_associators_are_not_cached(self) -> None:
+        self._update({'vendor': 'Aastra', 'mac': '00:08:5d:00:00:01'})
+        device = self._update({'vendor': 'Other', 'mac': '00:08:5d:00:00:02'})
+
+        assert_that(device, equal_to({'plugin': 'mac'}))
+        assert_that(self.mac_associator.calls, equal_to(2))
+
+    def test_cache_cleared_on_plugin_load_and_unload(self) -> None:
+        observer = self.pg_mgr.attach.call_args[0][0]
+
+        self._update({'vendor': 'Aastra'})
+        observer.pg_load('other')
+        self._update({'vendor': 'Aastra'})
+        observer.pg_unload('other')
+        self._update({'vendor': 'Aastra'})
+
+        assert_that(self.aastra_associator.calls, equal_to(3))
+
+    def test_provide_status(self) -> None:
+        self._update({'vendor': 'Aastra'})
+        status: dict = {}
+
+        self.updater.provide_status(status)
+
+        assert_that(status['plugin_association_cache'], has_entries(hits=0, misses=2))
@@ -6,7 +6,7 @@ from __future__ import annotations
 import builtins
 import logging
 import os.path
-from collections.abc import Generator
+from collections.abc import Generator, Iterator
 from typing import TYPE_CHECKING, Any, Callable
 
 from twisted.application import internet
@@ -31,7 +31,10 @@ from wazo_provd.app import ProvisioningApplication
 from wazo_provd.devices import ident, pgasso
 from wazo_provd.devices.config import ConfigCollection
 from wazo_provd.devices.device import DeviceCollection
+from wazo_provd.persist.common import COMMON_INDEXES
 from wazo_provd.persist.json_backend import JsonDatabaseFactory
+from wazo_provd.persist.log_backend import LogDatabaseFactory
+from wazo_provd.persist.sqlite_backend import SqliteDatabaseFactory
 from wazo_provd.rest.api.resource import ResponseFile
 from wazo_provd.rest.server import auth
 from wazo_provd.rest.server.server import new_authenticated_server_resource
@@ -39,6 +42,8 @@ from wazo_provd.servers.http_site import AuthResource, Site
 from wazo_provd.servers.tftp.proto import TFTPProtocol
 
 if TYPE_CHECKING:
+    from twisted.python.failure import Failure
+
     from .config import BusConfigDict, Options, ProvdConfigDict
     from .persist.common import AbstractDatabase
 
@@ -62,6 +67,8 @@ class ProvisioningService(Service):
 
     _DB_FACTORIES = {
         'json': JsonDatabaseFactory(),
+        'log': LogDatabaseFactory(),
+        'sqlite': SqliteDatabaseFactory(),
     }
 
     def __init__(self, config: ProvdConfigDict) -> None:
@@ -95,17 +102,24 @@ class ProvisioningService(Service):
             logger.error('Error while closing database', exc_info=True)
         logger.info('/Database closed')
 
+    def _on_config_indexes_error(self, failure: Failure) -> None:
+        # the indexes are built again on the first method needing them
+        logger.error('Error while building config indexes: %s', failure.value)
+
     def startService(self) -> None:
         self._database = self._create_database()
         try:
             cfg_collection = ConfigCollection(self._database.collection('configs'))
+            # build the config indexes now rather than on the first requests
+            cfg_collection.build_child_and_parent_indexes().addErrback(
+                self._on_config_indexes_error
+            )
             dev_collection = DeviceCollection(self._database.collection('devices'))
             if self._config['database']['ensure_common_indexes']:
                 logger.debug('Ensuring index existence on collections')
                 try:
-                    dev_collection.ensure_index('mac')
-                    dev_collection.ensure_index('ip')
-                    dev_collection.ensure_index('sn')
+                    for complex_key in COMMON_INDEXES['devices']:
+                        dev_collection.ensure_index(complex_key)
                 except AttributeError as e:
                     logger.warning(
                         'This type of database doesn\'t seem to support index: %s', e
@@ -135,6 +149,14 @@ class ProvisioningService(Service):
         self._close_database()
 
 
+def _iter_device_updaters(updater: Any) -> Iterator[Any]:
+    # Yield the updater and, recursively, the updaters it is composed of
+    yield updater
+    if isinstance(updater, ident.CompositeDeviceUpdater):
+        for sub_updater in updater.updaters:
+            yield from _iter_device_updaters(sub_updater)
+
+
 class ProcessService(Service):
     request_processing: ident.RequestProcessingService
 
@@ -181,8 +203,29 @@ class ProcessService(Service):
         dev_info_extractor = self._create_processor('info_extractor')
         dev_retriever = self._create_processor('retriever')
         dev_updater = self._create_processor('updater')
+        for updater in _iter_device_updaters(dev_updater):
+            if isinstance(updater, pgasso.PluginAssociatorDeviceUpdater):
+                status.get_status_aggregator().add_provider(updater.provide_status)
+        app = self._prov_service.app
+        general_config = self._config['general']
+        ident_cache = None
+        if general_config['ident_cache_ttl'] > 0:
+            ident_cache = ident.IdentificationCache(
+                app, app.pg_mgr, general_config['ident_cache_ttl']
+            )
+        admission_controller = None
+        if general_config['ident_max_concurrent_requests'] > 0:
+            admission_controller = ident.AdmissionController(
+                general_config['ident_max_concurrent_requests'],
+                general_config['ident_max_queued_requests'],
+            )
         self.request_processing = ident.RequestProcessingService(
-            self._prov_service.app, dev_info_extractor, dev_retriever, dev_updater
+            app,
+            dev_info_extractor,
+            dev_retriever,
+            dev_updater,
+            ident_cache,
+            admission_controller,
         )
         Service.startService(self)
 
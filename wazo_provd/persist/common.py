@@ -1,4 +1,4 @@
-# Copyright 2011-2023 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2011-2024 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 r"""Persistent storage interface for 'documents'.
@@ -46,12 +46,20 @@ Here's examples of valid selector and the documents the selector will match:
 from __future__ import annotations
 
 from abc import ABCMeta, abstractmethod
+from collections.abc import Iterable
 from typing import Any, Literal, TypedDict, Union
 
 from twisted.internet.defer import Deferred
 
 ID_KEY: Literal["id"] = "id"
 
+# complex keys indexed by collection when the common indexes are ensured,
+# i.e. the keys used to identify devices and the low cardinality keys used to
+# find the devices affected by a config or plugin change
+COMMON_INDEXES: dict[str, tuple[str, ...]] = {
+    'devices': ('mac', 'ip', 'sn', 'config', 'plugin', 'tenant_uuid'),
+}
+
 
 class BaseDocumentDict(TypedDict):
     id: str
@@ -96,6 +104,18 @@ class AbstractDocumentCollection(metaclass=ABCMeta):
 
         """
 
+    @abstractmethod
+    def insert_many(self, documents: Iterable[Document]) -> Deferred:
+        """Store many new documents at once and return a deferred that will
+        fire with the list of IDs of the documents once every document has
+        been successfully inserted.
+
+        IDs are given or generated as for insert. If a given ID is already
+        in use, or given twice, no document is inserted and the deferred will
+        fire its errback with an InvalidIdError.
+
+        """
+
     @abstractmethod
     def update(self, document: Document) -> Deferred:
         """Update the document with the current document and return a
@@ -108,6 +128,17 @@ class AbstractDocumentCollection(metaclass=ABCMeta):
 
         """
 
+    @abstractmethod
+    def update_many(self, documents: Iterable[Document]) -> Deferred:
+        """Update many documents at once and return a deferred that fire
+        with None once every document has been successfully updated.
+
+        Every document must have an 'id' key that is a valid ID in the
+        collection, else no document is updated and the deferred will fire
+        its errback with an InvalidIdError.
+
+        """
+
     @abstractmethod
     def delete(self, document_id: str) -> Deferred:
         """Delete the document with the given ID and return a deferred that
@@ -209,7 +240,7 @@ class AbstractDatabaseFactory(metaclass=ABCMeta):
     @staticmethod
     @abstractmethod
     def new_database(
-        db_type: Literal['json'],
+        db_type: str,
         generator: Literal['default', 'numeric', 'uuid'],
         **kwargs: Any,
     ) -> AbstractDatabase:
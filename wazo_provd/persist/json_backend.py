@@ -6,11 +6,17 @@ from __future__ import annotations
 import json
 import logging
 import os
-from collections.abc import Generator
-from copy import deepcopy
-from typing import Any, Literal
+import threading
+import time
+from collections.abc import Callable, Generator, Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Literal, cast
+
+from twisted.internet import threads
+from twisted.internet.interfaces import IDelayedCall, IReactorTime
 
 from wazo_provd.persist.common import (
+    COMMON_INDEXES,
     AbstractBackend,
     AbstractDatabase,
     AbstractDatabaseFactory,
@@ -18,88 +24,340 @@ from wazo_provd.persist.common import (
 from wazo_provd.persist.id import GeneratorFactory, get_id_generator_factory
 from wazo_provd.persist.util import (
     SimpleBackendDocumentCollection,
+    copy_document,
+    fsync_directory,
     new_backend_based_collection,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_FLUSH_DELAY = 0.0
+
+_LOAD_WORKERS = 8
+
+_TMP_DIRECTORY_SUFFIX = '.tmp'
+
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter, e.g. on big integers
+            pass
+    return json.loads(data)
+
 
 class JsonSimpleBackend(AbstractBackend):
-    closed = False
+    """Backend storing every document in its own JSON file.
+
+    Documents are written to a temporary file, in a directory next to the
+    collection directory, which is then renamed over the document file, so
+    that a crash never leaves a partially written document. The files and the
+    collection directory are synced to disk once written, so that a power
+    loss doesn't either.
+
+    If flush_delay is 0, every write is done immediately. Otherwise, modified
+    documents are only marked as dirty and are all written and synced in one
+    pass at most flush_delay seconds later, in a thread of the reactor thread
+    pool if flush_in_thread is true. Pending writes are always done on close.
+
+    If autoload is false, the documents are only loaded once load is called.
 
-    def __init__(self, directory: str) -> None:
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        flush_delay: float = DEFAULT_FLUSH_DELAY,
+        flush_in_thread: bool = False,
+        clock: IReactorTime | None = None,
+        autoload: bool = True,
+    ) -> None:
+        if clock is None:
+            from twisted.internet import reactor
+
+            clock = cast(IReactorTime, reactor)
         self._directory = directory
+        # outside of the collection directory, so that temporary files never
+        # clash with documents
+        self._tmp_directory = f'{directory}{_TMP_DIRECTORY_SUFFIX}'
+        self._flush_delay = flush_delay
+        self._flush_in_thread = flush_in_thread
+        self._clock = clock
+        self._delayed_flush: IDelayedCall | None = None
+        self._dirty: set[str] = set()
+        # documents being written by a flush in a thread
+        self._flushing: set[str] | None = None
+        # held while writing files, so that writes are never interleaved
+        self._write_lock = threading.Lock()
+        # incremented on every synchronous flush, so that an older flush
+        # waiting in a thread doesn't overwrite newer documents
+        self._write_generation = 0
         self._dict: dict[str, Any] = {}
-        self._load()
+        if autoload:
+            self.load()
         self._closed = False
 
-    def _load(self) -> None:
+    def _read_document(self, abs_filename: str) -> dict[str, Any] | None:
+        # Called in a thread of the loading pool
+        try:
+            with open(abs_filename, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.warning('Could not open file %s: %s', abs_filename, e)
+            return None
+        try:
+            return _loads(data)
+        except ValueError as e:
+            logger.warning('Could not decode JSON document %s: %s', abs_filename, e)
+            return None
+
+    def _remove_temporary_files(self) -> None:
+        if not os.path.isdir(self._tmp_directory):
+            os.mkdir(self._tmp_directory)
+            return
+
+        for rel_filename in os.listdir(self._tmp_directory):
+            # write interrupted by a crash, the document file is intact
+            abs_filename = os.path.join(self._tmp_directory, rel_filename)
+            logger.info('Removing temporary file %s', abs_filename)
+            try:
+                os.remove(abs_filename)
+            except OSError as e:
+                logger.warning('Could not remove file %s: %s', abs_filename, e)
+
+    def _list_document_filenames(self) -> list[str]:
         if not os.path.isdir(self._directory):
             os.mkdir(self._directory)
+        self._remove_temporary_files()
+        return os.listdir(self._directory)
+
+    def load(self, listener: Callable[[dict[str, Any]], None] | None = None) -> None:
+        """Load every document of the directory.
+
+        Files are read and decoded by a pool of threads, and listener, if
+        given, is called in the calling thread with every loaded document.
+
+        """
+        start_time = time.monotonic()
+        rel_filenames = self._list_document_filenames()
+        abs_filenames = [
+            os.path.join(self._directory, rel_filename)
+            for rel_filename in rel_filenames
+        ]
+        with ThreadPoolExecutor(max_workers=_LOAD_WORKERS) as executor:
+            documents = executor.map(self._read_document, abs_filenames)
+            for rel_filename, document in zip(rel_filenames, documents):
+                if document is None:
+                    continue
+                self._dict[rel_filename] = document
+                if listener is not None:
+                    listener(document)
+        logger.info(
+            'Loaded %d documents from %s in %.3f seconds',
+            len(self._dict),
+            self._directory,
+            time.monotonic() - start_time,
+        )
+
+    def _serialize(self, document_ids: Iterable[str]) -> list[tuple[str, str | None]]:
+        # Return a list of (document ID, JSON text) tuples, where the JSON
+        # text is None for deleted documents
+        records: list[tuple[str, str | None]] = []
+        for document_id in document_ids:
+            document = self._dict.get(document_id)
+            if document is None:
+                records.append((document_id, None))
+            else:
+                records.append(
+                    (document_id, json.dumps(document, separators=(',', ':')))
+                )
+        return records
 
-        for rel_filename in os.listdir(self._directory):
-            abs_filename = os.path.join(self._directory, rel_filename)
+    def _write_file(self, document_id: str, data: str | None) -> None:
+        abs_filename = os.path.join(self._directory, document_id)
+        if data is None:
             try:
-                fobj = open(abs_filename)
+                os.remove(abs_filename)
+            except FileNotFoundError:
+                pass
             except OSError as e:
-                logger.warning('Could not open file %s: %s', abs_filename, e)
-            else:
-                try:
-                    document = json.load(fobj)
-                except ValueError as e:
-                    logger.warning(
-                        'Could not decode JSON document %s: %s', abs_filename, e
-                    )
-                else:
-                    self._dict[rel_filename] = document
-                finally:
-                    fobj.close()
+                logger.info(
+                    'Error while removing JSON document %s: %s', abs_filename, e
+                )
+            return
+
+        tmp_filename = os.path.join(self._tmp_directory, document_id)
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, abs_filename)
+
+    def _write_records(
+        self,
+        records: list[tuple[str, str | None]],
+        generation: int | None = None,
+    ) -> None:
+        with self._write_lock:
+            if generation is not None and generation != self._write_generation:
+                # superseded by a synchronous flush
+                return
+            for document_id, data in records:
+                self._write_file(document_id, data)
+            if records:
+                fsync_directory(self._directory)
+
+    def _cancel_delayed_flush(self) -> None:
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+
+    def flush(self) -> None:
+        """Write every pending document now."""
+        self._cancel_delayed_flush()
+        document_ids = self._dirty
+        if self._flushing is not None:
+            document_ids = document_ids | self._flushing
+        self._dirty = set()
+        records = self._serialize(document_ids)
+        with self._write_lock:
+            self._write_generation += 1
+        self._write_records(records, self._write_generation)
+
+    def _flush_in_background(self) -> None:
+        self._delayed_flush = None
+        if not self._flush_in_thread:
+            self.flush()
+            return
+
+        document_ids = self._flushing = self._dirty
+        self._dirty = set()
+        logger.debug('Flushing %d documents in %s', len(document_ids), self._directory)
+        d = threads.deferToThread(
+            self._write_records,
+            self._serialize(document_ids),
+            self._write_generation,
+        )
+        d.addCallbacks(self._on_flush_success, self._on_flush_failure)
+
+    def _on_flush_success(self, _: None) -> None:
+        self._flushing = None
+        if self._dirty and not self._closed:
+            self._schedule_flush()
+
+    def _on_flush_failure(self, failure) -> None:
+        logger.error(
+            'Error while flushing documents in %s: %s',
+            self._directory,
+            failure.getErrorMessage(),
+        )
+        # retry on the next flush
+        if self._flushing is not None and not self._closed:
+            self._dirty |= self._flushing
+        self._on_flush_success(None)
+
+    def _schedule_flush(self) -> None:
+        if self._delayed_flush is None and self._flushing is None:
+            self._delayed_flush = self._clock.callLater(
+                self._flush_delay, self._flush_in_background
+            )
+
+    def _mark_dirty(self, document_ids: Iterable[str]) -> None:
+        if self._flush_delay <= 0:
+            self._write_records(self._serialize(document_ids))
+        else:
+            self._dirty.update(document_ids)
+            self._schedule_flush()
 
     def close(self) -> None:
+        if not self._closed:
+            self.flush()
         self._dict = {}
         self._closed = True
 
     def __getitem__(self, document_id: str) -> dict[str, Any]:
-        return deepcopy(self._dict[document_id])
+        return copy_document(self._dict[document_id])
+
+    def peek(self, document_id: str) -> dict[str, Any]:
+        """Return the stored document without copying it.
+
+        The returned document is shared and MUST NOT be modified.
+
+        """
+        return self._dict[document_id]
 
     def __setitem__(self, document_id: str, document: dict[str, Any]) -> None:
-        self._dict[document_id] = deepcopy(document)
-        abs_filename = os.path.join(self._directory, document_id)
-        with open(abs_filename, 'w') as f:
-            json.dump(document, fp=f, separators=(',', ':'))
+        self._dict[document_id] = copy_document(document)
+        self._mark_dirty([document_id])
+
+    def set_many(self, documents: dict[str, dict[str, Any]]) -> None:
+        """Store many documents, writing them as a single batch."""
+        for document_id, document in documents.items():
+            self._dict[document_id] = copy_document(document)
+        self._mark_dirty(documents)
 
     def __delitem__(self, document_id: str) -> None:
         del self._dict[document_id]
-        abs_filename = os.path.join(self._directory, document_id)
-        try:
-            os.remove(abs_filename)
-        except OSError as e:
-            logger.info('Error while removing JSON document %s: %s', e)
+        self._mark_dirty([document_id])
 
     def __contains__(self, document_id: str) -> bool:
         return document_id in self._dict
 
+    def __len__(self) -> int:
+        return len(self._dict)
+
     def values(self) -> Generator[dict[str, Any], None, None]:
         for document in self._dict.values():
-            yield deepcopy(document)
+            yield copy_document(document)
+
+    def peek_values(self) -> Iterable[dict[str, Any]]:
+        """Return the stored documents without copying them.
+
+        The returned documents are shared and MUST NOT be modified.
+
+        """
+        return self._dict.values()
 
     def items(self) -> Generator[tuple[str, dict[str, Any]], None, None]:
         for document_id, document in self._dict.items():
-            yield document_id, deepcopy(document)
+            yield document_id, copy_document(document)
 
 
 def new_json_collection(
-    directory: str, generator: Generator[str, None, None]
+    directory: str,
+    generator: Generator[str, None, None],
+    index_keys: Iterable[str] = (),
+    **kwargs: Any,
 ) -> SimpleBackendDocumentCollection:
-    return new_backend_based_collection(JsonSimpleBackend(directory), generator)
+    backend = JsonSimpleBackend(directory, autoload=False, **kwargs)
+    collection = new_backend_based_collection(backend, generator)
+    # build the indexes while the documents are loaded
+    collection.create_indexes_on_load(index_keys, backend.load)
+    return collection
 
 
 class JsonDatabase(AbstractDatabase):
     def __init__(
-        self, base_directory: str, generator_factory: GeneratorFactory
+        self,
+        base_directory: str,
+        generator_factory: GeneratorFactory,
+        flush_delay: float = DEFAULT_FLUSH_DELAY,
+        flush_in_thread: bool = False,
+        indexes: Mapping[str, Iterable[str]] | None = None,
     ) -> None:
         self._base_directory = base_directory
         self._generator_factory = generator_factory
+        self._flush_delay = flush_delay
+        self._flush_in_thread = flush_in_thread
+        self._indexes = indexes or {}
         self._collections: dict[str, SimpleBackendDocumentCollection] = {}
         self._create_base_directory()
 
@@ -116,7 +374,13 @@ class JsonDatabase(AbstractDatabase):
         generator = self._generator_factory()
         directory = os.path.join(self._base_directory, collection_id)
         try:
-            return new_json_collection(directory, generator)
+            return new_json_collection(
+                directory,
+                generator,
+                self._indexes.get(collection_id, ()),
+                flush_delay=self._flush_delay,
+                flush_in_thread=self._flush_in_thread,
+            )
         except Exception as e:
             # could not create collection
             raise ValueError(e)
@@ -141,6 +405,14 @@ class JsonDatabaseFactory(AbstractDatabaseFactory):
             base_directory = kwargs['json_db_dir']
         except KeyError:
             raise ValueError(f'missing "json_db_dir" arguments in "{kwargs}"')
+        try:
+            flush_delay = float(kwargs.get('json_db_flush_delay', DEFAULT_FLUSH_DELAY))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'invalid json database arguments: {e}')
+        flush_in_thread = bool(kwargs.get('json_db_flush_in_thread', False))
+        indexes = COMMON_INDEXES if kwargs.get('ensure_common_indexes') else None
 
         generator_factory = get_id_generator_factory(generator)
-        return JsonDatabase(base_directory, generator_factory)
+        return JsonDatabase(
+            base_directory, generator_factory, flush_delay, flush_in_thread, indexes
+        )
@@ -0,0 +1,342 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Log structured storage of documents.
+
+Every document of a collection is stored in a directory containing two files:
+- a snapshot file, holding every document at the time of the last compaction
+- a log file, to which every write made since the last compaction is appended
+
+Both files contain one JSON record per line. A record is either
+{"op": "set", "id": <document id>, "document": <document>} or
+{"op": "del", "id": <document id>}. Loading a collection is then only a
+sequential read of two files, replaying the records in order.
+
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from collections.abc import Generator, Iterable
+from typing import Any, Literal, cast
+
+from twisted.internet.interfaces import IDelayedCall, IReactorTime
+
+from wazo_provd.persist.common import (
+    AbstractBackend,
+    AbstractDatabase,
+    AbstractDatabaseFactory,
+)
+from wazo_provd.persist.id import GeneratorFactory, get_id_generator_factory
+from wazo_provd.persist.util import (
+    SimpleBackendDocumentCollection,
+    copy_document,
+    fsync_directory,
+    new_backend_based_collection,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = 'snapshot.ndjson'
+LOG_FILENAME = 'log.ndjson'
+
+DEFAULT_SYNC_DELAY = 1.0
+DEFAULT_COMPACT_THRESHOLD = 10000
+
+
+def _dumps_record(record: dict[str, Any]) -> str:
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+class LogSimpleBackend(AbstractBackend):
+    """Backend storing documents in a snapshot file and an append-only log.
+
+    Writes are appended to the log and flushed immediately, but fsync calls
+    are batched: the log is synced at most sync_delay seconds after a write
+    (0 meaning after every write). Once the log holds more than
+    compact_threshold records, and more records than there are documents,
+    it is compacted into a new snapshot.
+
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sync_delay: float = DEFAULT_SYNC_DELAY,
+        compact_threshold: int = DEFAULT_COMPACT_THRESHOLD,
+        clock: IReactorTime | None = None,
+    ) -> None:
+        if clock is None:
+            from twisted.internet import reactor
+
+            clock = cast(IReactorTime, reactor)
+        self._directory = directory
+        self._snapshot_filename = os.path.join(directory, SNAPSHOT_FILENAME)
+        self._log_filename = os.path.join(directory, LOG_FILENAME)
+        self._sync_delay = sync_delay
+        self._compact_threshold = compact_threshold
+        self._clock = clock
+        self._delayed_sync: IDelayedCall | None = None
+        self._dict: dict[str, Any] = {}
+        self._log_count = 0
+        self._load()
+        self._log_file = open(self._log_filename, 'a')
+        if self._needs_compaction():
+            self.compact()
+        self._closed = False
+
+    def _replay(self, filename: str) -> int:
+        # Apply every record of the file and return the number of records
+        count = 0
+        with open(filename) as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                    if record['op'] == 'set':
+                        self._dict[record['id']] = record['document']
+                    elif record['op'] == 'del':
+                        self._dict.pop(record['id'], None)
+                    else:
+                        raise ValueError(f'unknown operation {record["op"]}')
+                except (KeyError, TypeError, ValueError) as e:
+                    # usually a partially written record following a crash
+                    logger.warning(
+                        'Ignoring invalid record at %s:%s: %s', filename, line_number, e
+                    )
+                else:
+                    count += 1
+        return count
+
+    def _truncate_partial_record(self) -> None:
+        # Remove a record partially written at the end of the log, e.g. after
+        # a crash, so that the next records are not appended to it
+        with open(self._log_filename, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            f.seek(end - 1)
+            if f.read(1) == b'\n':
+                return
+            while end > 0:
+                start = max(0, end - 4096)
+                f.seek(start)
+                index = f.read(end - start).rfind(b'\n')
+                if index != -1:
+                    f.truncate(start + index + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def _load(self) -> None:
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        start_time = time.monotonic()
+        if os.path.isfile(self._snapshot_filename):
+            self._replay(self._snapshot_filename)
+        if os.path.isfile(self._log_filename):
+            self._truncate_partial_record()
+            self._log_count = self._replay(self._log_filename)
+        logger.info(
+            'Loaded %d documents and %d log records from %s in %.3f seconds',
+            len(self._dict),
+            self._log_count,
+            self._directory,
+            time.monotonic() - start_time,
+        )
+
+    def _needs_compaction(self) -> bool:
+        if self._log_count < self._compact_threshold:
+            return False
+        return self._log_count > len(self._dict)
+
+    def _cancel_delayed_sync(self) -> None:
+        if self._delayed_sync is not None:
+            if self._delayed_sync.active():
+                self._delayed_sync.cancel()
+            self._delayed_sync = None
+
+    def sync(self) -> None:
+        """Make sure every write appended to the log is on disk."""
+        self._cancel_delayed_sync()
+        self._log_file.flush()
+        os.fsync(self._log_file.fileno())
+
+    def _schedule_sync(self) -> None:
+        if self._sync_delay <= 0:
+            self.sync()
+        elif self._delayed_sync is None:
+            self._delayed_sync = self._clock.callLater(self._sync_delay, self.sync)
+
+    def _append(self, records: Iterable[dict[str, Any]]) -> None:
+        for record in records:
+            self._log_file.write(_dumps_record(record))
+            self._log_count += 1
+        self._log_file.flush()
+        if self._needs_compaction():
+            self.compact()
+        else:
+            self._schedule_sync()
+
+    def compact(self) -> None:
+        """Write every document to a new snapshot and truncate the log."""
+        logger.debug(
+            'Compacting %d log records in %s', self._log_count, self._directory
+        )
+        tmp_filename = f'{self._snapshot_filename}.tmp'
+        with open(tmp_filename, 'w') as f:
+            for document_id, document in self._dict.items():
+                f.write(
+                    _dumps_record(
+                        {'op': 'set', 'id': document_id, 'document': document}
+                    )
+                )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self._snapshot_filename)
+        fsync_directory(self._directory)
+        # replaying the log over the new snapshot is harmless, so a crash
+        # before the log is truncated doesn't lose anything
+        self._cancel_delayed_sync()
+        self._log_file.close()
+        self._log_file = open(self._log_filename, 'w')
+        self._log_count = 0
+
+    def close(self) -> None:
+        if not self._closed:
+            self.sync()
+            self._log_file.close()
+        self._dict = {}
+        self._closed = True
+
+    def __getitem__(self, document_id: str) -> dict[str, Any]:
+        return copy_document(self._dict[document_id])
+
+    def peek(self, document_id: str) -> dict[str, Any]:
+        """Return the stored document without copying it.
+
+        The returned document is shared and MUST NOT be modified.
+
+        """
+        return self._dict[document_id]
+
+    def __setitem__(self, document_id: str, document: dict[str, Any]) -> None:
+        self._dict[document_id] = copy_document(document)
+        self._append([{'op': 'set', 'id': document_id, 'document': document}])
+
+    def set_many(self, documents: dict[str, dict[str, Any]]) -> None:
+        """Store many documents, appending them to the log at once."""
+        for document_id, document in documents.items():
+            self._dict[document_id] = copy_document(document)
+        self._append(
+            {'op': 'set', 'id': document_id, 'document': document}
+            for document_id, document in documents.items()
+        )
+
+    def __delitem__(self, document_id: str) -> None:
+        del self._dict[document_id]
+        self._append([{'op': 'del', 'id': document_id}])
+
+    def __contains__(self, document_id: str) -> bool:
+        return document_id in self._dict
+
+    def __len__(self) -> int:
+        return len(self._dict)
+
+    def values(self) -> Generator[dict[str, Any], None, None]:
+        for document in self._dict.values():
+            yield copy_document(document)
+
+    def peek_values(self) -> Iterable[dict[str, Any]]:
+        """Return the stored documents without copying them.
+
+        The returned documents are shared and MUST NOT be modified.
+
+        """
+        return self._dict.values()
+
+    def items(self) -> Generator[tuple[str, dict[str, Any]], None, None]:
+        for document_id, document in self._dict.items():
+            yield document_id, copy_document(document)
+
+
+def new_log_collection(
+    directory: str, generator: Generator[str, None, None], **kwargs: Any
+) -> SimpleBackendDocumentCollection:
+    return new_backend_based_collection(
+        LogSimpleBackend(directory, **kwargs), generator
+    )
+
+
+class LogDatabase(AbstractDatabase):
+    def __init__(
+        self,
+        base_directory: str,
+        generator_factory: GeneratorFactory,
+        sync_delay: float = DEFAULT_SYNC_DELAY,
+        compact_threshold: int = DEFAULT_COMPACT_THRESHOLD,
+    ) -> None:
+        self._base_directory = base_directory
+        self._generator_factory = generator_factory
+        self._sync_delay = sync_delay
+        self._compact_threshold = compact_threshold
+        self._collections: dict[str, SimpleBackendDocumentCollection] = {}
+        self._create_base_directory()
+
+    def _create_base_directory(self) -> None:
+        if not os.path.isdir(self._base_directory):
+            os.makedirs(self._base_directory)
+
+    def close(self) -> None:
+        for collection in self._collections.values():
+            collection.close()
+        self._collections = {}
+
+    def _new_collection(self, collection_id: str) -> SimpleBackendDocumentCollection:
+        generator = self._generator_factory()
+        directory = os.path.join(self._base_directory, collection_id)
+        try:
+            return new_log_collection(
+                directory,
+                generator,
+                sync_delay=self._sync_delay,
+                compact_threshold=self._compact_threshold,
+            )
+        except Exception as e:
+            # could not create collection
+            raise ValueError(e)
+
+    def collection(self, collection_id: str) -> SimpleBackendDocumentCollection:
+        if (
+            collection_id not in self._collections
+            or self._collections[collection_id].closed
+        ):
+            self._collections[collection_id] = self._new_collection(collection_id)
+        return self._collections[collection_id]
+
+
+class LogDatabaseFactory(AbstractDatabaseFactory):
+    @staticmethod
+    def new_database(
+        db_type: str, generator: Literal['default', 'numeric', 'uuid'], **kwargs: Any
+    ) -> LogDatabase:
+        if db_type != 'log':
+            raise ValueError(f'unrecognised type "{db_type}"')
+        try:
+            base_directory = kwargs['log_db_dir']
+        except KeyError:
+            raise ValueError(f'missing "log_db_dir" arguments in "{kwargs}"')
+        try:
+            sync_delay = float(kwargs.get('log_db_sync_delay', DEFAULT_SYNC_DELAY))
+            compact_threshold = int(
+                kwargs.get('log_db_compact_threshold', DEFAULT_COMPACT_THRESHOLD)
+            )
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'invalid log database arguments: {e}')
+
+        generator_factory = get_id_generator_factory(generator)
+        return LogDatabase(
+            base_directory, generator_factory, sync_delay, compact_threshold
+        )
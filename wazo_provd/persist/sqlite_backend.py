@@ -0,0 +1,477 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""SQLite storage of documents.
+
+Every collection is a table of (id, document) rows, where document is the
+JSON text of the document. Indexes are SQL indexes on virtual generated
+columns extracting the indexed key with the JSON1 functions.
+
+Selectors are translated to SQL when they can be matched exactly in SQL,
+i.e. for non-complex keys compared to JSON scalar values. The remaining part
+of a selector is matched in Python, in which case skip and limit are also
+applied in Python.
+
+"""
+from __future__ import annotations
+
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+from collections.abc import Collection, Generator, Iterator
+from typing import Any, Literal
+
+from twisted.internet import defer
+
+from wazo_provd.persist.common import (
+    ID_KEY,
+    AbstractDatabase,
+    AbstractDatabaseFactory,
+    AbstractDocumentCollection,
+    InvalidIdError,
+    NonDeletableError,
+)
+from wazo_provd.persist.id import GeneratorFactory, get_id_generator_factory
+from wazo_provd.persist.util import (
+    _contains_operator,
+    _create_pred_from_selector,
+    _new_fields_map_function,
+)
+
+logger = logging.getLogger(__name__)
+
+_MIN_SQLITE_VERSION = (3, 31, 0)
+
+_COLLECTION_ID_REGEX = re.compile(r'^\w+$')
+_COMPLEX_KEY_REGEX = re.compile(r'^\w+(\.\w+)*$')
+_SIMPLE_KEY_REGEX = re.compile(r'^\w+$')
+
+_NUMBER_JSON_TYPES = "('integer', 'real', 'true', 'false')"
+_RANGE_SQL_OPERATORS = {'$gt': '>', '$ge': '>=', '$lt': '<', '$le': '<='}
+_MAX_SQL_INTEGER = 2**63
+
+
+def _is_sql_number(value: Any) -> bool:
+    if isinstance(value, int):
+        return -_MAX_SQL_INTEGER <= value < _MAX_SQL_INTEGER
+    return isinstance(value, float)
+
+
+def _json_path(complex_key: str) -> str:
+    return '$' + ''.join(f'."{key}"' for key in complex_key.split('.'))
+
+
+def _index_column(complex_key: str) -> str:
+    return 'idx_' + complex_key.replace('.', '__')
+
+
+class SqliteDocumentCollection(AbstractDocumentCollection):
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        table: str,
+        generator: Generator[str, None, None],
+    ) -> None:
+        self._connection = connection
+        self._table = table
+        self._generator = generator
+        self._index_columns: dict[str, str] = {}
+        self.closed = False
+        with self._connection:
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" '
+                '(id TEXT PRIMARY KEY NOT NULL, document TEXT NOT NULL)'
+            )
+
+    def _has_column(self, column: str) -> bool:
+        rows = self._connection.execute(f'PRAGMA table_xinfo("{self._table}")')
+        return any(row[1] == column for row in rows)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def _contains(self, document_id: str) -> bool:
+        cursor = self._connection.execute(
+            f'SELECT 1 FROM "{self._table}" WHERE id = ?', (document_id,)
+        )
+        return cursor.fetchone() is not None
+
+    def _generate_new_id(self, excluded_ids: Collection[str] = ()) -> str:
+        for document_id in self._generator:
+            if document_id not in excluded_ids and not self._contains(document_id):
+                return document_id
+        raise Exception('ID generator exhausted')
+
+    def insert(self, document):
+        if ID_KEY in document:
+            document_id = document[ID_KEY]
+            if self._contains(document_id):
+                return defer.fail(InvalidIdError(document_id))
+        else:
+            document_id = self._generate_new_id()
+            document[ID_KEY] = document_id
+
+        with self._connection:
+            self._connection.execute(
+                f'INSERT INTO "{self._table}" (id, document) VALUES (?, ?)',
+                (document_id, json.dumps(document, separators=(',', ':'))),
+            )
+        return defer.succeed(document_id)
+
+    def insert_many(self, documents):
+        documents = list(documents)
+        new_ids = set()
+        for document in documents:
+            if ID_KEY in document:
+                document_id = document[ID_KEY]
+                if document_id in new_ids or self._contains(document_id):
+                    return defer.fail(InvalidIdError(document_id))
+                new_ids.add(document_id)
+
+        params = []
+        for document in documents:
+            if ID_KEY not in document:
+                document[ID_KEY] = self._generate_new_id(new_ids)
+                new_ids.add(document[ID_KEY])
+            params.append(
+                (document[ID_KEY], json.dumps(document, separators=(',', ':')))
+            )
+        with self._connection:
+            self._connection.executemany(
+                f'INSERT INTO "{self._table}" (id, document) VALUES (?, ?)', params
+            )
+        return defer.succeed([document[ID_KEY] for document in documents])
+
+    def update(self, document):
+        try:
+            document_id = document[ID_KEY]
+        except KeyError:
+            return defer.fail(
+                ValueError(f'no {ID_KEY} key found in document {document}')
+            )
+        with self._connection:
+            cursor = self._connection.execute(
+                f'UPDATE "{self._table}" SET document = ? WHERE id = ?',
+                (json.dumps(document, separators=(',', ':')), document_id),
+            )
+        if not cursor.rowcount:
+            return defer.fail(InvalidIdError(document_id))
+        return defer.succeed(None)
+
+    def update_many(self, documents):
+        params = []
+        for document in documents:
+            try:
+                document_id = document[ID_KEY]
+            except KeyError:
+                return defer.fail(
+                    ValueError(f'no {ID_KEY} key found in document {document}')
+                )
+            params.append((json.dumps(document, separators=(',', ':')), document_id))
+
+        try:
+            with self._connection:
+                for param in params:
+                    cursor = self._connection.execute(
+                        f'UPDATE "{self._table}" SET document = ? WHERE id = ?', param
+                    )
+                    if not cursor.rowcount:
+                        # rollback every update made so far
+                        raise InvalidIdError(param[1])
+        except InvalidIdError as e:
+            return defer.fail(e)
+        return defer.succeed(None)
+
+    def delete(self, document_id):
+        document = self._retrieve(document_id)
+        if document is None:
+            return defer.fail(InvalidIdError(document_id))
+        if not document.get('deletable', True):
+            return defer.fail(NonDeletableError(document_id))
+        with self._connection:
+            self._connection.execute(
+                f'DELETE FROM "{self._table}" WHERE id = ?', (document_id,)
+            )
+        return defer.succeed(None)
+
+    def _retrieve(self, document_id: str) -> dict[str, Any] | None:
+        cursor = self._connection.execute(
+            f'SELECT document FROM "{self._table}" WHERE id = ?', (document_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def retrieve(self, document_id):
+        return defer.succeed(self._retrieve(document_id))
+
+    def _value_expr(self, key: str) -> str:
+        if key in self._index_columns:
+            return f'"{self._index_columns[key]}"'
+        return f"json_extract(document, '{_json_path(key)}')"
+
+    def _type_expr(self, key: str) -> str:
+        return f"json_type(document, '{_json_path(key)}')"
+
+    def _eq_condition(self, key: str, value: Any) -> tuple[str, list] | None:
+        # Return a SQL condition matching documents for which the value of the
+        # key is equal to value, the same way Python equality would
+        if key == ID_KEY and isinstance(value, str):
+            return 'id = ?', [value]
+        if value is None:
+            return f"{self._type_expr(key)} = 'null'", []
+        if isinstance(value, str):
+            return (
+                f"({self._type_expr(key)} = 'text' AND {self._value_expr(key)} = ?)",
+                [value],
+            )
+        if _is_sql_number(value):
+            return (
+                f'({self._type_expr(key)} IN {_NUMBER_JSON_TYPES} '
+                f'AND {self._value_expr(key)} = ?)',
+                [value],
+            )
+        return None
+
+    def _in_condition(self, key: str, values: Any) -> tuple[str, list] | None:
+        if not isinstance(values, list):
+            return None
+        if not values:
+            return '0', []
+        if key == ID_KEY and all(isinstance(value, str) for value in values):
+            return f'id IN ({", ".join("?" * len(values))})', list(values)
+        conditions = []
+        params: list[Any] = []
+        for value in values:
+            condition = self._eq_condition(key, value)
+            if condition is None:
+                return None
+            conditions.append(condition[0])
+            params.extend(condition[1])
+        return f'({" OR ".join(conditions)})', params
+
+    def _range_condition(
+        self, key: str, operator: str, value: Any
+    ) -> tuple[str, list] | None:
+        sql_operator = _RANGE_SQL_OPERATORS[operator]
+        if isinstance(value, str):
+            json_types = "('text')"
+        elif _is_sql_number(value):
+            json_types = _NUMBER_JSON_TYPES
+        else:
+            return None
+        return (
+            f'({self._type_expr(key)} IN {json_types} '
+            f'AND {self._value_expr(key)} {sql_operator} ?)',
+            [value],
+        )
+
+    def _operator_condition(
+        self, key: str, operator: str, value: Any
+    ) -> tuple[str, list] | None:
+        if operator == '$in':
+            return self._in_condition(key, value)
+        if operator in ('$ne', '$nin'):
+            if operator == '$ne':
+                condition = self._eq_condition(key, value)
+            else:
+                condition = self._in_condition(key, value)
+            if condition is None:
+                return None
+            # documents without the key must match
+            return f'NOT COALESCE({condition[0]}, 0)', condition[1]
+        if operator == '$exists':
+            if value:
+                return f'{self._type_expr(key)} IS NOT NULL', []
+            return f'{self._type_expr(key)} IS NULL', []
+        if operator in _RANGE_SQL_OPERATORS:
+            return self._range_condition(key, operator, value)
+        return None
+
+    def _key_condition(self, key: str, s_value: Any) -> tuple[str, list] | None:
+        # Return a SQL condition exactly matching the same documents as the
+        # selector key and value, or None if it can't be expressed in SQL
+        if not _SIMPLE_KEY_REGEX.match(key):
+            return None
+        if not _contains_operator(s_value):
+            return self._eq_condition(key, s_value)
+        conditions = []
+        params: list[Any] = []
+        for operator, value in s_value.items():
+            condition = self._operator_condition(key, operator, value)
+            if condition is None:
+                return None
+            conditions.append(condition[0])
+            params.extend(condition[1])
+        return ' AND '.join(conditions), params
+
+    def _sort_expr(self, key: str) -> str:
+        # Same order as wazo_provd.persist.util._new_key_fun_from_key, i.e.
+        # the string value, with missing and null values sorted as ''
+        if not _COMPLEX_KEY_REGEX.match(key):
+            return "''"
+        return (
+            f"COALESCE(CASE {self._type_expr(key)} WHEN 'true' THEN 'True' "
+            "WHEN 'false' THEN 'False' WHEN 'null' THEN '' "
+            f"ELSE CAST({self._value_expr(key)} AS TEXT) END, '')"
+        )
+
+    def _new_sql_query(self, selector, skip, limit, sort):
+        # Return a tuple (sql, params, regular_selector), where
+        # regular_selector is the part of the selector that must still be
+        # matched in Python.
+        conditions = []
+        params: list[Any] = []
+        regular_selector = {}
+        for s_key, s_value in selector.items():
+            condition = self._key_condition(s_key, s_value)
+            if condition is None:
+                regular_selector[s_key] = s_value
+            else:
+                conditions.append(condition[0])
+                params.extend(condition[1])
+
+        sql = f'SELECT document FROM "{self._table}"'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(f'({c})' for c in conditions)
+        if sort:
+            key, direction = sort
+            if direction not in (1, -1):
+                raise Exception(f'invalid direction {direction}')
+            order = 'ASC' if direction == 1 else 'DESC'
+            sql += f' ORDER BY {self._sort_expr(key)} {order}, id {order}'
+        if not regular_selector and (skip or limit):
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([limit or -1, skip])
+        return sql, params, regular_selector
+
+    def _do_find(self, selector, fields, skip, limit, sort) -> Iterator[dict]:
+        sql, params, regular_selector = self._new_sql_query(selector, skip, limit, sort)
+        logger.debug('Executing SQL query %s with %s', sql, params)
+        # the rows are fetched at once, so that the result is not affected by
+        # later writes, but each document is only decoded once iterated over
+        rows = self._connection.execute(sql, params).fetchall()
+        documents: Iterator[dict] = (json.loads(row[0]) for row in rows)
+        if regular_selector:
+            documents = filter(_create_pred_from_selector(regular_selector), documents)
+            stop = skip + limit if limit else None
+            documents = itertools.islice(documents, skip, stop)
+        return map(_new_fields_map_function(fields), documents)
+
+    def find(self, selector, fields=None, skip=0, limit=0, sort=None):
+        logger.debug(
+            'Executing find in SQLite collection %s with:\n'
+            '  selector: %s\n'
+            '  fields: %s\n'
+            '  skip: %s\n'
+            '  limit: %s\n'
+            '  sort: %s',
+            self._table,
+            selector,
+            fields,
+            skip,
+            limit,
+            sort,
+        )
+        return defer.succeed(self._do_find(selector, fields, skip, limit, sort))
+
+    def find_one(self, selector):
+        it = self._do_find(selector, None, 0, 1, None)
+        try:
+            result = next(it)
+        except StopIteration:
+            result = None
+        return defer.succeed(result)
+
+    def ensure_index(self, complex_key: str):
+        if complex_key in self._index_columns:
+            return defer.succeed(None)
+        if not _COMPLEX_KEY_REGEX.match(complex_key):
+            return defer.fail(ValueError(f'invalid index key "{complex_key}"'))
+
+        logger.info('Creating index on complex key %s', complex_key)
+        column = _index_column(complex_key)
+        with self._connection:
+            if not self._has_column(column):
+                self._connection.execute(
+                    f'ALTER TABLE "{self._table}" ADD COLUMN "{column}" '
+                    'GENERATED ALWAYS AS '
+                    f"(json_extract(document, '{_json_path(complex_key)}')) VIRTUAL"
+                )
+            self._connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{self._table}_{column}" '
+                f'ON "{self._table}" ("{column}")'
+            )
+        self._index_columns[complex_key] = column
+        return defer.succeed(None)
+
+
+class SqliteDatabase(AbstractDatabase):
+    def __init__(self, filename: str, generator_factory: GeneratorFactory) -> None:
+        self._filename = filename
+        self._generator_factory = generator_factory
+        self._collections: dict[str, SqliteDocumentCollection] = {}
+        self._connection = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self._filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        connection = sqlite3.connect(self._filename)
+        try:
+            connection.execute("SELECT json_extract('{}', '$.a')")
+        except sqlite3.OperationalError:
+            connection.close()
+            raise ValueError('the SQLite JSON1 functions are not available')
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def close(self) -> None:
+        for collection in self._collections.values():
+            collection.close()
+        self._collections = {}
+        self._connection.close()
+
+    def _new_collection(self, collection_id: str) -> SqliteDocumentCollection:
+        if not _COLLECTION_ID_REGEX.match(collection_id):
+            raise ValueError(f'invalid collection id "{collection_id}"')
+        generator = self._generator_factory()
+        try:
+            return SqliteDocumentCollection(self._connection, collection_id, generator)
+        except sqlite3.Error as e:
+            # could not create collection
+            raise ValueError(e)
+
+    def collection(self, collection_id: str) -> SqliteDocumentCollection:
+        if (
+            collection_id not in self._collections
+            or self._collections[collection_id].closed
+        ):
+            self._collections[collection_id] = self._new_collection(collection_id)
+        return self._collections[collection_id]
+
+
+class SqliteDatabaseFactory(AbstractDatabaseFactory):
+    @staticmethod
+    def new_database(
+        db_type: str, generator: Literal['default', 'numeric', 'uuid'], **kwargs: Any
+    ) -> SqliteDatabase:
+        if db_type != 'sqlite':
+            raise ValueError(f'unrecognised type "{db_type}"')
+        if sqlite3.sqlite_version_info < _MIN_SQLITE_VERSION:
+            raise ValueError(
+                f'SQLite {sqlite3.sqlite_version} is too old, generated columns '
+                f'require SQLite {".".join(map(str, _MIN_SQLITE_VERSION))}'
+            )
+        try:
+            filename = kwargs['sqlite_db_file']
+        except KeyError:
+            raise ValueError(f'missing "sqlite_db_file" arguments in "{kwargs}"')
+
+        generator_factory = get_id_generator_factory(generator)
+        return SqliteDatabase(filename, generator_factory)
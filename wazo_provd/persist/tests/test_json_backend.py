@@ -0,0 +1,273 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any
+from unittest.mock import patch
+
+from twisted.internet import defer
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from wazo_provd.persist.common import COMMON_INDEXES
+from wazo_provd.persist.id import numeric_id_generator
+from wazo_provd.persist.json_backend import (
+    JsonDatabaseFactory,
+    JsonSimpleBackend,
+    new_json_collection,
+)
+from wazo_provd.persist.util import copy_document
+
+
+def _result(deferred: Deferred) -> Any:
+    results: list[Any] = []
+    deferred.addCallback(results.append)
+    return results[0]
+
+
+class TestCopyDocument(unittest.TestCase):
+    def test_copy_document(self) -> None:
+        document: dict[str, Any] = {
+            'id': 'd1',
+            'a': [1, {'b': None}],
+            'c': {'d': 1.5, 'e': True},
+        }
+
+        result = copy_document(document)
+
+        self.assertEqual(document, result)
+        self.assertIsNot(document['a'], result['a'])
+        self.assertIsNot(document['a'][1], result['a'][1])
+        self.assertIsNot(document['c'], result['c'])
+
+
+class TestJsonSimpleBackend(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join(tempfile.mkdtemp(), 'devices')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def test_stored_document_is_isolated_from_caller(self) -> None:
+        backend = JsonSimpleBackend(self.directory)
+        document: dict[str, Any] = {'id': 'd1', 'options': {'switchboard': False}}
+        backend['d1'] = document
+
+        document['options']['switchboard'] = True
+        backend['d1']['options']['switchboard'] = True
+
+        self.assertEqual({'switchboard': False}, backend.peek('d1')['options'])
+
+    def test_documents_are_reloaded(self) -> None:
+        backend = JsonSimpleBackend(self.directory)
+        backend['d1'] = {'id': 'd1', 'mac': '00:11:22:33:44:55'}
+        backend['d2'] = {'id': 'd2'}
+        del backend['d2']
+
+        backend = JsonSimpleBackend(self.directory)
+
+        self.assertEqual({'id': 'd1', 'mac': '00:11:22:33:44:55'}, backend['d1'])
+        self.assertFalse('d2' in backend)
+
+    def test_load_calls_listener_with_every_document(self) -> None:
+        backend = JsonSimpleBackend(self.directory)
+        backend['d1'] = {'id': 'd1'}
+        backend['d2'] = {'id': 'd2'}
+        with open(os.path.join(self.directory, 'd3'), 'w') as f:
+            f.write('{"id": "d3", "ma')
+        loaded: list[dict[str, Any]] = []
+
+        backend = JsonSimpleBackend(self.directory, autoload=False)
+        backend.load(loaded.append)
+
+        self.assertEqual([{'id': 'd1'}, {'id': 'd2'}], sorted(loaded, key=str))
+        self.assertEqual(2, len(backend))
+
+    def test_temporary_files_are_removed(self) -> None:
+        backend = JsonSimpleBackend(self.directory)
+        backend['d1'] = {'id': 'd1'}
+        backend['.d2.tmp'] = {'id': '.d2.tmp'}
+        tmp_directory = f'{self.directory}.tmp'
+        with open(os.path.join(tmp_directory, 'd1'), 'w') as f:
+            f.write('{"id": "d1", "ma')
+
+        backend = JsonSimpleBackend(self.directory)
+
+        self.assertEqual({'id': 'd1'}, backend['d1'])
+        self.assertEqual({'id': '.d2.tmp'}, backend['.d2.tmp'])
+        self.assertEqual([], os.listdir(tmp_directory))
+
+    def test_immediate_writes_are_synced(self) -> None:
+        backend = JsonSimpleBackend(self.directory)
+        with patch(
+            'wazo_provd.persist.json_backend.fsync_directory'
+        ) as fsync_directory, patch(
+            'wazo_provd.persist.json_backend.os.fsync'
+        ) as fsync:
+            backend['d1'] = {'id': 'd1'}
+
+        fsync.assert_called_once()
+        fsync_directory.assert_called_once_with(self.directory)
+        self.assertEqual({'id': 'd1'}, JsonSimpleBackend(self.directory)['d1'])
+
+    def test_writes_are_batched(self) -> None:
+        clock = Clock()
+        backend = JsonSimpleBackend(self.directory, flush_delay=1.0, clock=clock)
+        backend['d1'] = {'id': 'd1'}
+        backend['d2'] = {'id': 'd2'}
+        backend['d1'] = {'id': 'd1', 'ip': '10.0.0.1'}
+        del backend['d2']
+
+        self.assertEqual([], os.listdir(self.directory))
+
+        clock.advance(1.0)
+
+        self.assertEqual(['d1'], os.listdir(self.directory))
+        self.assertEqual(
+            {'id': 'd1', 'ip': '10.0.0.1'}, JsonSimpleBackend(self.directory)['d1']
+        )
+
+    def test_batched_writes_are_synced_at_once(self) -> None:
+        clock = Clock()
+        backend = JsonSimpleBackend(self.directory, flush_delay=1.0, clock=clock)
+        backend.set_many({'d1': {'id': 'd1'}, 'd2': {'id': 'd2'}})
+        with patch(
+            'wazo_provd.persist.json_backend.fsync_directory'
+        ) as fsync_directory:
+            clock.advance(1.0)
+
+        fsync_directory.assert_called_once_with(self.directory)
+        self.assertEqual(['d1', 'd2'], sorted(os.listdir(self.directory)))
+
+    def test_pending_writes_are_flushed_on_close(self) -> None:
+        backend = JsonSimpleBackend(self.directory, flush_delay=1.0, clock=Clock())
+        backend['d1'] = {'id': 'd1'}
+
+        backend.close()
+
+        self.assertEqual({'id': 'd1'}, JsonSimpleBackend(self.directory)['d1'])
+
+    @patch('wazo_provd.persist.json_backend.threads')
+    def test_writes_are_flushed_in_thread(self, threads) -> None:
+        pending: list[Deferred] = []
+
+        def defer_to_thread(f, *args):
+            d = defer.maybeDeferred(f, *args)
+            pending.append(d)
+            return d
+
+        threads.deferToThread.side_effect = defer_to_thread
+        clock = Clock()
+        backend = JsonSimpleBackend(
+            self.directory, flush_delay=1.0, flush_in_thread=True, clock=clock
+        )
+        backend['d1'] = {'id': 'd1'}
+
+        clock.advance(1.0)
+
+        self.assertEqual(1, len(pending))
+        self.assertEqual(['d1'], os.listdir(self.directory))
+
+        backend['d2'] = {'id': 'd2'}
+        clock.advance(1.0)
+
+        self.assertEqual(2, len(pending))
+        self.assertEqual(['d1', 'd2'], sorted(os.listdir(self.directory)))
+
+    @patch('wazo_provd.persist.json_backend.threads')
+    def test_close_supersedes_flush_in_thread(self, threads) -> None:
+        pending: list[tuple] = []
+
+        def defer_to_thread(f, *args):
+            # the thread only runs once the backend is closed
+            pending.append((f, args))
+            return Deferred()
+
+        threads.deferToThread.side_effect = defer_to_thread
+        clock = Clock()
+        backend = JsonSimpleBackend(
+            self.directory, flush_delay=1.0, flush_in_thread=True, clock=clock
+        )
+        backend['d1'] = {'id': 'd1'}
+        clock.advance(1.0)
+        backend['d1'] = {'id': 'd1', 'ip': '10.0.0.1'}
+
+        backend.close()
+        f, args = pending[0]
+        f(*args)
+
+        self.assertEqual(
+            {'id': 'd1', 'ip': '10.0.0.1'}, JsonSimpleBackend(self.directory)['d1']
+        )
+
+
+class TestJsonCollection(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = os.path.join(tempfile.mkdtemp(), 'devices')
+        self.collection = new_json_collection(self.directory, numeric_id_generator())
+        self.collection.ensure_index('mac')
+        self.collection.insert({'id': 'd1', 'mac': '00:11:22:33:44:55', 'x': [1]})
+        self.collection.insert({'id': 'd2', 'mac': '00:11:22:33:44:66', 'x': [2]})
+
+    def tearDown(self) -> None:
+        self.collection.close()
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def test_found_documents_are_copies(self) -> None:
+        (document,) = _result(self.collection.find({'x': [1]}))
+        document['x'].append(3)
+        document['mac'] = '00:11:22:33:44:77'
+
+        (document,) = _result(self.collection.find({'mac': '00:11:22:33:44:55'}))
+        self.assertEqual([1], document['x'])
+
+    def test_found_documents_with_fields_are_copies(self) -> None:
+        (document,) = _result(self.collection.find({'id': 'd2'}, fields=['x']))
+        document['x'].append(3)
+
+        self.assertEqual([2], _result(self.collection.retrieve('d2'))['x'])
+
+    def test_indexes_are_created_on_load(self) -> None:
+        self.collection.close()
+        collection = new_json_collection(
+            self.directory, numeric_id_generator(), index_keys=['mac']
+        )
+
+        self.assertEqual(
+            {'index': 'mac', 'indexes': ['mac'], 'candidates': 1, 'filter': []},
+            _result(collection.explain({'mac': '00:11:22:33:44:66'})),
+        )
+        (document,) = _result(collection.find({'x': [2]}))
+        self.assertEqual('d2', document['id'])
+        self.assertEqual(
+            ['d2', 'd1'],
+            [d['id'] for d in _result(collection.find({}, sort=('mac', -1)))],
+        )
+
+
+class TestJsonDatabaseFactory(unittest.TestCase):
+    def test_invalid_flush_delay(self) -> None:
+        self.assertRaises(
+            ValueError,
+            JsonDatabaseFactory.new_database,
+            'json',
+            'default',
+            json_db_dir='jsondb',
+            json_db_flush_delay='soon',
+        )
+
+    def test_common_indexes(self) -> None:
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database = JsonDatabaseFactory.new_database(
+            'json', 'default', json_db_dir=directory, ensure_common_indexes=True
+        )
+
+        collection = database.collection('devices')
+
+        self.assertEqual(list(COMMON_INDEXES['devices']), list(collection._indexes))
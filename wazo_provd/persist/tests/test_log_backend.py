@@ -0,0 +1,124 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from twisted.internet.task import Clock
+
+from wazo_provd.persist.log_backend import (
+    LOG_FILENAME,
+    SNAPSHOT_FILENAME,
+    LogDatabaseFactory,
+    LogSimpleBackend,
+)
+
+
+class TestLogSimpleBackend(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.clock = Clock()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def _new_backend(self, **kwargs) -> LogSimpleBackend:
+        return LogSimpleBackend(self.directory, clock=self.clock, **kwargs)
+
+    def _read_lines(self, filename: str) -> list[str]:
+        with open(os.path.join(self.directory, filename)) as f:
+            return f.readlines()
+
+    def test_documents_are_reloaded(self) -> None:
+        backend = self._new_backend()
+        backend['d1'] = {'id': 'd1', 'mac': '00:11:22:33:44:55'}
+        backend['d2'] = {'id': 'd2'}
+        backend['d1'] = {'id': 'd1', 'ip': '10.0.0.1'}
+        del backend['d2']
+        backend.close()
+
+        backend = self._new_backend()
+
+        self.assertEqual({'id': 'd1', 'ip': '10.0.0.1'}, backend['d1'])
+        self.assertFalse('d2' in backend)
+        self.assertEqual(1, len(backend))
+
+    def test_writes_are_appended_to_the_log(self) -> None:
+        backend = self._new_backend()
+        backend['d1'] = {'id': 'd1'}
+        del backend['d1']
+
+        self.assertEqual(2, len(self._read_lines(LOG_FILENAME)))
+
+    def test_partial_record_is_ignored(self) -> None:
+        backend = self._new_backend()
+        backend['d1'] = {'id': 'd1'}
+        backend.close()
+        with open(os.path.join(self.directory, LOG_FILENAME), 'a') as f:
+            f.write('{"op":"set","id":"d2","docu')
+
+        backend = self._new_backend()
+        backend['d3'] = {'id': 'd3'}
+        backend.close()
+        backend = self._new_backend()
+
+        self.assertTrue('d1' in backend)
+        self.assertFalse('d2' in backend)
+        self.assertTrue('d3' in backend)
+
+    def test_log_is_compacted(self) -> None:
+        backend = self._new_backend(compact_threshold=3)
+        backend['d1'] = {'id': 'd1'}
+        backend['d1'] = {'id': 'd1', 'ip': '10.0.0.1'}
+        backend['d2'] = {'id': 'd2'}
+
+        self.assertEqual([], self._read_lines(LOG_FILENAME))
+        self.assertEqual(2, len(self._read_lines(SNAPSHOT_FILENAME)))
+
+        backend.close()
+        backend = self._new_backend()
+        self.assertEqual({'id': 'd1', 'ip': '10.0.0.1'}, backend['d1'])
+        self.assertTrue('d2' in backend)
+
+    def test_syncs_are_batched(self) -> None:
+        backend = self._new_backend(sync_delay=1.0)
+        with patch('wazo_provd.persist.log_backend.os.fsync') as fsync:
+            backend['d1'] = {'id': 'd1'}
+            backend['d2'] = {'id': 'd2'}
+            fsync.assert_not_called()
+
+            self.clock.advance(1.0)
+
+            fsync.assert_called_once()
+
+    def test_sync_after_every_write(self) -> None:
+        backend = self._new_backend(sync_delay=0)
+        with patch('wazo_provd.persist.log_backend.os.fsync') as fsync:
+            backend['d1'] = {'id': 'd1'}
+            backend['d2'] = {'id': 'd2'}
+
+            self.assertEqual(2, fsync.call_count)
+
+    def test_set_many_syncs_once(self) -> None:
+        backend = self._new_backend(sync_delay=0)
+        with patch('wazo_provd.persist.log_backend.os.fsync') as fsync:
+            backend.set_many({'d1': {'id': 'd1'}, 'd2': {'id': 'd2'}})
+
+            fsync.assert_called_once()
+        self.assertEqual(2, len(self._read_lines(LOG_FILENAME)))
+        self.assertEqual({'id': 'd2'}, backend['d2'])
+
+
+class TestLogDatabaseFactory(unittest.TestCase):
+    def test_new_database_invalid_type(self) -> None:
+        self.assertRaises(
+            ValueError, LogDatabaseFactory.new_database, 'json', 'default'
+        )
+
+    def test_new_database_missing_directory(self) -> None:
+        self.assertRaises(ValueError, LogDatabaseFactory.new_database, 'log', 'default')
@@ -5,8 +5,15 @@ from __future__ import annotations
 
 import unittest
 from typing import Any
+from unittest.mock import patch
 
+from twisted.internet.defer import Deferred
+
+from wazo_provd.persist.common import InvalidIdError
+from wazo_provd.persist.id import numeric_id_generator
 from wazo_provd.persist.util import (
+    SimpleBackendDocumentCollection,
+    _compile_selector_shape,
     _create_pred_from_selector,
     _new_key_fun_from_key,
     _retrieve_doc_values,
@@ -95,6 +102,260 @@ class TestSelectorCreatePredicate(unittest.TestCase):
         self.assertFalse(pred({'k': [{'kk': 'v1'}]}))
         self.assertFalse(pred({'k': []}))
 
+    def test_in_operator(self) -> None:
+        pred = _create_pred_from_selector({'k': {'$in': ['v1', 'v2']}})
+        self.assertTrue(pred({'k': 'v1'}))
+        self.assertTrue(pred({'k': 'v2'}))
+        self.assertFalse(pred({'k': 'v3'}))
+        self.assertFalse(pred({'k': ['v1']}))
+        self.assertFalse(pred({}))
+
+    def test_in_operator_unhashable_values(self) -> None:
+        pred = _create_pred_from_selector({'k': {'$in': [['v1'], 'v2']}})
+        self.assertTrue(pred({'k': ['v1']}))
+        self.assertTrue(pred({'k': 'v2'}))
+        self.assertFalse(pred({'k': {'v1': 1}}))
+
+    def test_nin_operator(self) -> None:
+        pred = _create_pred_from_selector({'k': {'$nin': ['v1', 'v2']}})
+        self.assertFalse(pred({'k': 'v1'}))
+        self.assertTrue(pred({'k': 'v3'}))
+        self.assertTrue(pred({'k': ['v1']}))
+        self.assertTrue(pred({}))
+
+    def test_multiple_operators(self) -> None:
+        pred = _create_pred_from_selector({'k': {'$exists': True, '$ne': 'v1'}})
+        self.assertTrue(pred({'k': 'v2'}))
+        self.assertFalse(pred({'k': 'v1'}))
+        self.assertFalse(pred({}))
+
+    def test_invalid_operator(self) -> None:
+        self.assertRaises(ValueError, _create_pred_from_selector, {'k': {'$foo': 1}})
+
+    def test_same_shape_reuse_plan(self) -> None:
+        _create_pred_from_selector({'k': 'v1', 'kk': {'$in': ['v1']}})
+        hits = _compile_selector_shape.cache_info().hits
+
+        pred = _create_pred_from_selector({'k': 'v2', 'kk': {'$in': ['v2']}})
+
+        self.assertEqual(hits + 1, _compile_selector_shape.cache_info().hits)
+        self.assertTrue(pred({'k': 'v2', 'kk': 'v2'}))
+        self.assertFalse(pred({'k': 'v1', 'kk': 'v1'}))
+
+
+class _DictBackend(dict):
+    def peek(self, document_id: str) -> dict[str, Any]:
+        return self[document_id]
+
+    def peek_values(self) -> Any:
+        return self.values()
+
+
+def _result(deferred: Deferred) -> Any:
+    results: list[Any] = []
+    deferred.addCallback(results.append)
+    return results[0]
+
+
+class TestSimpleBackendDocumentCollection(unittest.TestCase):
+    def setUp(self) -> None:
+        self.collection = SimpleBackendDocumentCollection(
+            _DictBackend(), numeric_id_generator()
+        )
+        self.collection.ensure_index('ip')
+        self.collection.ensure_index('config')
+        for document in [
+            {'id': 'd1', 'ip': '10.0.0.1', 'config': 'c1'},
+            {'id': 'd2', 'ip': '10.0.0.2', 'config': 'c1'},
+            {'id': 'd3', 'ip': '10.0.0.2', 'config': 'c2'},
+            {'id': 'd4', 'config': 'c3', 'plugin': 'p1'},
+        ]:
+            self.collection.insert(document)
+
+    def _find_ids(self, selector: dict) -> set[str]:
+        return {document['id'] for document in _result(self.collection.find(selector))}
+
+    def test_find_eq(self) -> None:
+        self.assertEqual({'d2', 'd3'}, self._find_ids({'ip': '10.0.0.2'}))
+        self.assertEqual({'d1'}, self._find_ids({'id': 'd1'}))
+        self.assertEqual(set(), self._find_ids({'id': 'unknown'}))
+
+    def test_find_in(self) -> None:
+        selector = {'config': {'$in': ['c1', 'c3']}}
+
+        self.assertEqual({'d1', 'd2', 'd4'}, self._find_ids(selector))
+        explanation = _result(self.collection.explain(selector))
+        self.assertEqual('config', explanation['index'])
+        self.assertEqual(3, explanation['candidates'])
+
+    def test_find_ne_with_positive_lookup(self) -> None:
+        selector = {'ip': '10.0.0.2', 'id': {'$ne': 'd2'}}
+
+        self.assertEqual({'d3'}, self._find_ids(selector))
+        explanation = _result(self.collection.explain(selector))
+        self.assertEqual(['ip', 'id'], explanation['indexes'])
+        self.assertEqual(1, explanation['candidates'])
+        self.assertEqual([], explanation['filter'])
+
+    def test_find_only_negative_lookup_does_a_full_scan(self) -> None:
+        selector = {'config': {'$nin': ['c1']}}
+
+        self.assertEqual({'d3', 'd4'}, self._find_ids(selector))
+        explanation = _result(self.collection.explain(selector))
+        self.assertIsNone(explanation['index'])
+        self.assertEqual(4, explanation['candidates'])
+        self.assertEqual(['config'], explanation['filter'])
+
+    def test_find_range(self) -> None:
+        selector = {'ip': {'$gt': '10.0.0.1'}}
+
+        self.assertEqual({'d2', 'd3'}, self._find_ids(selector))
+        self.assertEqual('ip', _result(self.collection.explain(selector))['index'])
+
+    def test_find_picks_most_selective_index(self) -> None:
+        selector = {'ip': '10.0.0.2', 'config': 'c2', 'plugin': {'$exists': False}}
+
+        self.assertEqual({'d3'}, self._find_ids(selector))
+        explanation = _result(self.collection.explain(selector))
+        self.assertEqual('config', explanation['index'])
+        self.assertEqual(1, explanation['candidates'])
+        self.assertEqual(['plugin'], explanation['filter'])
+
+    def _find_sorted_ids(self, selector: dict, **kwargs: Any) -> list[str]:
+        documents = _result(self.collection.find(selector, **kwargs))
+        return [document['id'] for document in documents]
+
+    def test_find_sorted_on_ordered_index(self) -> None:
+        self.assertEqual(
+            ['d4', 'd1', 'd2', 'd3'], self._find_sorted_ids({}, sort=('ip', 1))
+        )
+        self.assertEqual(
+            ['d3', 'd2', 'd1', 'd4'], self._find_sorted_ids({}, sort=('ip', -1))
+        )
+
+    def test_find_sorted_on_ordered_index_with_skip_and_limit(self) -> None:
+        ids = self._find_sorted_ids({}, sort=('ip', 1), skip=1, limit=2)
+        self.assertEqual(['d1', 'd2'], ids)
+
+        ids = self._find_sorted_ids(
+            {'plugin': {'$exists': False}}, sort=('ip', -1), skip=1, limit=1
+        )
+        self.assertEqual(['d2'], ids)
+
+        ids = self._find_sorted_ids({'config': 'c1'}, sort=('ip', -1), limit=1)
+        self.assertEqual(['d2'], ids)
+
+    def test_find_sorted_after_update_and_delete(self) -> None:
+        self.collection.update({'id': 'd1', 'ip': '10.0.0.9', 'config': 'c1'})
+        self.collection.delete('d3')
+
+        ids = self._find_sorted_ids({}, sort=('ip', 1))
+
+        self.assertEqual(['d4', 'd2', 'd1'], ids)
+
+    def test_find_sorted_without_ordered_index_with_limit(self) -> None:
+        ids = self._find_sorted_ids({}, sort=('plugin', -1), limit=2)
+
+        self.assertEqual(['d4', 'd1'], ids)
+
+    def _assert_find_not_affected_by_later_writes(self, **kwargs: Any) -> None:
+        documents = _result(self.collection.find({'config': 'c1'}, **kwargs))
+        self.collection.update({'id': 'd1', 'ip': '10.0.0.9', 'config': 'c2'})
+        self.collection.delete('d2')
+
+        self.assertEqual(
+            [
+                {'id': 'd1', 'ip': '10.0.0.1', 'config': 'c1'},
+                {'id': 'd2', 'ip': '10.0.0.2', 'config': 'c1'},
+            ],
+            sorted(documents, key=lambda document: document['id']),
+        )
+
+    def test_find_is_not_affected_by_later_writes(self) -> None:
+        self._assert_find_not_affected_by_later_writes()
+
+    def test_find_sorted_is_not_affected_by_later_writes(self) -> None:
+        self._assert_find_not_affected_by_later_writes(sort=('ip', 1))
+
+    def test_index_entries_after_update_and_delete(self) -> None:
+        self.collection.update({'id': 'd1', 'ip': '10.0.0.2', 'config': 'c2'})
+        self.collection.delete('d2')
+
+        self.assertEqual({'d1', 'd3'}, self.collection._indexes['ip']['10.0.0.2'])
+        self.assertEqual({'d1', 'd3'}, self.collection._indexes['config']['c2'])
+        self.assertNotIn('c1', self.collection._indexes['config'])
+        self.assertNotIn('10.0.0.1', self.collection._indexes['ip'])
+
+    def test_update_only_touches_indexes_whose_value_changed(self) -> None:
+        with patch.object(
+            self.collection,
+            '_del_value_for_index',
+            wraps=self.collection._del_value_for_index,
+        ) as del_value_for_index:
+            self.collection.update({'id': 'd1', 'ip': '10.0.0.1', 'config': 'c2'})
+
+        del_value_for_index.assert_called_once_with(
+            self.collection._indexes['config'], 'd1', 'c1'
+        )
+        self.assertEqual({'d1', 'd3'}, self._find_ids({'config': 'c2'}))
+        self.assertEqual({'d1'}, self._find_ids({'ip': '10.0.0.1'}))
+
+    def test_update_many(self) -> None:
+        _result(
+            self.collection.update_many(
+                [
+                    {'id': 'd1', 'ip': '10.0.0.3', 'config': 'c1'},
+                    {'id': 'd2', 'ip': '10.0.0.3', 'config': 'c3'},
+                ]
+            )
+        )
+
+        self.assertEqual({'d1', 'd2'}, self._find_ids({'ip': '10.0.0.3'}))
+        self.assertEqual({'d2', 'd4'}, self._find_ids({'config': 'c3'}))
+
+    def test_update_many_unknown_id_updates_nothing(self) -> None:
+        results: list[Any] = []
+        self.collection.update_many(
+            [{'id': 'd1', 'ip': '10.0.0.3'}, {'id': 'unknown'}]
+        ).addErrback(results.append)
+
+        results[0].trap(InvalidIdError)
+        self.assertEqual({'d1'}, self._find_ids({'ip': '10.0.0.1'}))
+
+    def test_insert_many(self) -> None:
+        ids = _result(
+            self.collection.insert_many(
+                [{'id': 'd5', 'ip': '10.0.0.5'}, {'ip': '10.0.0.5', 'config': 'c1'}]
+            )
+        )
+
+        self.assertEqual(2, len(ids))
+        self.assertEqual('d5', ids[0])
+        self.assertEqual(set(ids), self._find_ids({'ip': '10.0.0.5'}))
+        self.assertEqual({'d1', 'd2', ids[1]}, self._find_ids({'config': 'c1'}))
+
+    def test_insert_many_existing_id_inserts_nothing(self) -> None:
+        results: list[Any] = []
+        self.collection.insert_many(
+            [{'id': 'd5', 'ip': '10.0.0.5'}, {'id': 'd1'}]
+        ).addErrback(results.append)
+
+        results[0].trap(InvalidIdError)
+        self.assertEqual(set(), self._find_ids({'ip': '10.0.0.5'}))
+
+    def test_unhashable_values_are_not_indexed(self) -> None:
+        self.collection.insert({'id': 'd5', 'ip': ['10.0.0.1'], 'config': {}})
+        self.collection.delete('d5')
+
+        self.assertEqual({'d1'}, self._find_ids({'ip': '10.0.0.1'}))
+        self.assertEqual(set(), self._find_ids({'ip': ['10.0.0.1']}))
+
+    def test_find_does_not_modify_index_entries(self) -> None:
+        self._find_ids({'config': 'c1', 'ip': {'$ne': '10.0.0.1'}})
+        self._find_ids({'config': 'c1', 'ip': '10.0.0.2'})
+
+        self.assertEqual({'d1', 'd2'}, self.collection._indexes['config']['c1'])
+
 
 class TestUtil(unittest.TestCase):
     def test_new_key_fun_from_key_field_exists(self) -> None:
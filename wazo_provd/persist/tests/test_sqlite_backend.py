@@ -0,0 +1,200 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import unittest
+from typing import Any
+
+from twisted.internet.defer import Deferred
+
+from wazo_provd.persist.common import InvalidIdError, NonDeletableError
+from wazo_provd.persist.id import get_id_generator_factory
+from wazo_provd.persist.sqlite_backend import SqliteDatabase, SqliteDatabaseFactory
+
+
+def _result(deferred: Deferred) -> Any:
+    results: list[Any] = []
+    deferred.addBoth(results.append)
+    return results[0]
+
+
+class TestSqliteDocumentCollection(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'provd.sqlite')
+        self.database = self._new_database()
+        self.collection = self.database.collection('devices')
+        for document in [
+            {'id': 'd1', 'mac': '00:00:00:00:00:01', 'n': 1, 'plugin': 'p2'},
+            {'id': 'd2', 'mac': '00:00:00:00:00:02', 'n': 2, 'plugin': 'p1'},
+            {'id': 'd3', 'n': 3, 'plugin': 'p1', 'deletable': False},
+            {'id': 'd4', 'n': '4', 'c': {'k': 'v'}, 'l': [1, 2]},
+        ]:
+            _result(self.collection.insert(document))
+
+    def tearDown(self) -> None:
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def _new_database(self) -> SqliteDatabase:
+        return SqliteDatabase(self.filename, get_id_generator_factory('numeric'))
+
+    def _find_ids(self, selector, **kwargs) -> list[str]:
+        documents = _result(self.collection.find(selector, **kwargs))
+        return [document['id'] for document in documents]
+
+    def test_insert_and_retrieve(self) -> None:
+        document_id = _result(self.collection.insert({'mac': 'ab'}))
+
+        self.assertEqual(
+            {'id': document_id, 'mac': 'ab'},
+            _result(self.collection.retrieve(document_id)),
+        )
+        self.assertIsNone(_result(self.collection.retrieve('unknown')))
+
+    def test_insert_existing_id(self) -> None:
+        failure = _result(self.collection.insert({'id': 'd1'}))
+
+        self.assertIsInstance(failure.value, InvalidIdError)
+        failure.trap(InvalidIdError)
+
+    def test_insert_many(self) -> None:
+        ids = _result(self.collection.insert_many([{'id': 'd5', 'n': 5}, {'n': 5}]))
+
+        self.assertEqual('d5', ids[0])
+        self.assertEqual(sorted(ids), sorted(self._find_ids({'n': 5})))
+
+    def test_insert_many_duplicate_id_inserts_nothing(self) -> None:
+        failure = _result(
+            self.collection.insert_many([{'id': 'd5', 'n': 5}, {'id': 'd5'}])
+        )
+
+        failure.trap(InvalidIdError)
+        self.assertEqual([], self._find_ids({'n': 5}))
+
+    def test_update(self) -> None:
+        _result(self.collection.update({'id': 'd1', 'n': 10}))
+
+        self.assertEqual({'id': 'd1', 'n': 10}, _result(self.collection.retrieve('d1')))
+        failure = _result(self.collection.update({'id': 'unknown'}))
+        failure.trap(InvalidIdError)
+
+    def test_update_many(self) -> None:
+        _result(
+            self.collection.update_many([{'id': 'd1', 'n': 10}, {'id': 'd2', 'n': 20}])
+        )
+
+        self.assertEqual(['d1'], self._find_ids({'n': 10}))
+        self.assertEqual(['d2'], self._find_ids({'n': 20}))
+
+    def test_update_many_unknown_id_updates_nothing(self) -> None:
+        failure = _result(
+            self.collection.update_many([{'id': 'd1', 'n': 10}, {'id': 'unknown'}])
+        )
+
+        failure.trap(InvalidIdError)
+        self.assertEqual(['d1'], self._find_ids({'n': 1}))
+
+    def test_delete(self) -> None:
+        _result(self.collection.delete('d1'))
+
+        self.assertIsNone(_result(self.collection.retrieve('d1')))
+        _result(self.collection.delete('d3')).trap(NonDeletableError)
+        _result(self.collection.delete('unknown')).trap(InvalidIdError)
+
+    def test_find_eq(self) -> None:
+        self.assertEqual(['d1'], self._find_ids({'mac': '00:00:00:00:00:01'}))
+        self.assertEqual(['d2'], self._find_ids({'n': 2}))
+        self.assertEqual(['d4'], self._find_ids({'n': '4'}))
+        self.assertEqual(['d3'], self._find_ids({'id': 'd3'}))
+
+    def test_find_operators(self) -> None:
+        self.assertEqual(['d1', 'd3'], sorted(self._find_ids({'n': {'$in': [1, 3]}})))
+        self.assertEqual(
+            ['d1', 'd4'], sorted(self._find_ids({'plugin': {'$ne': 'p1'}}))
+        )
+        self.assertEqual(['d4'], self._find_ids({'plugin': {'$nin': ['p1', 'p2']}}))
+        self.assertEqual(['d4'], self._find_ids({'c': {'$exists': True}}))
+        self.assertEqual(
+            ['d2', 'd3'], sorted(self._find_ids({'n': {'$gt': 1, '$le': 3}}))
+        )
+
+    def test_find_selector_matched_in_python(self) -> None:
+        self.assertEqual(['d4'], self._find_ids({'c.k': 'v'}))
+        self.assertEqual(['d4'], self._find_ids({'l': {'$contains': 2}}))
+        self.assertEqual(
+            ['d3'],
+            self._find_ids(
+                {'plugin': 'p1', 'c': {'$exists': False}, 'n': {'$in': [3]}}
+            ),
+        )
+
+    def test_find_sorted_with_skip_and_limit(self) -> None:
+        self.assertEqual(
+            ['d4', 'd2', 'd3', 'd1'], self._find_ids({}, sort=('plugin', 1))
+        )
+        self.assertEqual(
+            ['d3', 'd2'], self._find_ids({}, sort=('plugin', -1), skip=1, limit=2)
+        )
+        self.assertEqual(
+            ['d1'],
+            self._find_ids({'l': {'$exists': False}}, sort=('plugin', 1), skip=2),
+        )
+
+    def test_find_fields(self) -> None:
+        documents = list(_result(self.collection.find({'id': 'd1'}, fields=['n'])))
+
+        self.assertEqual([{'id': 'd1', 'n': 1}], documents)
+
+    def test_find_is_not_affected_by_later_writes(self) -> None:
+        documents = _result(self.collection.find({'plugin': 'p1'}, sort=('n', 1)))
+        _result(self.collection.update({'id': 'd2', 'plugin': 'p2', 'n': 5}))
+        _result(self.collection.delete('d2'))
+
+        self.assertEqual(['d2', 'd3'], [document['id'] for document in documents])
+
+    def test_find_one(self) -> None:
+        self.assertEqual('d2', _result(self.collection.find_one({'n': 2}))['id'])
+        self.assertIsNone(_result(self.collection.find_one({'n': 5})))
+
+    def test_ensure_index_is_used(self) -> None:
+        _result(self.collection.ensure_index('mac'))
+        sql, params, _ = self.collection._new_sql_query(
+            {'mac': '00:00:00:00:00:02'}, 0, 0, None
+        )
+        plan = self.database._connection.execute(
+            f'EXPLAIN QUERY PLAN {sql}', params
+        ).fetchall()
+
+        self.assertIn('idx_mac', str(plan))
+        self.assertEqual(['d2'], self._find_ids({'mac': '00:00:00:00:00:02'}))
+
+    def test_documents_and_indexes_are_persisted(self) -> None:
+        _result(self.collection.ensure_index('mac'))
+        self.database.close()
+
+        self.database = self._new_database()
+        self.collection = self.database.collection('devices')
+        _result(self.collection.ensure_index('mac'))
+
+        self.assertEqual(['d1'], self._find_ids({'mac': '00:00:00:00:00:01'}))
+
+
+class TestSqliteDatabaseFactory(unittest.TestCase):
+    def test_missing_file(self) -> None:
+        self.assertRaises(
+            ValueError, SqliteDatabaseFactory.new_database, 'sqlite', 'default'
+        )
+
+    def test_invalid_type(self) -> None:
+        self.assertRaises(
+            ValueError,
+            SqliteDatabaseFactory.new_database,
+            'json',
+            'default',
+            sqlite_db_file='provd.sqlite',
+        )
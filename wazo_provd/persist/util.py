@@ -3,8 +3,14 @@
 
 from __future__ import annotations
 
+import bisect
 import contextlib
+import functools
+import itertools
 import logging
+import operator
+import os
+from copy import deepcopy
 from typing import Any
 
 from twisted.internet import defer
@@ -20,28 +26,78 @@ from wazo_provd.persist.common import (
 logger = logging.getLogger(__name__)
 
 
+_SELECTOR_PLAN_CACHE_SIZE = 256
+
+
+def copy_document(value):
+    """Return a deep copy of a document, or of any value of a document.
+
+    This is a lot faster than copy.deepcopy since documents are only made
+    of dictionaries, lists and immutable values.
+
+    """
+    if isinstance(value, dict):
+        return {k: copy_document(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_document(v) for v in value]
+    if isinstance(value, (str, int, float, type(None), tuple)):
+        return value
+    return deepcopy(value)
+
+
+def fsync_directory(directory: str) -> None:
+    """Make sure the entries of a directory, e.g. renamed files, are on disk."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _new_doc_values_getter(s_key):
+    # Return a function taking a document and returning the list of values in
+    # the document matching the select key. The select key is split only once,
+    # when the getter is created, and not every time a document is examined.
+    *pre_tokens, last_token = s_key.split('.')
+
+    def add_last_values(current_doc, result):
+        if isinstance(current_doc, dict):
+            if last_token in current_doc:
+                result.append(current_doc[last_token])
+        elif isinstance(current_doc, list):
+            for elem in current_doc:
+                add_last_values(elem, result)
+
+    if not pre_tokens:
+
+        def simple_func(doc):
+            # common case optimization for documents and non-complex keys
+            if isinstance(doc, dict):
+                return [doc[last_token]] if last_token in doc else []
+            result: list[Any] = []
+            add_last_values(doc, result)
+            return result
+
+        return simple_func
+
+    def func(doc):
+        current_doc = doc
+        for token in pre_tokens:
+            if isinstance(current_doc, dict) and token in current_doc:
+                current_doc = current_doc[token]
+            else:
+                return []
+        result: list[Any] = []
+        add_last_values(current_doc, result)
+        return result
+
+    return func
+
+
 def _retrieve_doc_values(s_key, doc):
     # Return an iterator of matched value, i.e. all the value in the
     # doc that matches the select key
-    def func(current_s_key, current_doc):
-        pre, sep, post = current_s_key.partition('.')
-        if not sep:
-            assert pre == current_s_key
-            if isinstance(current_doc, dict):
-                if current_s_key in current_doc:
-                    yield current_doc[current_s_key]
-            elif isinstance(current_doc, list):
-                for elem in current_doc:
-                    yield from func(current_s_key, elem)
-        else:
-            assert pre != current_s_key
-            if post is None:
-                raise ValueError(f'invalid selector key "{s_key}"')
-
-            if isinstance(current_doc, dict) and pre in current_doc:
-                yield from func(post, current_doc[pre])
-
-    return func(s_key, doc)
+    return iter(_new_doc_values_getter(s_key)(doc))
 
 
 def _contains_operator(selector_value):
@@ -55,10 +111,10 @@ def _contains_operator(selector_value):
 
 
 def _new_simple_matcher_from_pred(pred):
-    # Return a matcher that returns true if there's a value in the document
-    # matching the select key for which pred(value) is true
-    def func(s_key, doc):
-        for doc_value in _retrieve_doc_values(s_key, doc):
+    # Return a matcher that returns true if there's a value in the list of
+    # document values for which pred(value) is true
+    def func(doc_values):
+        for doc_value in doc_values:
             if pred(doc_value):
                 return True
         return False
@@ -67,10 +123,10 @@ def _new_simple_matcher_from_pred(pred):
 
 
 def _new_simple_inv_matcher_from_pred(pred):
-    # Return a matcher that returns true if there's no value in the document
-    # matching the select key for which pred(value) is true
-    def func(s_key, doc):
-        for doc_value in _retrieve_doc_values(s_key, doc):
+    # Return a matcher that returns true if there's no value in the list of
+    # document values for which pred(value) is true
+    def func(doc_values):
+        for doc_value in doc_values:
             if pred(doc_value):
                 return False
         return True
@@ -78,6 +134,25 @@ def _new_simple_inv_matcher_from_pred(pred):
     return func
 
 
+def _new_membership_pred(s_value):
+    # Return a predicate that returns true if a document value is equal to
+    # one of the value in s_value. Lookups are done in a frozenset when
+    # possible, falling back to a list scan for unhashable values.
+    try:
+        s_set = frozenset(s_value)
+    except TypeError:
+        return lambda doc_value: doc_value in s_value
+
+    def func(doc_value):
+        try:
+            return doc_value in s_set
+        except TypeError:
+            # unhashable document value, i.e. a list or a dictionary
+            return doc_value in s_value
+
+    return func
+
+
 def _new_in_matcher(s_value):
     # Return a matcher that returns true if there's a value in the document
     # matching the select key that is equal to one of the value in s_value
@@ -85,7 +160,7 @@ def _new_in_matcher(s_value):
         raise ValueError(
             f'selector value for in matcher must be a list: {s_value} is not'
         )
-    return _new_simple_matcher_from_pred(lambda doc_value: doc_value in s_value)
+    return _new_simple_matcher_from_pred(_new_membership_pred(s_value))
 
 
 def _new_contains_matcher(s_value):
@@ -103,19 +178,31 @@ def _new_nin_matcher(s_value):
         raise ValueError(
             f'Selector value for nin matcher must be a list: {s_value} is not'
         )
-    return _new_simple_inv_matcher_from_pred(lambda doc_value: doc_value in s_value)
+    return _new_simple_inv_matcher_from_pred(_new_membership_pred(s_value))
 
 
 def _new_eq_matcher(s_value):
     # Return a matcher that returns true if there's a value in the document
     # matching the select key that is equal to s_value
-    return _new_simple_matcher_from_pred(lambda doc_value: doc_value == s_value)
+    def func(doc_values):
+        for doc_value in doc_values:
+            if doc_value == s_value:
+                return True
+        return False
+
+    return func
 
 
 def _new_ne_matcher(s_value):
     # Return a matcher that returns true if there's no value in the document
     # matching the select key that is equal to s_value
-    return _new_simple_inv_matcher_from_pred(lambda doc_value: doc_value == s_value)
+    def func(doc_values):
+        for doc_value in doc_values:
+            if doc_value == s_value:
+                return False
+        return True
+
+    return func
 
 
 def _new_gt_matcher(s_value):
@@ -139,28 +226,34 @@ def _new_le_matcher(s_value):
 def _new_exists_matcher(s_value):
     s_value = bool(s_value)
 
-    def aux(s_key, doc):
-        it = iter(_retrieve_doc_values(s_key, doc))
-        try:
-            next(it)
-        except StopIteration:
-            return not s_value
-        return s_value
+    def aux(doc_values):
+        return bool(doc_values) == s_value
 
     return aux
 
 
 def _new_and_matcher(matchers):
     # Return true if all the given matchers returns true.
-    def func(s_key, doc):
+    def func(doc_values):
         for matcher in matchers:
-            if not matcher(s_key, doc):
+            if not matcher(doc_values):
                 return False
         return True
 
     return func
 
 
+_RANGE_OPERATORS = {
+    '$gt': operator.gt,
+    '$ge': operator.ge,
+    '$lt': operator.lt,
+    '$le': operator.le,
+}
+
+_EMPTY_INDEX_ENTRY: frozenset = frozenset()
+
+_NEGATIVE_OPERATORS = ('$ne', '$nin')
+
 _MATCHER_FACTORIES = {
     '$in': _new_in_matcher,
     '$nin': _new_nin_matcher,
@@ -174,54 +267,170 @@ _MATCHER_FACTORIES = {
 }
 
 
-def _new_operator_matcher(operator_key, operator_value):
+def _get_operator_matcher_factory(operator_key):
     try:
-        matcher_factory = _MATCHER_FACTORIES[operator_key]
+        return _MATCHER_FACTORIES[operator_key]
     except KeyError:
         raise ValueError(f'Invalid operator: {operator_key}')
-    else:
-        return matcher_factory(operator_value)
 
 
-def _new_matcher(s_value):
-    # Return a predicate taking a select key and a document that returns true
-    # if the document value matches it, else false.
-    if _contains_operator(s_value):
-        matchers = [_new_operator_matcher(k, v) for k, v in s_value.items()]
-        if len(matchers) == 1:
-            return matchers[0]
-        return _new_and_matcher(matchers)
-    return _new_eq_matcher(s_value)
+def _selector_shape(selector):
+    # Return the shape of a selector, i.e. a hashable value that is the same
+    # for every selector having the same keys and operators, whatever their
+    # values are. For example, {'a': 1} and {'a': 2} have the same shape.
+    return tuple(
+        (s_key, tuple(s_value) if _contains_operator(s_value) else None)
+        for s_key, s_value in selector.items()
+    )
+
+
+@functools.lru_cache(maxsize=_SELECTOR_PLAN_CACHE_SIZE)
+def _compile_selector_shape(shape):
+    # Return a plan for the given selector shape, i.e. a tuple of
+    # (s_key, doc values getter, operator factories) where operator factories
+    # is None for a non-operator selector value, else a tuple of
+    # (operator key, matcher factory).
+    plan = []
+    for s_key, operator_keys in shape:
+        if operator_keys is None:
+            factories = None
+        else:
+            factories = tuple(
+                (operator_key, _get_operator_matcher_factory(operator_key))
+                for operator_key in operator_keys
+            )
+        plan.append((s_key, _new_doc_values_getter(s_key), factories))
+    return tuple(plan)
+
+
+def _new_matcher_from_plan_entry(factories, s_value):
+    # Return a matcher taking a list of document values that returns true if
+    # they match the selector value.
+    if factories is None:
+        return _new_eq_matcher(s_value)
+    matchers = [factory(s_value[operator_key]) for operator_key, factory in factories]
+    if len(matchers) == 1:
+        return matchers[0]
+    return _new_and_matcher(matchers)
 
 
 def _create_pred_from_selector(selector):
     # Return a predicate taking a document as argument and returning
     # true if the selector matches it, else false.
-    selector_matchers = [(k, _new_matcher(v)) for k, v in selector.items()]
+    plan = _compile_selector_shape(_selector_shape(selector))
+    selector_matchers = [
+        (getter, _new_matcher_from_plan_entry(factories, selector[s_key]))
+        for s_key, getter, factories in plan
+    ]
+
+    if not selector_matchers:
+        return lambda document: True
+
+    if len(selector_matchers) == 1:
+        ((getter, matcher),) = selector_matchers
+        return lambda document: matcher(getter(document))
 
     def aux(document):
-        for s_key, matcher in selector_matchers:
-            if not matcher(s_key, document):
+        for getter, matcher in selector_matchers:
+            if not matcher(getter(document)):
                 return False
         return True
 
     return aux
 
 
+def _new_fields_map_function(fields):
+    # Return a function taking a document and returning a new document with
+    # only the given fields and the ID, or the document itself if no fields
+    # are given. Note that the values of the new document are not copied.
+    if not fields:
+        return lambda x: x
+
+    split_keys = [field.split('.') for field in fields]
+
+    def aux(document):
+        result = {ID_KEY: document[ID_KEY]}
+        for split_key in split_keys:
+            cur_elem = document
+            try:
+                for cur_key in split_key:
+                    cur_elem = cur_elem[cur_key]
+            except (KeyError, TypeError):
+                # element does not have the given key or is not a dictionary -- ignore
+                pass
+            else:
+                cur_result = result
+                for cur_key in split_key[:-1]:
+                    cur_result = cur_result.setdefault(cur_key, {})
+                cur_result[split_key[-1]] = cur_elem
+        return result
+
+    return aux
+
+
+class _OrderedIndex:
+    # Index keeping the ID of every document of a collection ordered by the
+    # sort key of a complex key, i.e. the same order as a sort on this key.
+    # Ties are ordered by document ID.
+
+    def __init__(self, complex_key, documents):
+        self._key_fun = _new_key_fun_from_key(complex_key)
+        self._sort_keys = {
+            document[ID_KEY]: self._key_fun(document) for document in documents
+        }
+        self._entries = sorted(
+            (sort_key, document_id) for document_id, sort_key in self._sort_keys.items()
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, document):
+        document_id = document[ID_KEY]
+        sort_key = self._key_fun(document)
+        self._sort_keys[document_id] = sort_key
+        bisect.insort(self._entries, (sort_key, document_id))
+
+    def remove(self, document_id):
+        entry = (self._sort_keys.pop(document_id), document_id)
+        del self._entries[bisect.bisect_left(self._entries, entry)]
+
+    def update(self, document):
+        if self._key_fun(document) != self._sort_keys[document[ID_KEY]]:
+            self.remove(document[ID_KEY])
+            self.add(document)
+
+    def iter_ids(self, reverse):
+        entries = reversed(self._entries) if reverse else self._entries
+        for _, document_id in entries:
+            yield document_id
+
+    def sort_ids(self, document_ids, reverse):
+        sort_keys = self._sort_keys
+        return sorted(
+            document_ids,
+            key=lambda document_id: (sort_keys[document_id], document_id),
+            reverse=reverse,
+        )
+
+
 class SimpleBackendDocumentCollection(AbstractDocumentCollection):
     def __init__(self, backend, generator):
         self._backend = backend
         self._generator = generator
         self._indexes = {}
+        # precompiled value getter of every index
+        self._index_value_funs = {}
+        self._ordered_indexes = {}
         self.closed = False
 
     def close(self):
         self._backend.close()
         self.closed = True
 
-    def _generate_new_id(self):
+    def _generate_new_id(self, excluded_ids=()):
         for document_id in self._generator:
-            if document_id not in self._backend:
+            if document_id not in self._backend and document_id not in excluded_ids:
                 return document_id
 
     def insert(self, document):
@@ -239,6 +448,33 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
         self._add_document_update_indexes(document)
         return defer.succeed(document_id)
 
+    def insert_many(self, documents):
+        documents = list(documents)
+        new_ids = set()
+        for document in documents:
+            if ID_KEY in document:
+                document_id = document[ID_KEY]
+                if document_id in self._backend or document_id in new_ids:
+                    return defer.fail(InvalidIdError(document_id))
+                new_ids.add(document_id)
+
+        new_documents = {}
+        for document in documents:
+            if ID_KEY not in document:
+                document[ID_KEY] = self._generate_new_id(new_ids)
+                new_ids.add(document[ID_KEY])
+            new_documents[document[ID_KEY]] = document
+        # backends that can write many documents at once have a set_many method
+        set_many = getattr(self._backend, 'set_many', None)
+        if set_many is None:
+            for document_id, document in new_documents.items():
+                self._backend[document_id] = document
+        else:
+            set_many(new_documents)
+        for document in documents:
+            self._add_document_update_indexes(document)
+        return defer.succeed(list(new_documents))
+
     def update(self, document):
         try:
             document_id = document[ID_KEY]
@@ -249,14 +485,42 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
         else:
             if document_id not in self._backend:
                 return defer.fail(InvalidIdError(document_id))
-            old_document = self._backend[document_id]
+            old_document = self._backend.peek(document_id)
             self._backend[document_id] = document
             self._update_document_update_indexes(document, old_document)
             return defer.succeed(None)
 
+    def update_many(self, documents):
+        new_documents = {}
+        for document in documents:
+            try:
+                document_id = document[ID_KEY]
+            except KeyError:
+                return defer.fail(
+                    ValueError(f'no {ID_KEY} key found in document {document}')
+                )
+            if document_id not in self._backend:
+                return defer.fail(InvalidIdError(document_id))
+            new_documents[document_id] = document
+
+        old_documents = {
+            document_id: self._backend.peek(document_id)
+            for document_id in new_documents
+        }
+        # backends that can write many documents at once have a set_many method
+        set_many = getattr(self._backend, 'set_many', None)
+        if set_many is None:
+            for document_id, document in new_documents.items():
+                self._backend[document_id] = document
+        else:
+            set_many(new_documents)
+        for document_id, document in new_documents.items():
+            self._update_document_update_indexes(document, old_documents[document_id])
+        return defer.succeed(None)
+
     def delete(self, document_id: str):
         try:
-            old_document = self._backend[document_id]
+            old_document = self._backend.peek(document_id)
             if old_document.get('deletable', True):
                 self._del_document_update_indexes(old_document)
                 del self._backend[document_id]
@@ -284,40 +548,49 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
             # XXX should probably create a more meaningful exception class
             raise Exception(f'invalid direction {direction}')
 
+    def _new_ordered_index_iterator(
+        self, selector, ordered_index, reverse, skip, limit
+    ):
+        # Return an iterator over the documents matching the selector in the
+        # order of the ordered index, skipping and limiting the documents as
+        # soon as possible so that only the returned documents are retrieved
+        # when the selector can be fully answered by the indexes.
+        document_ids, _, regular_selector = self._plan_query(selector)
+        if document_ids is None:
+            ordered_ids = ordered_index.iter_ids(reverse)
+        else:
+            ordered_ids = ordered_index.sort_ids(document_ids, reverse)
+        if not regular_selector:
+            stop = skip + limit if limit else None
+            ordered_ids = itertools.islice(ordered_ids, skip, stop)
+            return (self._backend.peek(document_id) for document_id in ordered_ids)
+        pred = _create_pred_from_selector(regular_selector)
+        documents = (self._backend.peek(document_id) for document_id in ordered_ids)
+        documents = self._new_skip_iterator(skip, filter(pred, documents))
+        return self._new_limit_iterator(limit, documents)
+
     def _do_find_sorted(self, selector, fields, skip, limit, sort):
-        documents = list(self._do_find_unsorted(selector, fields, 0, 0))
         key, direction = sort
+        if key in self._ordered_indexes:
+            reverse = self._reverse_from_direction(direction)
+            documents = self._new_ordered_index_iterator(
+                selector, self._ordered_indexes[key], reverse, skip, limit
+            )
+            return map(self._new_output_function(fields), list(documents))
+
+        documents = list(self._new_iterator_over_matching_documents(selector))
         key_fun = _new_key_fun_from_key(key)
         reverse = self._reverse_from_direction(direction)
         documents.sort(key=key_fun, reverse=reverse)
-        documents = list(self._new_skip_iterator(skip, documents))
-        documents = list(self._new_limit_iterator(limit, documents))
-        return iter(documents)
-
-    def _new_fields_map_function(self, fields):
-        if not fields:
-            return lambda x: x
-
-        split_keys = [field.split('.') for field in fields]
-
-        def aux(document):
-            result = {ID_KEY: document[ID_KEY]}
-            for split_key in split_keys:
-                cur_elem = document
-                try:
-                    for cur_key in split_key:
-                        cur_elem = cur_elem[cur_key]
-                except (KeyError, TypeError):
-                    # element does not have the given key or is not a dictionary -- ignore
-                    pass
-                else:
-                    cur_result = result
-                    for cur_key in split_key[:-1]:
-                        cur_result = cur_result.setdefault(cur_key, {})
-                    cur_result[split_key[-1]] = cur_elem
-            return result
+        documents = self._new_skip_iterator(skip, documents)
+        documents = self._new_limit_iterator(limit, documents)
+        return map(self._new_output_function(fields), list(documents))
 
-        return aux
+    def _new_output_function(self, fields):
+        # Return a function mapping a shared document from the backend to the
+        # document returned to the caller, i.e. a copy of the selected fields.
+        fields_map_function = _new_fields_map_function(fields)
+        return lambda document: copy_document(fields_map_function(document))
 
     def _new_skip_iterator(self, skip: int, documents):
         with contextlib.suppress(StopIteration):
@@ -330,6 +603,7 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
     def _new_limit_iterator(self, limit: int | None, documents):
         if not limit:
             return documents
+        documents = iter(documents)
 
         def func():
             nonlocal limit
@@ -346,65 +620,135 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
         pred = _create_pred_from_selector(selector)
         return list(filter(pred, documents))
 
-    def _new_indexes_iterator(self, indexes_selector):
-        # Return an iterator that will return every document in the backend
-        # matching the given "indexes" selector. Note that an indexes selector
-        # can't be empty.
-        document_ids = set()
-        first_loop = True
-        for selector_key, selector_value in indexes_selector.items():
-            index = self._indexes[selector_key]
-            index_entry = index.get(selector_value, [])
-            if first_loop:
-                first_loop = False
-                document_ids.update(index_entry)
+    def _lookup_index(self, complex_key, operator_key, s_value):
+        # Return the set of IDs of the documents for which the value of the
+        # complex key is matched by the operator (None meaning equality), or
+        # None if the index can't be used for this operator and value.
+        # Negative operators ($ne and $nin) return the set of IDs to exclude.
+        # The returned set may be an index entry and MUST NOT be modified.
+        if complex_key == ID_KEY:
+            # the backend itself is an index on the ID key
+
+            def get_index_entry(value):
+                return {value} if value in self._backend else _EMPTY_INDEX_ENTRY
+
+        else:
+            index = self._indexes[complex_key]
+
+            def get_index_entry(value):
+                return index.get(value, _EMPTY_INDEX_ENTRY)
+
+        try:
+            if operator_key is None or operator_key == '$ne':
+                return get_index_entry(s_value)
+            if operator_key in ('$in', '$nin'):
+                if not isinstance(s_value, list):
+                    return None
+                document_ids = set()
+                for value in s_value:
+                    document_ids.update(get_index_entry(value))
+                return document_ids
+            if operator_key in _RANGE_OPERATORS and complex_key != ID_KEY:
+                compare = _RANGE_OPERATORS[operator_key]
+                document_ids = set()
+                for value, index_entry in index.items():
+                    if compare(value, s_value):
+                        document_ids.update(index_entry)
+                return document_ids
+        except TypeError:
+            # unhashable or not comparable value
+            return None
+        return None
+
+    def _plan_query(self, selector):
+        # Return a tuple (document_ids, index_keys, regular_selector) where
+        # document_ids is the set of candidate document IDs found using the
+        # indexes, or None if every document must be scanned, index_keys is
+        # the list of keys for which an index was used, the most selective
+        # first, and regular_selector is the part of the selector that must
+        # still be matched against each candidate document.
+        positive_lookups = []
+        negative_lookups = []
+        regular_selector = {}
+        for selector_key, selector_value in selector.items():
+            if selector_key != ID_KEY and selector_key not in self._indexes:
+                regular_selector[selector_key] = selector_value
+                continue
+            if _contains_operator(selector_value):
+                operators = list(selector_value.items())
+            else:
+                operators = [(None, selector_value)]
+            lookups = []
+            for operator_key, operator_value in operators:
+                document_ids = self._lookup_index(
+                    selector_key, operator_key, operator_value
+                )
+                if document_ids is None:
+                    regular_selector[selector_key] = selector_value
+                    break
+                lookups.append((operator_key in _NEGATIVE_OPERATORS, document_ids))
+            else:
+                for negative, document_ids in lookups:
+                    if negative:
+                        negative_lookups.append((selector_key, document_ids))
+                    else:
+                        positive_lookups.append((selector_key, document_ids))
+
+        if not positive_lookups:
+            # negative lookups can only be subtracted from a set of candidates
+            for selector_key, _ in negative_lookups:
+                regular_selector[selector_key] = selector[selector_key]
+            return None, [], regular_selector
+
+        # start from the smallest set, which is the only one copied, so that
+        # every intersection and difference is bounded by its size
+        positive_lookups.sort(key=lambda lookup: len(lookup[1]))
+        index_keys = []
+        document_ids = None
+        for selector_key, lookup_ids in positive_lookups:
+            if document_ids is None:
+                document_ids = set(lookup_ids)
+            elif document_ids:
+                document_ids.intersection_update(lookup_ids)
+            if selector_key not in index_keys:
+                index_keys.append(selector_key)
+        for selector_key, lookup_ids in negative_lookups:
+            if len(lookup_ids) > len(document_ids):
+                document_ids = {
+                    document_id
+                    for document_id in document_ids
+                    if document_id not in lookup_ids
+                }
             else:
-                document_ids.intersection_update(index_entry)
-        for document_id in document_ids:
-            yield self._backend[document_id]
+                document_ids.difference_update(lookup_ids)
+            if selector_key not in index_keys:
+                index_keys.append(selector_key)
+        return document_ids, index_keys, regular_selector
 
     def _new_iterator_over_matching_documents(self, selector):
         # Return an iterator that will yield every document in the backend
         # matching the given selector. This may or may not use indices.
-        # 1. check if there's some key-value in the selector usable by the
-        #    indexes
-        indexes_selector = {}
-        regular_selector = {}
-        for selector_key, selector_value in selector.items():
-            if selector_key in self._indexes and not _contains_operator(selector_value):
-                indexes_selector[selector_key] = selector_value
-            else:
-                regular_selector[selector_key] = selector_value
-        # 2. use indexes selector if possible
-        if indexes_selector:
-            documents = self._new_indexes_iterator(indexes_selector)
+        document_ids, _, regular_selector = self._plan_query(selector)
+        if document_ids is None:
+            documents = self._backend.peek_values()
         else:
-            documents = self._backend.values()
-        # 3. use regular selector if possible
+            documents = (
+                self._backend.peek(document_id) for document_id in document_ids
+            )
         if regular_selector:
             documents = self._new_iterator(regular_selector, documents)
         return documents
 
     def _do_find_unsorted(self, selector, fields, skip, limit):
-        # common case optimization when only ID_KEY is present
-        if (
-            ID_KEY in selector
-            and len(selector) == 1
-            and not _contains_operator(selector[ID_KEY])
-        ):
-            try:
-                documents = [self._backend[selector[ID_KEY]]]
-            except KeyError:
-                documents = []
-        else:
-            documents = self._new_iterator_over_matching_documents(selector)
+        documents = self._new_iterator_over_matching_documents(selector)
         documents = self._new_skip_iterator(skip, documents)
         documents = self._new_limit_iterator(limit, documents)
-        documents = list(map(self._new_fields_map_function(fields), documents))
-        return iter(documents)
+        return map(self._new_output_function(fields), list(documents))
 
     def _do_find(self, selector, fields, skip, limit, sort):
-        # Return an iterator over the documents
+        # Return an iterator over the documents. The matching documents are
+        # listed at once, so that the result is not affected by later writes,
+        # but each of them is only copied once iterated over.
         if sort:
             return self._do_find_sorted(selector, fields, skip, limit, sort)
         else:
@@ -426,6 +770,28 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
         )
         return defer.succeed(self._do_find(selector, fields, skip, limit, sort))
 
+    def explain(self, selector):
+        """Return a deferred that will fire with a dictionary describing how
+        documents matching the selector would be found, with the following
+        keys:
+          index -- the most selective index used, or None for a full scan
+          indexes -- the list of every index used
+          candidates -- the number of documents that will be scanned
+          filter -- the list of selector keys matched against each candidate
+
+        """
+        document_ids, index_keys, regular_selector = self._plan_query(selector)
+        return defer.succeed(
+            {
+                'index': index_keys[0] if index_keys else None,
+                'indexes': index_keys,
+                'candidates': len(
+                    self._backend if document_ids is None else document_ids
+                ),
+                'filter': list(regular_selector),
+            }
+        )
+
     def find_one(self, selector):
         it = self._do_find(selector, None, 0, 1, None)
         try:
@@ -438,56 +804,63 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
         # Update the indexes after adding a document to the backend.
         document_id = document[ID_KEY]
         for complex_key, index in self._indexes.items():
-            has_key, value = self._get_value_from_complex_key(complex_key, document)
+            has_key, value = self._index_value_funs[complex_key](document)
             if has_key:
                 self._new_value_for_index(index, document_id, value)
+        for ordered_index in self._ordered_indexes.values():
+            ordered_index.add(document)
 
     def _update_document_update_indexes(self, document, old_document):
-        # Update the indexes after updating a document to the backend.
-        self._del_document_update_indexes(old_document)
-        self._add_document_update_indexes(document)
+        # Update the indexes after updating a document to the backend. Only
+        # the indexes for which the value of the document changed are updated.
+        document_id = document[ID_KEY]
+        for complex_key, index in self._indexes.items():
+            get_value_fun = self._index_value_funs[complex_key]
+            old_has_key, old_value = get_value_fun(old_document)
+            has_key, value = get_value_fun(document)
+            if old_has_key == has_key and old_value == value:
+                continue
+            if old_has_key:
+                self._del_value_for_index(index, document_id, old_value)
+            if has_key:
+                self._new_value_for_index(index, document_id, value)
+        for ordered_index in self._ordered_indexes.values():
+            ordered_index.update(document)
 
     def _del_document_update_indexes(self, old_document):
         # Update the indexes after removing document from the backend.
         document_id = old_document[ID_KEY]
         for complex_key, index in self._indexes.items():
-            has_key, value = self._get_value_from_complex_key(complex_key, old_document)
+            has_key, value = self._index_value_funs[complex_key](old_document)
             if has_key:
                 self._del_value_for_index(index, document_id, value)
+        for ordered_index in self._ordered_indexes.values():
+            ordered_index.remove(document_id)
 
     def _new_value_for_index(self, index, document_id, value):
         # Add the value belonging to the document with the given id to the
-        # given index.
-        def func(value):
-            if value in index:
-                index_entry = index[value]
-                if document_id not in index_entry:
-                    index_entry.append(document_id)
-            else:
-                index[value] = [document_id]
-
-        func(value)
-        if isinstance(value, list):
-            for list_item in value:
-                func(list_item)
+        # given index. Unhashable values, i.e. lists and dictionaries, are
+        # not indexed, since lookups are never done on these values.
+        try:
+            index_entry = index.get(value)
+        except TypeError:
+            return
+        if index_entry is None:
+            index[value] = {document_id}
+        else:
+            index_entry.add(document_id)
 
     def _del_value_for_index(self, index, document_id, value):
         # Delete the value belonging to the document with the given id to
         # the given index.
-        def func(inner_value):
-            index_entry = index[inner_value]
-            index_entry.remove(document_id)
+        try:
+            index_entry = index.get(value)
+        except TypeError:
+            return
+        if index_entry is not None:
+            index_entry.discard(document_id)
             if not index_entry:
-                del index[inner_value]
-
-        func(value)
-        if isinstance(value, list):
-            for list_item in value:
-                func(list_item)
-
-    def _get_value_from_complex_key(self, complex_key, document):
-        get_value_fun = self._new_get_value_fun_from_complex_key(complex_key)
-        return get_value_fun(document)
+                del index[value]
 
     def _new_get_value_fun_from_complex_key(self, complex_key):
         # Return a function that takes a document and return a tuple where
@@ -513,21 +886,40 @@ class SimpleBackendDocumentCollection(AbstractDocumentCollection):
 
         return func
 
-    def _new_id_and_value_iterator(self, complex_key):
-        # Return an iterator that yield (id, value) tuple for each document
-        # in the backend that has the given complex key.
-        get_value_fun = self._new_get_value_fun_from_complex_key(complex_key)
-        for document in self._backend.values():
-            has_key, value = get_value_fun(document)
-            if has_key:
-                yield document[ID_KEY], value
-
     def _create_index(self, complex_key: str):
-        logger.info('Creating index on complex key %s', complex_key)
-        index: dict[str, Any] = {}
-        for key, value in self._new_id_and_value_iterator(complex_key):
-            self._new_value_for_index(index, key, value)
-        self._indexes[complex_key] = index
+        # index the documents already in the backend, without loading any
+        self.create_indexes_on_load([complex_key], lambda add_document: None)
+
+    def create_indexes_on_load(self, complex_keys, load):
+        """Create indexes on the complex keys while the backend is loaded.
+
+        load is called with a function that must be called with every
+        document loaded in the backend, so that the documents are indexed in
+        the same pass instead of being iterated over once per index.
+
+        """
+        new_indexes: list[tuple[str, Any, dict]] = []
+        for complex_key in complex_keys:
+            if complex_key not in self._indexes:
+                logger.info('Creating index on complex key %s', complex_key)
+                get_value_fun = self._new_get_value_fun_from_complex_key(complex_key)
+                new_indexes.append((complex_key, get_value_fun, {}))
+
+        def add_document(document):
+            for _, get_value_fun, index in new_indexes:
+                has_key, value = get_value_fun(document)
+                if has_key:
+                    self._new_value_for_index(index, document[ID_KEY], value)
+
+        for document in self._backend.peek_values():
+            add_document(document)
+        load(add_document)
+        for complex_key, get_value_fun, index in new_indexes:
+            self._indexes[complex_key] = index
+            self._index_value_funs[complex_key] = get_value_fun
+            self._ordered_indexes[complex_key] = _OrderedIndex(
+                complex_key, self._backend.peek_values()
+            )
 
     def ensure_index(self, complex_key: str) -> Deferred:
         if complex_key not in self._indexes:
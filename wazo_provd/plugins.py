@@ -166,6 +166,7 @@ class Plugin(AbstractPlugin):
     http_service
     tftp_dev_info_extractor
     tftp_service
+    dev_info_dispatch_hints
 
     Plugin class that are made to be instantiated (i.e. the one doing the
     real job, and not superclass that helps it) must have an attribute
@@ -314,6 +315,26 @@ class Plugin(AbstractPlugin):
 
     """
 
+    dev_info_dispatch_hints = None
+    """A dictionary of hints describing which requests the device info
+    extractors of this plugin can extract information from, or None if
+    they must be given every request.
+
+    Keys are request types ('http', 'tftp' or 'dhcp') and values are
+    dictionaries with zero or more of the following keys:
+      user_agent_prefixes -- a list of User-Agent header prefixes (HTTP)
+      filename_patterns -- a list of regular expressions matched against
+        the start of the requested filename (HTTP and TFTP)
+      vendor_class_prefixes -- a list of vendor class identifier (option
+        60) prefixes (DHCP)
+
+    The extractor for a request type with hints is only given the requests
+    matching at least one of its hints, so hints MUST match every request
+    the extractor can extract information from. Requests matching the hints
+    of no plugin are given to every extractor.
+
+    """
+
     pg_associator = None
     """Return an object providing the IPluginAssociator interface, or None if
     the plugin doesn't have a plugin associator.
@@ -376,6 +397,29 @@ class Plugin(AbstractPlugin):
         """
         pass
 
+    def configure_batch(
+        self, devices_and_raw_configs: list[tuple[dict[str, str], dict[str, Any]]]
+    ) -> None:
+        """Configure many devices at once. This method is called instead of
+        the configure method when many devices of this plugin need to be
+        reconfigured, for example after a change to a config shared by all
+        these devices.
+
+        devices_and_raw_configs is a list of (device, raw config) tuples,
+        with the same pre and post conditions as for the configure method.
+        Every raw config object is distinct and can be modified.
+
+        Plugin class MAY override this method if it can apply many
+        configurations more efficiently than one at a time (e.g. by writing
+        shared files only once). If this method raises an exception, the
+        configure method will be called for each device instead. The
+        default implementation raises a NotImplementedError.
+
+        This method is synchronous/blocking.
+
+        """
+        raise NotImplementedError()
+
     def deconfigure(self, device: dict[str, str]) -> None:
         """De-configure the plugin so that the plugin won't configure the
         device.
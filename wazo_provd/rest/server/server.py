@@ -19,9 +19,11 @@ import functools
 import json
 import logging
 from binascii import a2b_base64
-from collections.abc import Callable, Generator
-from typing import TYPE_CHECKING, Any, TypeVar
+from collections.abc import Callable, Generator, Iterable
+from typing import TYPE_CHECKING, Any, BinaryIO, TypeVar, cast
 
+from twisted.internet import task
+from twisted.internet.defer import Deferred
 from twisted.web import http
 from twisted.web.resource import IResource, Resource
 from twisted.web.server import NOT_DONE_YET
@@ -34,6 +36,7 @@ from wazo_provd.app import (
     ProvisioningApplication,
     TenantInvalidForDeviceError,
 )
+from wazo_provd.devices.schemas import DeviceDict
 from wazo_provd.localization import get_locale_and_language
 from wazo_provd.operation import (
     OperationInProgress,
@@ -43,7 +46,7 @@ from wazo_provd.operation import (
 from wazo_provd.persist.common import ID_KEY
 from wazo_provd.plugins import BasePluginManagerObserver, PluginManager
 from wazo_provd.rest.server.util import accept_mime_type, numeric_id_generator
-from wazo_provd.rest.util import PROV_MIME_TYPE, uri_append_path
+from wazo_provd.rest.util import NDJSON_MIME_TYPE, PROV_MIME_TYPE, uri_append_path
 from wazo_provd.servers.http_site import AuthResource, Request
 from wazo_provd.services import InvalidParameterError
 from wazo_provd.status import get_status_aggregator
@@ -69,6 +72,9 @@ REL_UPDATE = 'srv.install.update'
 REL_CONFIGURE_SRV = 'srv.configure'
 REL_CONFIGURE_PARAM = 'srv.configure.param'
 
+# number of lines parsed, or documents written, before yielding to the reactor
+STREAM_BATCH_SIZE = 500
+
 _PPRINT = False
 if _PPRINT:
     json_dumps = functools.partial(json.dumps, sort_keys=True, indent=4)
@@ -165,6 +171,86 @@ def deferred_respond_no_resource(
     request.finish()
 
 
+def _deferred_respond_chunks(
+    request: Request, chunks: Iterable[str], response_code: int = http.OK
+) -> None:
+    # Write the chunks STREAM_BATCH_SIZE at a time, cooperatively, so that
+    # large responses are never built in memory nor block the reactor, then
+    # finish the request. Writing stops if the client disconnects.
+    request.setResponseCode(response_code)
+
+    def write_chunks() -> Generator[None, None, None]:
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) == STREAM_BATCH_SIZE:
+                request.write(''.join(batch).encode('utf-8'))
+                batch = []
+                yield None
+        if batch:
+            request.write(''.join(batch).encode('utf-8'))
+
+    cooperative_task = task.cooperate(write_chunks())
+
+    def on_connection_lost(_):
+        try:
+            cooperative_task.stop()
+        except task.TaskFinished:
+            pass
+
+    def on_written(_):
+        request.finish()
+
+    def on_error(failure):
+        if not failure.check(task.TaskStopped):
+            logger.error('Error while writing response: %s', failure.value)
+            request.loseConnection()
+
+    request.notifyFinish().addErrback(on_connection_lost)
+    cooperative_task.whenDone().addCallbacks(on_written, on_error)
+
+
+def deferred_respond_documents(
+    request: Request,
+    key: str,
+    documents: Iterable[Any],
+    response_code: int = http.OK,
+) -> None:
+    """Respond with a JSON object holding the list of documents under key.
+
+    The documents are serialized and written incrementally, as they are
+    iterated over, instead of being dumped all at once.
+
+    """
+
+    def chunks() -> Generator[str, None, None]:
+        yield f'{{{json_dumps(key)}:['
+        separator = ''
+        for document in documents:
+            yield separator + json_dumps(document)
+            separator = ','
+        yield ']}'
+
+    _deferred_respond_chunks(request, chunks(), response_code)
+
+
+def deferred_respond_ndjson(
+    request: Request, documents: Iterable[Any], response_code: int = http.OK
+) -> None:
+    """Respond with every document as a line of JSON.
+
+    The documents are serialized and written incrementally, as they are
+    iterated over.
+
+    """
+    request.setHeader(b'Content-Type', NDJSON_MIME_TYPE.encode('ascii'))
+    _deferred_respond_chunks(
+        request,
+        (json.dumps(document, separators=(',', ':')) + '\n' for document in documents),
+        response_code,
+    )
+
+
 def json_response_entity(
     fun: Callable[[Resource, Request], R]
 ) -> Callable[[Resource, Request], R]:
@@ -757,6 +843,8 @@ class DeviceManagerResource(IntermediaryResource):
                 DeviceDHCPInfoResource(app, dhcp_request_processing_service),
             ),
             ('dev.devices', 'devices', DevicesResource(app)),
+            ('dev.import', 'import', DevicesImportResource(app)),
+            ('dev.export', 'export', DevicesExportResource(app)),
         ]
         super().__init__(links)
 
@@ -828,7 +916,7 @@ class DeviceReconfigureResource(AuthResource):
                 )
 
             def on_tenant_valid_for_device(tenant_uuid):
-                return self._app.dev_reconfigure(device_id)
+                return self._app.dev_reconfigure(device_id, force=True)
 
             def on_callback(ign):
                 deferred_respond_no_content(request)
@@ -889,6 +977,12 @@ class DeviceDHCPInfoResource(AuthResource):
         return respond_error(request, 'invalid operation value')
 
 
+def _extract_recurse(request: Request) -> bool:
+    for value in request.args.get(b'recurse', []):
+        return value in [b'true', b'True']
+    return False
+
+
 class DevicesResource(AuthResource):
     def __init__(self, app: ProvisioningApplication) -> None:
         super().__init__()
@@ -897,24 +991,18 @@ class DevicesResource(AuthResource):
     def getChild(self, path: bytes, request: Request) -> DevicesResource:
         return DeviceResource(self._app, path)
 
-    def _extract_recurse(self, request: Request) -> bool:
-        for value in request.args.get(b'recurse', []):
-            return value in [b'true', b'True']
-        return False
-
     @json_response_entity
     @required_acl('provd.dev_mgr.devices.read')
     def render_GET(self, request: Request):
         find_arguments = find_arguments_from_request(request)
 
         def on_callback(devices):
-            data = json_dumps({'devices': list(devices)})
-            deferred_respond_ok(request, data)
+            deferred_respond_documents(request, 'devices', devices)
 
         def on_errback(failure):
             deferred_respond_error(request, failure.value)
 
-        recurse = self._extract_recurse(request)
+        recurse = _extract_recurse(request)
         tenant_uuids = self._build_tenant_list_from_request(request, recurse=recurse)
         find_arguments['selector']['tenant_uuid'] = {'$in': tenant_uuids}
         d = self._app.dev_find(**find_arguments)
@@ -950,6 +1038,117 @@ class DevicesResource(AuthResource):
         return NOT_DONE_YET
 
 
+class DevicesImportResource(_OipInstallResource):
+    def __init__(self, app: ProvisioningApplication) -> None:
+        super().__init__()
+        self._app = app
+
+    @required_acl('provd.dev_mgr.import.create')
+    def render_POST(self, request: Request):
+        content_type = decode_bytes(request.getHeader(b'Content-Type'))
+        if content_type != NDJSON_MIME_TYPE:
+            return respond_error(
+                request,
+                f'Entity must be in media type "{NDJSON_MIME_TYPE}".',
+                http.UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        # for each non empty line, its number and either the device or the
+        # parsing error
+        entries: list[tuple[int, DeviceDict | ValueError]] = []
+
+        def parse_lines() -> Generator[None, None, None]:
+            content = cast(BinaryIO, request.content)
+            content.seek(0)
+            for line_number, line in enumerate(content, 1):
+                if not line.strip():
+                    continue
+                try:
+                    device = json.loads(line)
+                    if not isinstance(device, dict):
+                        raise ValueError('not a JSON object')
+                except ValueError as e:
+                    entries.append(
+                        (line_number, ValueError(f'line {line_number}: {e}'))
+                    )
+                else:
+                    entries.append((line_number, cast(DeviceDict, device)))
+                if line_number % STREAM_BATCH_SIZE == 0:
+                    yield None
+
+        def on_valid_tenant(tenant_uuid):
+            # devices of another tenant are refused instead of being moved
+            devices = []
+            for i, (line_number, entry) in enumerate(entries):
+                if isinstance(entry, ValueError):
+                    continue
+                if not entry.get('tenant_uuid'):
+                    entry['tenant_uuid'] = tenant_uuid
+                elif entry['tenant_uuid'] != tenant_uuid:
+                    error = f'invalid tenant_uuid "{entry["tenant_uuid"]}"'
+                    entries[i] = line_number, ValueError(f'line {line_number}: {error}')
+                    continue
+                devices.append(entry)
+            logger.debug(
+                'Importing %d devices using tenant_uuid %s', len(devices), tenant_uuid
+            )
+            deferred, oip = self._app.dev_insert_many(devices)
+            location = self._add_new_oip(oip, request)
+            request.setHeader(b'Location', location.encode('ascii'))
+            return deferred
+
+        def on_callback(results):
+            results_iter = iter(results)
+
+            def lines():
+                for _, entry in entries:
+                    if isinstance(entry, ValueError):
+                        result = entry
+                    else:
+                        result = next(results_iter)
+                    if isinstance(result, Exception):
+                        yield {'error': str(result)}
+                    else:
+                        yield {'id': result}
+
+            deferred_respond_ndjson(request, lines(), http.CREATED)
+
+        def on_errback(failure):
+            if failure.check(UnauthorizedTenant):
+                deferred_respond_unauthorized(request)
+            else:
+                deferred_respond_error(request, failure.value)
+
+        d: Deferred = task.cooperate(parse_lines()).whenDone()
+        d.addCallback(lambda _: self._verify_tenant(request))
+        d.addCallback(on_valid_tenant)
+        d.addCallbacks(on_callback, on_errback)
+        return NOT_DONE_YET
+
+
+class DevicesExportResource(AuthResource):
+    def __init__(self, app: ProvisioningApplication) -> None:
+        super().__init__()
+        self._app = app
+
+    @required_acl('provd.dev_mgr.export.read')
+    def render_GET(self, request: Request):
+        find_arguments = find_arguments_from_request(request)
+
+        def on_callback(devices):
+            deferred_respond_ndjson(request, devices)
+
+        def on_errback(failure):
+            deferred_respond_error(request, failure.value)
+
+        recurse = _extract_recurse(request)
+        tenant_uuids = self._build_tenant_list_from_request(request, recurse=recurse)
+        find_arguments['selector']['tenant_uuid'] = {'$in': tenant_uuids}
+        d = self._app.dev_find(**find_arguments)
+        d.addCallbacks(on_callback, on_errback)
+        return NOT_DONE_YET
+
+
 class DeviceResource(AuthResource):
     def __init__(self, app: ProvisioningApplication, device_id: str | bytes) -> None:
         super().__init__()
@@ -1103,8 +1302,7 @@ class ConfigsResource(AuthResource):
         find_arguments = find_arguments_from_request(request)
 
         def on_callback(configs):
-            data = json_dumps({'configs': list(configs)})
-            deferred_respond_ok(request, data)
+            deferred_respond_documents(request, 'configs', configs)
 
         def on_errback(failure):
             deferred_respond_error(request, failure.value)
@@ -0,0 +1,257 @@
+# Copyright 2024 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import annotations
+
+import io
+import json
+import unittest
+from collections.abc import Generator
+from typing import Any, cast
+from unittest.mock import Mock, patch
+
+from hamcrest import assert_that, contains_exactly, equal_to
+from twisted.internet import defer, task
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+
+from wazo_provd.operation import OIP_PROGRESS, OperationInProgress
+from wazo_provd.rest.server import server
+from wazo_provd.rest.util import NDJSON_MIME_TYPE
+from wazo_provd.servers.http_site import Request
+
+
+class _Request(DummyRequest):
+    def __init__(self, path: bytes, content: bytes = b'') -> None:
+        super().__init__([b''])
+        self.path = path
+        self.content = io.BytesIO(content)
+
+
+class _ResourceTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # run the cooperative tasks on a fake clock instead of the reactor, one
+        # step per clock advance
+        self.clock = task.Clock()
+        cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda f: self.clock.callLater(1, f),  # type: ignore[arg-type]
+        )
+        patcher = patch.object(task, 'cooperate', cooperator.cooperate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = Mock()
+
+    def _run(self) -> None:
+        while self.clock.getDelayedCalls():
+            self.clock.advance(1)
+
+    @staticmethod
+    def _written(request: DummyRequest) -> str:
+        return b''.join(request.written).decode('utf-8')
+
+    def _written_lines(self, request: DummyRequest) -> list[Any]:
+        return [json.loads(line) for line in self._written(request).splitlines()]
+
+
+class TestDevicesImportResource(_ResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.oip = OperationInProgress('configure', OIP_PROGRESS)
+        self.resource = server.DevicesImportResource(self.app)
+        self.resource._verify_tenant = Mock(  # type: ignore[method-assign]
+            return_value=defer.succeed('tenant')
+        )
+
+    def _import(self, content: bytes) -> DummyRequest:
+        request = _Request(b'/dev_mgr/import', content)
+        request.requestHeaders.setRawHeaders(
+            b'Content-Type', [NDJSON_MIME_TYPE.encode('ascii')]
+        )
+        self.resource.render_POST(request)
+        self._run()
+        return request
+
+    def test_devices_are_imported(self) -> None:
+        self.app.dev_insert_many.return_value = (
+            defer.succeed(['d1', 'd2']),
+            self.oip,
+        )
+
+        request = self._import(b'{"mac": "00:11:22:33:44:55"}\n\n{"id": "d2"}\n')
+
+        self.app.dev_insert_many.assert_called_once_with(
+            [
+                {'mac': '00:11:22:33:44:55', 'tenant_uuid': 'tenant'},
+                {'id': 'd2', 'tenant_uuid': 'tenant'},
+            ]
+        )
+        assert_that(request.responseCode, equal_to(http.CREATED))
+        assert_that(
+            request.responseHeaders.getRawHeaders(b'Content-Type'),
+            equal_to([NDJSON_MIME_TYPE.encode('ascii')]),
+        )
+        assert_that(
+            self._written_lines(request),
+            contains_exactly({'id': 'd1'}, {'id': 'd2'}),
+        )
+        assert_that(request.finished, equal_to(1))
+
+    def test_errors_are_reported_by_line(self) -> None:
+        self.app.dev_insert_many.return_value = (
+            defer.succeed([ValueError('duplicate ID'), 'd3']),
+            self.oip,
+        )
+
+        request = self._import(b'{"id": "d1"}\n[1]\n\n{bad\n{"id": "d3"}\n')
+
+        self.app.dev_insert_many.assert_called_once_with(
+            [
+                {'id': 'd1', 'tenant_uuid': 'tenant'},
+                {'id': 'd3', 'tenant_uuid': 'tenant'},
+            ]
+        )
+        assert_that(
+            self._written_lines(request),
+            contains_exactly(
+                {'error': 'duplicate ID'},
+                {'error': 'line 2: not a JSON object'},
+                {
+                    'error': 'line 4: Expecting property name enclosed in double '
+                    'quotes: line 1 column 2 (char 1)'
+                },
+                {'id': 'd3'},
+            ),
+        )
+
+    def test_devices_of_other_tenants_are_refused(self) -> None:
+        self.app.dev_insert_many.return_value = (
+            defer.succeed(['d1', 'd3']),
+            self.oip,
+        )
+
+        request = self._import(
+            b'{"id": "d1", "tenant_uuid": "tenant"}\n'
+            b'{"id": "d2", "tenant_uuid": "other"}\n'
+            b'{"id": "d3"}\n'
+        )
+
+        self.app.dev_insert_many.assert_called_once_with(
+            [
+                {'id': 'd1', 'tenant_uuid': 'tenant'},
+                {'id': 'd3', 'tenant_uuid': 'tenant'},
+            ]
+        )
+        assert_that(
+            self._written_lines(request),
+            contains_exactly(
+                {'id': 'd1'},
+                {'error': 'line 2: invalid tenant_uuid "other"'},
+                {'id': 'd3'},
+            ),
+        )
+
+    def test_configuration_progress_is_reported(self) -> None:
+        self.app.dev_insert_many.return_value = (defer.succeed(['d1']), self.oip)
+
+        request = self._import(b'{"id": "d1"}\n')
+        self.oip.current = 1
+        self.oip.end = 2
+        oip_request = _Request(b'/dev_mgr/import/1')
+        location = request.responseHeaders.getRawHeaders(b'Location')
+        data = self.resource.children[b'1'].render_GET(oip_request)
+
+        assert_that(location, equal_to([b'/dev_mgr/import/1']))
+        assert_that(json.loads(data), equal_to({'status': 'configure|progress;1/2'}))
+
+    def test_other_media_types_are_refused(self) -> None:
+        request = _Request(b'/dev_mgr/import', b'{"id": "d1"}\n')
+        request.requestHeaders.setRawHeaders(b'Content-Type', [b'application/json'])
+
+        self.resource.render_POST(request)
+
+        assert_that(request.responseCode, equal_to(http.UNSUPPORTED_MEDIA_TYPE))
+        self.app.dev_insert_many.assert_not_called()
+
+
+class TestDevicesExportResource(_ResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.resource = server.DevicesExportResource(self.app)
+        self.resource._build_tenant_list_from_request = Mock(  # type: ignore
+            return_value=['tenant']
+        )
+
+    def test_devices_are_exported_as_ndjson(self) -> None:
+        devices = [{'id': 'd1', 'mac': '00:11:22:33:44:55'}, {'id': 'd2'}]
+        self.app.dev_find.return_value = defer.succeed(iter(devices))
+        request = _Request(b'/dev_mgr/export')
+
+        self.resource.render_GET(request)
+        self._run()
+
+        self.app.dev_find.assert_called_once_with(
+            selector={'tenant_uuid': {'$in': ['tenant']}}
+        )
+        assert_that(
+            request.responseHeaders.getRawHeaders(b'Content-Type'),
+            equal_to([NDJSON_MIME_TYPE.encode('ascii')]),
+        )
+        assert_that(
+            self._written(request),
+            equal_to('{"id":"d1","mac":"00:11:22:33:44:55"}\n{"id":"d2"}\n'),
+        )
+        assert_that(request.finished, equal_to(1))
+
+
+class TestDeferredRespondDocuments(_ResourceTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(server, 'STREAM_BATCH_SIZE', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _respond(self, documents: list[dict[str, Any]]) -> _Request:
+        request = _Request(b'/dev_mgr/devices')
+        server.deferred_respond_documents(
+            cast(Request, request), 'devices', iter(documents)
+        )
+        self._run()
+        return request
+
+    def test_documents_are_written_in_batches(self) -> None:
+        # the opening and closing of the object are chunks of their own, so
+        # that 1, 4 and 7 documents fill exactly 1, 2 and 3 batches
+        for count, write_count in [(0, 1), (1, 1), (2, 2), (4, 2), (5, 3), (7, 3)]:
+            documents = [{'id': f'd{i}'} for i in range(count)]
+
+            request = self._respond(documents)
+
+            assert_that(
+                len(request.written), equal_to(write_count), f'{count} documents'
+            )
+            assert_that(
+                json.loads(self._written(request)), equal_to({'devices': documents})
+            )
+            assert_that(request.finished, equal_to(1))
+
+    def test_documents_are_iterated_as_they_are_written(self) -> None:
+        iterated: list[int] = []
+
+        def documents() -> Generator[dict[str, Any], None, None]:
+            for i in range(4):
+                iterated.append(i)
+                yield {'id': f'd{i}'}
+
+        request = _Request(b'/dev_mgr/devices')
+        server.deferred_respond_documents(
+            cast(Request, request), 'devices', documents()
+        )
+        self.clock.advance(1)
+
+        assert_that(iterated, equal_to([0, 1]))
+        assert_that(
+            self._written(request), equal_to('{"devices":[{"id":"d0"},{"id":"d1"}')
+        )
+        self._run()
+        assert_that(iterated, equal_to([0, 1, 2, 3]))
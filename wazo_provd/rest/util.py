@@ -6,6 +6,7 @@ from __future__ import annotations
 from wazo_provd.util import decode_bytes
 
 PROV_MIME_TYPE = 'application/vnd.proformatique.provd+json'
+NDJSON_MIME_TYPE = 'application/x-ndjson'
 
 
 def uri_append_path(base: bytes | str, *path: bytes | str) -> str:
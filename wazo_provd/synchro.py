@@ -1,4 +1,4 @@
-# Copyright 2011-2023 The Wazo Authors  (see the AUTHORS file)
+# Copyright 2011-2024 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 """Synchronization primitives for event driven systems."""
@@ -6,11 +6,13 @@ from __future__ import annotations
 
 import logging
 from collections import deque
-from collections.abc import Callable
-from typing import Any, TypeVar
+from collections.abc import Callable, Hashable, Iterable
+from typing import Any, TypeVar, cast
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IReactorFromThreads
+from twisted.python.threadpool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
@@ -155,3 +157,250 @@ class DeferredRWLock:
         logger.debug('Releasing write lock %d of RWLock %s', self._writing - 1, self)
         self._writing -= 1
         self._reschedule()
+
+    @property
+    def idle(self) -> bool:
+        """True if no one is holding or waiting for the lock."""
+        return not (
+            self._reading or self._writing or self._read_waiting or self._write_waiting
+        )
+
+
+class DeferredLockManager:
+    """Read-write locks identified by keys, under a global read-write lock.
+
+    Operations on a few keys, e.g. on a device, acquire the read lock of the
+    global lock and then the locks of these keys, so that operations on
+    unrelated keys can run concurrently. Operations on everything escalate
+    to the write lock of the global lock and so are run alone.
+
+    The lock of every key needed by an operation must be acquired in one call
+    to acquire, which always acquires them in the same (sorted) order, so
+    keys must be orderable. The lock of a key only exists while someone is
+    holding or waiting for it.
+
+    """
+
+    def __init__(self) -> None:
+        self.global_lock = DeferredRWLock()
+        self._locks: dict[Hashable, DeferredRWLock] = {}
+
+    def _acquire_key(self, key: Hashable, write: bool) -> Deferred:
+        # the lock is looked up only when it's its turn to be acquired, since
+        # it might be removed while the previous keys are being acquired
+        try:
+            rw_lock = self._locks[key]
+        except KeyError:
+            rw_lock = self._locks[key] = DeferredRWLock()
+        lock = rw_lock.write_lock if write else rw_lock.read_lock
+        return lock.acquire()
+
+    def acquire(
+        self, write_keys: Iterable[Hashable] = (), read_keys: Iterable[Hashable] = ()
+    ) -> Deferred:
+        """Acquire the read lock of the global lock, then the write lock of
+        every write key and the read lock of every read key.
+
+        Return a deferred that will fire with a token to pass to release once
+        every lock has been acquired.
+
+        """
+        modes = dict.fromkeys(read_keys, False)
+        modes.update(dict.fromkeys(write_keys, True))
+        token = sorted(modes.items())
+
+        d = self.global_lock.read_lock.acquire()
+        for key, write in token:
+            d.addCallback(lambda _, key=key, write=write: self._acquire_key(key, write))
+        d.addCallback(lambda _: token)
+        return d
+
+    def release(self, token: list[tuple[Hashable, bool]]) -> None:
+        for key, write in reversed(token):
+            rw_lock = self._locks[key]
+            if write:
+                rw_lock.write_lock.release()
+            else:
+                rw_lock.read_lock.release()
+            # the lock might already have been removed by a waiter that was
+            # run to completion by the release
+            if rw_lock.idle and self._locks.get(key) is rw_lock:
+                del self._locks[key]
+        self.global_lock.read_lock.release()
+
+    def _releaseAndReturn(self, r: R, token: list[tuple[Hashable, bool]]) -> R:
+        self.release(token)
+        return r
+
+    def run_acquired(
+        self, token: list[tuple[Hashable, bool]], f: Callable, *args: Any, **kwargs: Any
+    ) -> Deferred:
+        """Call f with the locks of token already acquired, and release them
+        once the deferred returned by f has fired.
+
+        """
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        d.addBoth(self._releaseAndReturn, token)
+        return d
+
+    def run(
+        self,
+        write_keys: Iterable[Hashable],
+        read_keys: Iterable[Hashable],
+        f: Callable,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Deferred:
+        """Call f once the locks of the keys have been acquired, and release
+        them once the deferred returned by f has fired.
+
+        """
+        d = self.acquire(write_keys, read_keys)
+        d.addCallback(self.run_acquired, f, *args, **kwargs)
+        return d
+
+
+class _ExecutorCall:
+    def __init__(self, keys: frozenset[Hashable], start: Callable[[], None]) -> None:
+        self.keys = keys
+        self.start = start
+        # number of keys for which an earlier call is still pending
+        self.blocked_by = 0
+
+
+class DeferredExecutor:
+    """Execute functions in a pool of threads, with ordering guarantees.
+
+    Every call is made on behalf of a group and for a set of keys. Calls
+    sharing a key are executed one at a time, in the order they have been
+    submitted, and at most max_calls_per_group calls of a same group are
+    executed at the same time.
+
+    If max_threads is 0, functions are called in the reactor thread instead,
+    with the same guarantees.
+
+    """
+
+    def __init__(
+        self,
+        max_threads: int,
+        max_calls_per_group: int = 1,
+        reactor: IReactorFromThreads | None = None,
+    ) -> None:
+        if max_calls_per_group < 1:
+            raise ValueError(f'invalid max calls per group {max_calls_per_group}')
+        if reactor is None:
+            from twisted.internet import reactor as default_reactor
+
+            reactor = cast(IReactorFromThreads, default_reactor)
+        self._reactor = reactor
+        self._max_calls_per_group = max_calls_per_group
+        self._semaphores: dict[Hashable, defer.DeferredSemaphore] = {}
+        self._queues: dict[Hashable, deque[_ExecutorCall]] = {}
+        self._threadpool: ThreadPool | None = None
+        if max_threads > 0:
+            self._threadpool = ThreadPool(0, max_threads, 'DeferredExecutor')
+            self._threadpool.start()
+
+    def close(self) -> None:
+        """Stop the threads of the pool, waiting for running calls."""
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
+
+    @property
+    def idle(self) -> bool:
+        return not self._queues
+
+    def _enqueue(self, call: _ExecutorCall) -> None:
+        for key in call.keys:
+            queue = self._queues.setdefault(key, deque())
+            if queue:
+                call.blocked_by += 1
+            queue.append(call)
+        if not call.blocked_by:
+            call.start()
+
+    def _dequeue(self, call: _ExecutorCall) -> None:
+        for key in call.keys:
+            queue = self._queues[key]
+            assert queue[0] is call
+            queue.popleft()
+            if queue:
+                next_call = queue[0]
+                next_call.blocked_by -= 1
+                if not next_call.blocked_by:
+                    next_call.start()
+            else:
+                del self._queues[key]
+
+    def _submit(
+        self,
+        group: Hashable,
+        keys: Iterable[Hashable],
+        f: Callable,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Deferred:
+        try:
+            semaphore = self._semaphores[group]
+        except KeyError:
+            semaphore = self._semaphores[group] = defer.DeferredSemaphore(
+                self._max_calls_per_group
+            )
+        result: Deferred = Deferred()
+
+        def start() -> None:
+            d = semaphore.run(f, *args, **kwargs)
+            d.addBoth(finish)
+
+        def finish(r: Any) -> None:
+            self._dequeue(call)
+            result.callback(r)
+
+        call = _ExecutorCall(frozenset(keys), start)
+        self._enqueue(call)
+        return result
+
+    def call_in_thread(
+        self,
+        group: Hashable,
+        keys: Iterable[Hashable],
+        f: Callable,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Deferred:
+        """Call f in a thread of the pool once it's its turn.
+
+        Return a deferred that will fire with the result of f.
+
+        """
+        if self._threadpool is None:
+            return self._submit(group, keys, f, *args, **kwargs)
+        return self._submit(
+            group,
+            keys,
+            threads.deferToThreadPool,
+            self._reactor,
+            self._threadpool,
+            f,
+            *args,
+            **kwargs,
+        )
+
+    def call(
+        self,
+        group: Hashable,
+        keys: Iterable[Hashable],
+        f: Callable,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Deferred:
+        """Call f in the reactor thread once it's its turn, for functions
+        that return a deferred or that must not be called from another thread.
+
+        The call is considered completed once the deferred returned by f has
+        fired.
+
+        """
+        return self._submit(group, keys, f, *args, **kwargs)
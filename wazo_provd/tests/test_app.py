@@ -4,11 +4,19 @@
 from __future__ import annotations
 
 import unittest
-from unittest.mock import Mock, sentinel
+from typing import cast
+from unittest.mock import MagicMock, Mock, sentinel
 
-from hamcrest import assert_that, equal_to, is_
+from hamcrest import assert_that, equal_to, is_, is_not, none
+from twisted.internet import defer
 
-from wazo_provd.app import ApplicationConfigureService
+from wazo_provd.app import (
+    ApplicationConfigureService,
+    ProvisioningApplication,
+    _keep_unchanged_values,
+    _plugin_config_digest,
+)
+from wazo_provd.devices.schemas import DeviceDict, RawConfigDict
 from wazo_provd.services import InvalidParameterError
 
 
@@ -36,3 +44,162 @@ class TestAppConfigureService(unittest.TestCase):
     def test_set_nat_to_none(self) -> None:
         self.service.set('NAT', None)
         assert_that(self.app.nat, equal_to(0))
+
+
+class TestKeepUnchangedValues(unittest.TestCase):
+    def test_keep_unchanged_values(self) -> None:
+        device = cast(
+            DeviceDict, {'id': 'a', 'ip': '10.0.0.2', 'vendor': 'v', 'model': 'm2'}
+        )
+        old_device = cast(
+            DeviceDict, {'id': 'a', 'ip': '10.0.0.1', 'model': 'm1', 'plugin': 'p'}
+        )
+
+        _keep_unchanged_values(device, old_device, {'ip', 'vendor'})
+
+        assert_that(
+            device,
+            equal_to(
+                {
+                    'id': 'a',
+                    'ip': '10.0.0.2',
+                    'vendor': 'v',
+                    'model': 'm1',
+                    'plugin': 'p',
+                }
+            ),
+        )
+
+
+class TestDevNewRawConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = Mock()
+        self.raw_config = cast(
+            RawConfigDict, {'http_base_url': 'http://provd', 'sip_lines': {'1': {}}}
+        )
+
+    def test_raw_config_is_copied_without_provisioning_key(self) -> None:
+        self.app.use_provisioning_key = False
+
+        raw_config = ProvisioningApplication._dev_new_raw_config(
+            self.app, {'id': 'a'}, self.raw_config
+        )
+
+        assert_that(raw_config, equal_to(self.raw_config))
+        self.assertIsNot(raw_config, self.raw_config)
+        self.assertIsNot(raw_config['sip_lines'], self.raw_config['sip_lines'])
+
+    def test_provisioning_key_is_added_to_the_copy(self) -> None:
+        self.app.use_provisioning_key = True
+        self.app.configure_service.get.return_value = 'key'
+
+        raw_config = ProvisioningApplication._dev_new_raw_config(
+            self.app, {'id': 'a', 'tenant_uuid': 't'}, self.raw_config
+        )
+        raw_config['sip_lines']['1']['username'] = 'u'
+
+        assert_that(raw_config['http_base_url'], equal_to('http://provd/key'))
+        assert_that(
+            self.raw_config,
+            equal_to({'http_base_url': 'http://provd', 'sip_lines': {'1': {}}}),
+        )
+        self.app.configure_service.get.assert_called_once_with('provisioning_key', 't')
+
+
+class TestDevGetConfiguredDigest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = Mock()
+        self.app.use_provisioning_key = False
+        self.app.proxies = {}
+        self.app.nat = 0
+        self.app._plugin_versions = {'p': '1.0'}
+        self.app._plugin_config_digests = {'p': _plugin_config_digest({}, {})}
+        self.plugin = Mock(id='p')
+        self.device = cast(DeviceDict, {'id': 'a', 'plugin': 'p'})
+
+    def _digest(self) -> str | None:
+        return ProvisioningApplication._dev_get_configured_digest(
+            self.app, self.device, self.plugin, 'raw-config-digest'
+        )
+
+    def test_digest_depends_on_plugin_config(self) -> None:
+        digest = self._digest()
+
+        self.app._plugin_config_digests['p'] = _plugin_config_digest({}, {'k': 'v'})
+
+        assert_that(self._digest(), is_not(equal_to(digest)))
+
+    def test_digest_depends_on_proxies_and_nat(self) -> None:
+        digest = self._digest()
+
+        self.app.proxies = {'http': 'http://proxy'}
+        proxies_digest = self._digest()
+        self.app.nat = 1
+
+        assert_that(proxies_digest, is_not(equal_to(digest)))
+        assert_that(self._digest(), is_not(equal_to(proxies_digest)))
+
+    def test_no_digest_without_plugin_version(self) -> None:
+        self.app._plugin_versions = {'p': None}
+
+        assert_that(self._digest(), none())
+
+
+class TestPgDeconfigureOutdatedDevices(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = Mock()
+        self.plugin = Mock(id='p')
+        self.app.pg_mgr = MagicMock()
+        self.app.pg_mgr.__getitem__.return_value = self.plugin
+        self.app.pg_mgr.list_installed.return_value = {'p': {'version': '1.0'}}
+        self.app._plugin_versions = {'p': '1.0'}
+        self.app._plugin_config_digests = {'p': _plugin_config_digest({}, {})}
+        self.app._pg_new_config.return_value = ({}, {})
+        self.app._dev_get_configuration.side_effect = lambda device: defer.succeed(
+            (self.plugin, {}, 'digest')
+        )
+        self.app._dev_deconfigure.return_value = defer.succeed(True)
+        self.app._dev_collection.update.return_value = defer.succeed(None)
+        self.devices = [
+            cast(
+                DeviceDict,
+                {'id': 'a', 'configured': True, 'configured_digest': 'digest'},
+            ),
+            cast(
+                DeviceDict,
+                {'id': 'b', 'configured': True, 'configured_digest': 'outdated'},
+            ),
+            cast(DeviceDict, {'id': 'c', 'configured': False}),
+        ]
+
+    def _deconfigure(self) -> None:
+        ProvisioningApplication._pg_deconfigure_outdated_devices(
+            self.app, 'p', self.devices
+        )
+
+    def _deconfigured_ids(self) -> list[str]:
+        return [call.args[0]['id'] for call in self.app._dev_deconfigure.call_args_list]
+
+    def test_outdated_devices_are_deconfigured(self) -> None:
+        self._deconfigure()
+
+        assert_that(self._deconfigured_ids(), equal_to(['b']))
+        self.app._dev_deconfigure.assert_called_once_with(self.devices[1], self.plugin)
+        self.app._dev_collection.update.assert_called_once_with(self.devices[1])
+        assert_that(self.devices[1], equal_to({'id': 'b', 'configured': False}))
+        assert_that(self.devices[0]['configured'], equal_to(True))
+
+    def test_configured_devices_are_deconfigured_on_version_change(self) -> None:
+        self.app.pg_mgr.list_installed.return_value = {'p': {'version': '2.0'}}
+
+        self._deconfigure()
+
+        assert_that(self._deconfigured_ids(), equal_to(['a', 'b']))
+        self.app._dev_get_configuration.assert_not_called()
+
+    def test_configured_devices_are_deconfigured_on_config_change(self) -> None:
+        self.app._pg_new_config.return_value = ({}, {'k': 'v'})
+
+        self._deconfigure()
+
+        assert_that(self._deconfigured_ids(), equal_to(['a', 'b']))
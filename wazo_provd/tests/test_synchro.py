@@ -6,11 +6,14 @@
 
 from __future__ import annotations
 
+import threading
 import time
+import unittest
+from unittest.mock import Mock
 
 from twisted.internet import defer, reactor
 
-from wazo_provd.synchro import DeferredRWLock
+from wazo_provd.synchro import DeferredExecutor, DeferredLockManager, DeferredRWLock
 
 _load_time = time.time()
 
@@ -157,6 +160,144 @@ def rw_lock_tests():
     dl.addCallback(lambda _: reactor.stop())
 
 
+class TestDeferredLockManager(unittest.TestCase):
+    def setUp(self) -> None:
+        self.locks = DeferredLockManager()
+
+    def _acquire(self, *args, **kwargs) -> list:
+        tokens: list = []
+        self.locks.acquire(*args, **kwargs).addCallback(tokens.append)
+        return tokens
+
+    def test_unrelated_keys_are_acquired_concurrently(self) -> None:
+        token1 = self._acquire([('device', 'd1')], [('config', 'c1')])
+        token2 = self._acquire([('device', 'd2')], [('config', 'c1')])
+
+        self.assertTrue(token1)
+        self.assertTrue(token2)
+
+    def test_same_key_waits_for_release(self) -> None:
+        (token1,) = self._acquire([('device', 'd1')])
+        token2 = self._acquire([('device', 'd1')])
+
+        self.assertEqual([], token2)
+
+        self.locks.release(token1)
+
+        self.assertTrue(token2)
+
+    def test_read_keys_wait_for_write_key(self) -> None:
+        (token1,) = self._acquire([('config', 'c1')])
+        token2 = self._acquire([], [('config', 'c1')])
+
+        self.assertEqual([], token2)
+
+        self.locks.release(token1)
+
+        self.assertTrue(token2)
+
+    def test_global_write_lock_waits_for_keys(self) -> None:
+        (token1,) = self._acquire([('device', 'd1')])
+        called: list[bool] = []
+        self.locks.global_lock.write_lock.run(called.append, True)
+        token2 = self._acquire([('device', 'd2')])
+
+        self.assertEqual([], called)
+        self.assertEqual([], token2)
+
+        self.locks.release(token1)
+
+        self.assertEqual([True], called)
+        self.assertTrue(token2)
+
+    def test_locks_are_removed_once_released(self) -> None:
+        (token1,) = self._acquire([('device', 'd1')], [('config', 'c1')])
+        self.locks.release(token1)
+
+        self.assertEqual({}, self.locks._locks)
+
+    def test_run_releases_on_error(self) -> None:
+        def fail():
+            raise ValueError()
+
+        d = self.locks.run([('device', 'd1')], [], fail)
+        d.addErrback(lambda failure: failure.trap(ValueError))
+
+        self.assertTrue(self._acquire([('device', 'd1')]))
+
+
+class TestDeferredExecutor(unittest.TestCase):
+    def setUp(self) -> None:
+        self.executor = DeferredExecutor(0, max_calls_per_group=2)
+        self.pending: dict[str, defer.Deferred] = {}
+        self.started: list[str] = []
+
+    def _call(self, name: str, group: str, keys: list[str]) -> defer.Deferred:
+        def f() -> defer.Deferred:
+            self.started.append(name)
+            d = self.pending[name] = defer.Deferred()
+            return d
+
+        return self.executor.call(group, keys, f)
+
+    def test_calls_on_same_key_are_ordered(self) -> None:
+        self._call('c1', 'p1', ['d1'])
+        self._call('c2', 'p2', ['d1', 'd2'])
+        self._call('c3', 'p3', ['d2'])
+        self._call('c4', 'p4', ['d3'])
+
+        self.assertEqual(['c1', 'c4'], self.started)
+
+        self.pending['c1'].callback(None)
+
+        self.assertEqual(['c1', 'c4', 'c2'], self.started)
+
+        self.pending['c2'].callback(None)
+
+        self.assertEqual(['c1', 'c4', 'c2', 'c3'], self.started)
+
+    def test_calls_per_group_are_limited(self) -> None:
+        for name in ['c1', 'c2', 'c3']:
+            self._call(name, 'p1', [name])
+        self._call('c4', 'p2', ['c4'])
+
+        self.assertEqual(['c1', 'c2', 'c4'], self.started)
+
+        self.pending['c2'].callback(None)
+
+        self.assertEqual(['c1', 'c2', 'c4', 'c3'], self.started)
+
+    def test_result_and_errors_are_returned(self) -> None:
+        def fail() -> None:
+            raise ValueError()
+
+        results: list = []
+        self.executor.call('p1', ['d1'], lambda: 42).addCallback(results.append)
+        self.executor.call('p1', ['d1'], fail).addErrback(results.append)
+
+        self.assertEqual(42, results[0])
+        results[1].trap(ValueError)
+        self.assertTrue(self.executor.idle)
+
+    def test_call_in_thread(self) -> None:
+        reactor = Mock()
+        reactor.callFromThread.side_effect = lambda f, *args: f(*args)
+        executor = DeferredExecutor(2, reactor=reactor)
+        done = threading.Event()
+        results: list = []
+
+        def callback(result) -> None:
+            results.append(result)
+            done.set()
+
+        d = executor.call_in_thread('p1', ['d1'], threading.current_thread)
+        d.addCallback(callback)
+        done.wait(5)
+        executor.close()
+
+        self.assertIsNot(threading.current_thread(), results[0])
+
+
 if __name__ == '__main__':
     rw_lock_tests()
     reactor.run()